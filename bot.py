@@ -6,6 +6,44 @@
 # - Daily reminder at 16:55 (5 min before window) to ADMIN_NOTIFY_CHAT_IDS
 # - Daily report at 03:00 with yesterday stats to ADMIN_NOTIFY_CHAT_IDS
 # - Access mode open/closed with approve/block
+# - Logging: non-blocking (QueueListener), JSON logs/bot.log with size/time rotation + gzip, sampling (LOG_* env)
+# - Storage: async layer over SQLite (default) or Postgres/asyncpg (DB_BACKEND, DATABASE_URL); `python bot.py --migrate-to-pg`;
+#   `--storage-selftest` checks both backends (Postgres via SELFTEST_DATABASE_URL)
+# - DB maintenance after the 01:00 report: WAL checkpoint, ANALYZE/optimize, incremental vacuum, stats to admins (/db_maint)
+# - Retention: old codes/reservations/rewards move to the archive DB (RETENTION_* env), per-day rollups keep stats
+# - "📇 Моя карта": iiko customer info via stale-while-revalidate cache (IIKO_BASE_URL, IIKO_CACHE_* env);
+#   `python bot.py --iiko-selftest` runs it against a local stub iiko
+# - Bulk prize import: /import_prizes + CSV/XLSX, one transaction, phone_norm join, rate-limited sender
+# - Backups: daily online SQLite backup of codes.db and the archive DB to backups/ (integrity_check, daily/weekly
+#   rotation), /backup_now, /backup_status
+#   Restore (bot stopped): python bot.py --restore backups/codes-YYYYMMDD-HHMMSS.db (+ its .archive.db)
+# - Settings: /settings, /set key value — discounts, code window, schedule, menu, luck prizes in the DB over .env;
+#   handlers read an immutable cached snapshot, scheduled jobs re-plan when their time changes
+# - Update ledger: redelivered updates are skipped (processed_updates, written in the handler's transaction),
+#   one-shot user operations (reservation, luck draw) are keyed in op_keys; both pruned hourly
+# - Task supervisor: background jobs with per-run timeouts, retry backoff and restart, heartbeat/last success;
+#   /health for admins, HTTP /healthz /readyz /metrics on HEALTH_PORT
+# - Stall detector: sidecar thread measures event-loop lag, captures the blocking stack + update/handler (/stalls),
+#   lag percentiles in /metrics (STALL_* env)
+# - Analytics: /analytics [N | from to] — DAU/WAU/MAU, funnel start→contact→code→reservation→redeem,
+#   weekly cohort retention; read from incrementally updated aggregates (user_activity, analytics_daily)
+# - Door check: /check CODE for staff (ADMIN_IDS + STAFF_IDS) — in-memory index of today's/yesterday's codes,
+#   atomic one-time redeem, codes(day_key, code) fallback; `python bot.py --bench-check`
+# - Signed codes (CODE_FORMAT=hmac): day/kind/discount-or-prize/nonce + 25-bit HMAC in 13 base32 chars, checked
+#   offline before any DB lookup; key rotation via CODE_HMAC_KEYS="1:s1,2:s2" + CODE_HMAC_ACTIVE; --codes-selftest
+# - QR codes: bracelet/luck codes also sent as QR (rendered in a thread pool); Telegram file_id cached in tg_files
+#   (qr:<code>, asset:map, asset:menu_cover via ASSET_MAP_PATH / ASSET_MENU_COVER_PATH) so re-displays upload nothing
+# - Venues: VENUES="a,b" + venues/<name>.env — several venues/bots in one process (multibot polling, shared
+#   HTTP session, scheduler and metrics with venue label); each venue has its own DB, .env values and /set settings
+# - Admin panel: one message edited in place (sections, back, refresh; ap:<screen>); dashboard with today's
+#   reservations/codes/rewards and queue depths cached for ADMIN_DASHBOARD_TTL per venue
+# - Prize delivery: per-prize status (delivered_at, attempts, last_error); pending prizes go out as soon as the
+#   guest shares the contact (partial index on phone_norm), the weekly run only retries undelivered rows
+# - Guest identity: unique guests(user_id) / guests(phone_norm), duplicates merged at startup with a report to
+#   admins (`python bot.py --merge-guests [--dry-run]`); one joined users+guests read per update (guest_profile)
+# - Read-only reporting: reports and list views (@read_only) read through a small pool of SQLite mode=ro +
+#   query_only connections in worker threads (SQLITE_READ_POOL); under WAL they never block code writes
+# - Lifecycle: /restart and SIGTERM drain in-flight handlers before exit/execv; /reload or SIGHUP re-reads .env live
 # Requires: Python 3.11+, aiogram==3.13.1, python-dotenv, tzdata (Windows)
 from aiogram import F
 import os
@@ -18,34 +56,252 @@ from typing import Optional, List, Union
 from dotenv import load_dotenv
 from zoneinfo import ZoneInfo
 # === Logging setup ===
+# Все записи уходят в очередь (QueueHandler), а файл/консоль пишет отдельный поток
+# (QueueListener) — event loop никогда не блокируется на диске или stdout.
 import logging
+import logging.handlers
+import atexit
+import contextvars
+import copy
+import gzip
+import hashlib
+import hmac
+import signal
+import csv
+import html
+import io
+import json
+import queue
+import shutil
+import time
+from collections import OrderedDict, deque
+
+import requests
+
+# .env читается один раз, здесь: LOG_* ниже и раздел ENV берут значения уже из окружения
+dotenv_path = os.path.join(os.path.dirname(__file__), ".env")
+load_dotenv(dotenv_path, override=True)
 
 LOG_DIR = os.path.join(os.path.dirname(__file__), "logs")
 os.makedirs(LOG_DIR, exist_ok=True)
 LOG_FILE = os.path.join(LOG_DIR, "bot.log")
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-    handlers=[
-        logging.FileHandler(LOG_FILE, encoding="utf-8"),
-        logging.StreamHandler()
-    ]
-)
+LOG_LEVEL = (os.getenv("LOG_LEVEL", "INFO") or "INFO").upper()
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))   # ротация по размеру
+LOG_ROTATE_HOURS = int(os.getenv("LOG_ROTATE_HOURS", "24"))              # ротация по времени
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "14"))              # сколько .gz хранить
+# Сэмплирование шумных логгеров: "shishka-bot.broadcast=0.05,shishka-bot.iiko=0.2"
+# (доля INFO/WARNING-записей, которые доходят до файла; ERROR пишется всегда)
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "shishka-bot.broadcast=0.05")
+
+# контекст текущего апдейта (заполняется middleware, см. LogContextMiddleware)
+LOG_CTX_UPDATE_ID: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("log_update_id", default=None)
+LOG_CTX_USER_ID: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("log_user_id", default=None)
+LOG_CTX_HANDLER: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("log_handler", default=None)
+LOG_CTX_VENUE: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("log_venue", default=None)
+
+
+class _ContextFilter(logging.Filter):
+    """Добавляет к записи venue / user_id / handler / update_id из contextvars.
+
+    Висит на QueueHandler, т.е. выполняется в потоке, который пишет лог, —
+    там, где contextvars ещё доступны."""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.update_id = LOG_CTX_UPDATE_ID.get()
+        record.user_id = LOG_CTX_USER_ID.get()
+        record.handler = LOG_CTX_HANDLER.get()
+        record.venue = LOG_CTX_VENUE.get()
+        return True
+
+
+class _SamplingFilter(logging.Filter):
+    """Пропускает только долю записей ниже ERROR для заданных логгеров."""
+    def __init__(self, raw: str):
+        super().__init__()
+        self.rates: dict[str, float] = {}
+        for part in (raw or "").split(","):
+            name, _, rate = part.strip().partition("=")
+            try:
+                self.rates[name.strip()] = max(0.0, min(1.0, float(rate)))
+            except ValueError:
+                continue
+        self.dropped = 0
+
+    def _rate_for(self, name: str) -> float:
+        # ищем самое длинное совпадение по префиксу: a.b.c -> a.b -> a
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition(".")[0]
+        return 1.0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR or not self.rates:
+            return True
+        rate = self._rate_for(record.name)
+        if rate >= 1.0 or random.random() < rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+class _JsonFormatter(logging.Formatter):
+    """Одна запись — одна JSON-строка (удобно для grep/jq и сборщиков логов)."""
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in ("venue", "user_id", "handler", "update_id"):
+            value = getattr(record, key, None)
+            if value is not None:
+                payload[key] = value
+        # трейсбек приходит из очереди уже строкой (_QueueHandler.prepare); exc_info — на случай прямого вызова
+        exc = record.exc_text or (self.formatException(record.exc_info) if record.exc_info else None)
+        if exc:
+            payload["exc"] = exc
+        return json.dumps(payload, ensure_ascii=False)
+
+
+class _ConsoleFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        ctx = " ".join(
+            f"{key}={getattr(record, key)}"
+            for key in ("venue", "update_id", "user_id", "handler")
+            if getattr(record, key, None) is not None
+        )
+        return f"{line} [{ctx}]" if ctx else line
+
+
+_EXC_FORMATTER = logging.Formatter()
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Стандартный prepare() вклеивает трейсбек в msg и обнуляет exc_text — JSON-поле exc терялось.
+    Здесь msg — только сообщение, трейсбек едет отдельно в exc_text."""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = _EXC_FORMATTER.formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+def _gzip_rotator(source: str, dest: str) -> None:
+    if not os.path.exists(source):
+        return
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class _SizeTimeRotatingHandler(logging.handlers.RotatingFileHandler):
+    """Ротация по размеру ИЛИ раз в interval_s секунд; архивы сжимаются в .gz."""
+    def __init__(self, filename: str, max_bytes: int, interval_s: int, backup_count: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.interval_s = interval_s
+        self.rollover_at = time.time() + interval_s if interval_s else None
+        self.namer = lambda name: name + ".gz"
+        self.rotator = _gzip_rotator
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        if self.interval_s:
+            self.rollover_at = time.time() + self.interval_s
+
+
+def _setup_logging() -> logging.handlers.QueueListener:
+    file_handler = _SizeTimeRotatingHandler(LOG_FILE, LOG_MAX_BYTES, LOG_ROTATE_HOURS * 3600, LOG_BACKUP_COUNT)
+    file_handler.setFormatter(_JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(_ConsoleFormatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(_SamplingFilter(LOG_SAMPLE))
+    queue_handler.addFilter(_ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+LOG_LISTENER = _setup_logging()
 
 logger = logging.getLogger("shishka-bot")
+iiko_log = logger.getChild("iiko")
+broadcast_log = logger.getChild("broadcast")
 
 
-import requests
-from dotenv import load_dotenv
+# ===== Metrics =====
+class Metrics:
+    """In-process счётчики и gauge'и с метками; /metrics отдаёт их в формате Prometheus."""
+    def __init__(self):
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.gauges: dict[tuple[str, tuple], float] = {}
+        self.base_labels = None   # () -> dict: метки по умолчанию (venue при нескольких заведениях)
+
+    def _key(self, name: str, labels: dict) -> tuple[str, tuple]:
+        if self.base_labels:
+            labels = {**self.base_labels(), **labels}
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        self.gauges[self._key(name, labels)] = value
+
+    def get(self, name: str, **labels) -> float:
+        key = self._key(name, labels)
+        return self.counters.get(key, self.gauges.get(key, 0))
+
+    def render(self) -> str:
+        lines = []
+        for kind, store in (("counter", self.counters), ("gauge", self.gauges)):
+            seen = set()
+            for (name, labels), value in sorted(store.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} {kind}")
+                    seen.add(name)
+                lbl = ",".join(f'{k}="{v}"' for k, v in labels)
+                num = f"{value:.15g}"  # без экспоненты для unix-времени
+                lines.append(f"{name}{{{lbl}}} {num}" if lbl else f"{name} {num}")
+        return "\n".join(lines)
+
+
+metrics = Metrics()
+
 
-load_dotenv()
 IIKO_API_KEY = os.getenv("IIKO_API_KEY")  # или напрямую как строку
+IIKO_BASE_URL = os.getenv("IIKO_BASE_URL", "https://m1.iiko.cards/api/0").rstrip("/")
+IIKO_TIMEOUT = float(os.getenv("IIKO_TIMEOUT", "10"))
+
+
+class IikoError(Exception):
+    """iiko недоступен / ответил ошибкой (в отличие от «гость не найден»)."""
+
 
 def get_iiko_token():
     try:
-        url = f"https://m1.iiko.cards/api/0/auth/access_token?apiLogin={IIKO_API_KEY}"
-        resp = requests.get(url, timeout=10)
+        url = f"{IIKO_BASE_URL}/auth/access_token?apiLogin={IIKO_API_KEY}"
+        resp = requests.get(url, timeout=IIKO_TIMEOUT)
         resp.raise_for_status()
         return resp.json()["token"]
     except Exception as e:
@@ -53,22 +309,36 @@ def get_iiko_token():
         return None
 
 
-def find_guest_in_iiko(phone: str) -> dict | None:
+def fetch_iiko_customer(phone: str) -> dict | None:
+    """customer/info по телефону. None — гостя нет в iiko; IikoError — сбой запроса."""
     token = get_iiko_token()
     if not token:
-        return None
+        raise IikoError("no token")
 
-    url = "https://m1.iiko.cards/api/0/loyalty/customer/info"
+    url = f"{IIKO_BASE_URL}/loyalty/customer/info"
     headers = {"Authorization": f"Bearer {token}"}
     data = {"phone": phone.strip().replace(" ", "")}
 
     try:
-        resp = requests.post(url, json=data, headers=headers, timeout=10)
-        print("[IIKO][DEBUG]", resp.status_code, resp.text)
-        resp.raise_for_status()
-        return resp.json()
+        resp = requests.post(url, json=data, headers=headers, timeout=IIKO_TIMEOUT)
+    except requests.RequestException as e:
+        raise IikoError(str(e)) from e
+    iiko_log.debug("[IIKO] customer/info -> %s %s", resp.status_code, resp.text[:500])
+    if resp.status_code in (400, 404):
+        return None
+    if resp.status_code >= 300:
+        raise IikoError(f"HTTP {resp.status_code}")
+    try:
+        return resp.json() or None
+    except ValueError as e:
+        raise IikoError("bad json") from e
+
+
+def find_guest_in_iiko(phone: str) -> dict | None:
+    try:
+        return fetch_iiko_customer(phone)
     except Exception as e:
-        print("[IIKO][ERROR] Поиск карты:", e)
+        iiko_log.error("[IIKO] Поиск карты: %s", e)
         return None
 
 INVISIBLE = "\u2063"  # невидимый символ, безопасный для пустых сообщений
@@ -78,10 +348,7 @@ APP_VERSION = "SHISHKA bot v4.0 final"
 TZ = ZoneInfo("Asia/Tashkent")
 
 # ===== ENV =====
-dotenv_path = os.path.join(os.path.dirname(__file__), ".env")
-load_dotenv(dotenv_path, override=True)
-
-BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
+# .env уже загружен в начале файла (до настройки логов), см. dotenv_path
 
 def _parse_int_list(raw: str) -> List[int]:
     raw = (raw or "").replace(" ", "").strip()
@@ -112,213 +379,1139 @@ def _parse_targets(raw: str) -> List[Union[int, str]]:
             out.append(int(s))
     return out
 
-ADMIN_IDS = _parse_int_list(os.getenv("ADMIN_IDS", ""))
 # по умолчанию уведомления в @Restobar_Shishka
 default_notify = "@Restobar_Shishka"
-ADMIN_NOTIFY_CHAT_IDS = _parse_targets(os.getenv("ADMIN_NOTIFY_CHAT_IDS", default_notify))
 
-ADDRESS = os.getenv("ADDRESS", "ул Кичик Миробод 26 Shishka Restobar").strip()
-MAP_URL = os.getenv("MAP_URL", f"https://maps.google.com/?q={ADDRESS.replace(' ', '%20')}")
-CHANNEL_URL = os.getenv("CHANNEL_URL", "https://t.me/Restobar_Shishka")
+# 0=Mon ... 6=Sun, в .env: DISCOUNTS="0:40,1:30,2:30,3:30,4:20,5:20,6:30"
+def _parse_discounts(raw: str) -> dict[int, int]:
+    out: dict[int, int] = {}
+    for part in (raw or "").split(","):
+        day, _, pct = part.strip().partition(":")
+        if day.strip().isdigit() and pct.strip().isdigit():
+            out[int(day)] = int(pct)
+    return out
+
 
-ACCESS_MODE = (os.getenv("ACCESS_MODE", "open") or "open").lower()   # open | closed
-ACCESS_HINT = os.getenv("ACCESS_HINT", "Бот по приглашению. Мы свяжемся с вами после проверки.")
+def _env_conf(getenv) -> dict:
+    """Настройки заведения из .env (getenv — Venue.getenv). Их перечитывает /reload."""
+    address = getenv("ADDRESS", "ул Кичик Миробод 26 Shishka Restobar").strip()
+    return {
+        "ADMIN_IDS": _parse_int_list(getenv("ADMIN_IDS", "")),
+        "STAFF_IDS": _parse_int_list(getenv("STAFF_IDS", "")),  # кассиры/хостес: /check без админ-прав
+        "ADMIN_NOTIFY_CHAT_IDS": _parse_targets(getenv("ADMIN_NOTIFY_CHAT_IDS", default_notify)),
+        "ACCESS_MODE": (getenv("ACCESS_MODE", "open") or "open").lower(),   # open | closed
+        "ACCESS_HINT": getenv("ACCESS_HINT", "Бот по приглашению. Мы свяжемся с вами после проверки."),
+        "ADDRESS": address,
+        "MAP_URL": getenv("MAP_URL", f"https://maps.google.com/?q={address.replace(' ', '%20')}"),
+        "CHANNEL_URL": getenv("CHANNEL_URL", "https://t.me/Restobar_Shishka"),
+        # === Prize broadcast schedule (from .env or defaults) ===
+        "PRIZE_DAY": int(getenv("PRIZE_DAY", "6")),      # 0=Mon ... 6=Sun
+        "PRIZE_HOUR": int(getenv("PRIZE_HOUR", "18")),
+        "PRIZE_MINUTE": int(getenv("PRIZE_MINUTE", "0")),
+        "CODES_WINDOW_START": _parse_hhmm(getenv("CODES_WINDOW_START", "12:00")),
+        "CODES_WINDOW_END": _parse_hhmm(getenv("CODES_WINDOW_END", "19:00")),
+        "VALID_UNTIL_HHMM": _parse_hhmm(getenv("VALID_UNTIL_HHMM", "22:00")),
+        "DISCOUNTS": _parse_discounts(getenv("DISCOUNTS", "0:40,1:30,2:30,3:30,4:20,5:20,6:30")),  # Sun=30%
+        "MENU_URL": getenv("MENU_URL", "https://Shishkaone.myresto.online"),
+        "REMINDER_TIME": _parse_hhmm(getenv("REMINDER_TIME", "11:55")),
+        "REPORT_TIME": _parse_hhmm(getenv("REPORT_TIME", "01:00")),
+    }
 
 logger.info("[BOOT] VERSION: %s", APP_VERSION)
-print("[BOOT] ADMIN_IDS:", ADMIN_IDS)
-print("[BOOT] ADMIN_NOTIFY_CHAT_IDS:", ADMIN_NOTIFY_CHAT_IDS)
-print("[BOOT] ACCESS_MODE:", ACCESS_MODE)
-print("[BOOT] ADDRESS:", ADDRESS)
 
-# === Prize broadcast schedule (from .env or defaults) ===
-PRIZE_DAY    = int(os.getenv("PRIZE_DAY", "6"))      # 0=Mon ... 6=Sun
-PRIZE_HOUR   = int(os.getenv("PRIZE_HOUR", "18"))
-PRIZE_MINUTE = int(os.getenv("PRIZE_MINUTE", "0"))
+
+# ===== Venues =====
+# Один процесс может обслуживать несколько заведений: VENUES="shishka,second" —
+# для каждого файл venues/<имя>.env (поверх общего .env) со своим BOT_TOKEN,
+# базой, адресом, админами и т.д. Хендлеры, планировщик, метрики и HTTP-сессия
+# общие; всё, что принадлежит заведению (бот, storage, настройки /set, индексы,
+# состояния диалогов), живёт в объекте Venue. Текущее заведение — в contextvar:
+# его ставит VenueMiddleware по боту апдейта, фоновые задачи получают его при
+# запуске. Имена модуля bot, storage, code_index и т.п. — прокси на атрибут
+# текущего заведения, поэтому остальной код о заведениях не знает.
+# Без VENUES — одно заведение "main" из .env и codes.db, как раньше.
+from contextlib import contextmanager
+from dotenv import dotenv_values
+
+VENUES_DIR = os.getenv("VENUES_DIR") or os.path.join(os.path.dirname(__file__), "venues")
+VENUE_NAMES = [n.strip() for n in os.getenv("VENUES", "").split(",") if n.strip()]
+MULTI_VENUE = bool(VENUE_NAMES)
+
+_CURRENT_VENUE: contextvars.ContextVar[Optional["Venue"]] = contextvars.ContextVar("venue", default=None)
+_VENUE_LOCALS: dict[str, object] = {}   # имя атрибута -> фабрика factory(venue)
+
+
+def _read_env_file(path: str) -> dict[str, str]:
+    return {k: v for k, v in dotenv_values(path).items() if v is not None}
+
+
+class Venue:
+    """Заведение. Атрибуты В ВЕРХНЕМ регистре — значения из .env (_env_conf, /reload их
+    перечитывает); остальное состояние создаётся при первом обращении фабрикой venue_local()."""
+
+    def __init__(self, name: str, env_file: Optional[str] = None):
+        self.name = name
+        self.env_file = env_file
+        self.env = _read_env_file(env_file) if env_file else {}
+        base = os.path.dirname(__file__)
+        if env_file:
+            # пути и токен — только из файла заведения, иначе два заведения сядут на одну базу
+            self.BOT_TOKEN = self.env.get("BOT_TOKEN", "").strip()
+            self.db_path = self.env.get("DB_PATH") or os.path.join(base, f"codes_{name}.db")
+            self.archive_db_path = self.env.get("ARCHIVE_DB_PATH") or os.path.join(base, f"codes_{name}_archive.db")
+            self.database_url = self.env.get("DATABASE_URL", "")
+            self.backup_dir = self.env.get("BACKUP_DIR") or os.path.join(
+                os.getenv("BACKUP_DIR") or os.path.join(base, "backups"), name)
+        else:
+            self.BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
+            self.db_path = os.path.join(base, "codes.db")
+            self.archive_db_path = os.getenv("ARCHIVE_DB_PATH") or os.path.join(base, "codes_archive.db")
+            self.database_url = os.getenv("DATABASE_URL", "")
+            self.backup_dir = os.getenv("BACKUP_DIR") or os.path.join(base, "backups")
+        self.__dict__.update(_env_conf(self.getenv))
+
+    def getenv(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        value = self.env.get(key)
+        return value if value is not None else os.getenv(key, default)
+
+    def reload(self) -> dict[str, tuple]:
+        """Перечитывает venues/<имя>.env (общий .env — вызывающий). Возвращает {имя: (было, стало)}."""
+        if self.env_file:
+            self.env = _read_env_file(self.env_file)
+        changed = {}
+        for key, value in _env_conf(self.getenv).items():
+            old = getattr(self, key)
+            if old != value:
+                changed[key] = (old, value)
+                setattr(self, key, value)
+        return changed
+
+    def __getattr__(self, item: str):
+        factory = _VENUE_LOCALS.get(item)
+        if factory is None:
+            raise AttributeError(item)
+        with use_venue(self):
+            value = factory(self)
+        setattr(self, item, value)
+        return value
+
+    def __repr__(self) -> str:
+        return f"<Venue {self.name}>"
+
+
+class _VenueProxy:
+    """Имя модуля, за которым стоит атрибут текущего заведения (attr=None — само заведение)."""
+    __slots__ = ("_attr",)
+
+    def __init__(self, attr: Optional[str]):
+        object.__setattr__(self, "_attr", attr)
+
+    def _target(self):
+        v = current_venue()
+        attr = object.__getattribute__(self, "_attr")
+        return v if attr is None else getattr(v, attr)
+
+    def __getattr__(self, item):
+        return getattr(self._target(), item)
+
+    def __setattr__(self, item, value):
+        setattr(self._target(), item, value)
+
+    def __getitem__(self, key):
+        return self._target()[key]
+
+    def __setitem__(self, key, value):
+        self._target()[key] = value
+
+    def __delitem__(self, key):
+        del self._target()[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._target()
+
+    def __iter__(self):
+        return iter(self._target())
+
+    def __len__(self) -> int:
+        return len(self._target())
+
+    def __bool__(self) -> bool:
+        return bool(self._target())
+
+    def __call__(self, *args, **kwargs):
+        return self._target()(*args, **kwargs)
+
+    def __repr__(self) -> str:
+        return repr(self._target())
+
+
+def venue_local(name: str, factory) -> _VenueProxy:
+    """Состояние «на заведение»: factory(venue) вызывается при первом обращении."""
+    _VENUE_LOCALS[name] = factory
+    return _VenueProxy(name)
+
+
+def current_venue() -> "Venue":
+    return _CURRENT_VENUE.get() or VENUES[0]
+
+
+@contextmanager
+def use_venue(v: "Venue"):
+    token = _CURRENT_VENUE.set(v)
+    log_token = LOG_CTX_VENUE.set(v.name if MULTI_VENUE else None)
+    try:
+        yield v
+    finally:
+        LOG_CTX_VENUE.reset(log_token)
+        _CURRENT_VENUE.reset(token)
+
+
+def venue_task(name: str) -> str:
+    """Имя фоновой задачи текущего заведения (в /health и метриках)."""
+    return f"{current_venue().name}/{name}" if MULTI_VENUE else name
+
+
+def _load_venues() -> list[Venue]:
+    if not MULTI_VENUE:
+        return [Venue("main")]
+    venues = []
+    for name in VENUE_NAMES:
+        path = os.path.join(VENUES_DIR, f"{name}.env")
+        if not os.path.exists(path):
+            raise RuntimeError(f"VENUES: нет файла настроек заведения {path}")
+        venues.append(Venue(name, path))
+    for attr in ("BOT_TOKEN", "db_path", "database_url"):
+        values = [getattr(v, attr) for v in venues if getattr(v, attr)]
+        if len(values) != len(set(values)):
+            raise RuntimeError(f"VENUES: у заведений совпадает {attr} — у каждого должен быть свой")
+    return venues
+
+
+VENUES = _load_venues()
+VENUES_BY_NAME = {v.name: v for v in VENUES}
+venue = _VenueProxy(None)
+
+if MULTI_VENUE:
+    metrics.base_labels = lambda: {"venue": v.name} if (v := _CURRENT_VENUE.get()) else {}
+
+for _v in VENUES:
+    _p = f"[{_v.name}] " if MULTI_VENUE else ""
+    logger.info("[BOOT] %sADMIN_IDS: %s", _p, _v.ADMIN_IDS)
+    logger.info("[BOOT] %sADMIN_NOTIFY_CHAT_IDS: %s", _p, _v.ADMIN_NOTIFY_CHAT_IDS)
+    logger.info("[BOOT] %sACCESS_MODE: %s", _p, _v.ACCESS_MODE)
+    logger.info("[BOOT] %sADDRESS: %s", _p, _v.ADDRESS)
 
 
 # ===== aiogram =====
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
 from aiogram.filters import Command, CommandStart
 from aiogram.types import (
     Message, CallbackQuery,
     ReplyKeyboardMarkup, KeyboardButton,
-    BotCommand, BotCommandScopeDefault, BotCommandScopeChat
-    
+    BotCommand, BotCommandScopeDefault, BotCommandScopeChat,
+    InputMediaPhoto,
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import BotCommandScopeChatAdministrators
 
-bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+from aiogram import BaseMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import TelegramObject, Update
+
+# Одна aiohttp-сессия на все боты процесса (у каждого заведения свой Bot).
+HTTP_SESSION = AiohttpSession()
+
+
+def _make_bot(v: Venue) -> Bot:
+    return Bot(v.BOT_TOKEN, session=HTTP_SESSION, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+
+
+bot = venue_local("bot", _make_bot)
 dp = Dispatcher()
 
-# ===== DB (SQLite) =====
-DB_PATH = os.path.join(os.path.dirname(__file__), "codes.db")
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-conn.execute("PRAGMA journal_mode=WAL;")
-conn.execute("PRAGMA synchronous=NORMAL;")
-cur = conn.cursor()
-
-# === GUESTS ===
-cur.execute("""
-CREATE TABLE IF NOT EXISTS guests (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    name TEXT NOT NULL,
-    phone TEXT NOT NULL,
-    user_id INTEGER NOT NULL
-);
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS feedbacks (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  user_id INTEGER NOT NULL,
-  text TEXT,
-  photo_id TEXT,
-  created_at TEXT NOT NULL
-);
-""")
-
-# users
-cur.execute("""
-CREATE TABLE IF NOT EXISTS users (
-  user_id INTEGER PRIMARY KEY,
-  tg_first_name TEXT,
-  tg_last_name  TEXT,
-  tg_username   TEXT,
-  name          TEXT,
-  phone         TEXT,
-  guest_count   INTEGER NOT NULL DEFAULT 1,
-  source        TEXT,
-  approved      INTEGER NOT NULL DEFAULT 0,
-  blocked       INTEGER NOT NULL DEFAULT 0,
-  joined_at     TEXT NOT NULL,
-  last_seen     TEXT NOT NULL
-);
-""")
-# reservations
-cur.execute("""
-CREATE TABLE IF NOT EXISTS reservations (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  user_id INTEGER,
-  guest_name TEXT NOT NULL,
-  guest_phone TEXT NOT NULL,
-  covers INTEGER NOT NULL,
-  r_date TEXT NOT NULL,  -- YYYY-MM-DD
-  r_time TEXT NOT NULL,  -- HH:MM
-  note TEXT,
-  status TEXT NOT NULL DEFAULT 'new',
-  created_at TEXT NOT NULL,
-  updated_at TEXT NOT NULL
-);
-""")
-cur.execute("CREATE INDEX IF NOT EXISTS idx_res_date ON reservations(r_date)")
-cur.execute("CREATE INDEX IF NOT EXISTS idx_res_phone ON reservations(guest_phone)")
-
-# codes
-cur.execute("""
-CREATE TABLE IF NOT EXISTS codes (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  user_id   INTEGER NOT NULL,
-  code      TEXT    NOT NULL,
-  issued_at TEXT    NOT NULL,
-  expires_at TEXT   NOT NULL,
-  day_key   TEXT    NOT NULL,   -- YYYY-MM-DD (Ташкент)
-  valid     INTEGER NOT NULL DEFAULT 1
-);
-""")
-
-# prizes (гости с призами)
-cur.execute("""
-CREATE TABLE IF NOT EXISTS prizes (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  guest_name TEXT NOT NULL,
-  guest_phone TEXT NOT NULL,
-  prize TEXT NOT NULL,
-  user_id INTEGER,
-  created_at TEXT NOT NULL
-);
-""")
-
-# === RANDOM REWARDS ===
-cur.execute("""
-CREATE TABLE IF NOT EXISTS random_rewards (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    prize TEXT NOT NULL,
-    reward_code TEXT NOT NULL,
-    date_issued TEXT NOT NULL
-);
-""")
-cur.execute("CREATE INDEX IF NOT EXISTS idx_reward_code ON random_rewards(reward_code)")
-
-# Расширяем таблицу random_rewards, если нет нужных полей
-try:
-    cur.execute("ALTER TABLE random_rewards ADD COLUMN redeemed INTEGER DEFAULT 0")
-except sqlite3.OperationalError:
-    pass
-try:
-    cur.execute("ALTER TABLE random_rewards ADD COLUMN redeemed_by_user_id INTEGER")
-except sqlite3.OperationalError:
-    pass
-try:
-    cur.execute("ALTER TABLE random_rewards ADD COLUMN redeemed_by_username TEXT")
-except sqlite3.OperationalError:
-    pass
-try:
-    cur.execute("ALTER TABLE random_rewards ADD COLUMN redeemed_by_fullname TEXT")
-except sqlite3.OperationalError:
-    pass
-try:
-    cur.execute("ALTER TABLE random_rewards ADD COLUMN redeemed_at TEXT")
-except sqlite3.OperationalError:
-    pass
-    
-conn.commit()
-# --- Создание доп. колонок (безопасно, игнорируем ошибки) ---
-try:
-    cur.execute("ALTER TABLE random_rewards ADD COLUMN expiry_date TEXT")
-except sqlite3.OperationalError:
-    pass
-try:
-    cur.execute("ALTER TABLE random_rewards ADD COLUMN notified_24h INTEGER DEFAULT 0")
-except sqlite3.OperationalError:
-    pass
-try:
-    cur.execute("ALTER TABLE random_rewards ADD COLUMN expired INTEGER DEFAULT 0")
-except sqlite3.OperationalError:
-    pass
-conn.commit()
-
-conn.commit()
-cur.execute("CREATE INDEX IF NOT EXISTS idx_codes_user_day ON codes(user_id, day_key)")
-conn.commit()
-# --- Создание доп. колонок (безопасно, игнорируем ошибки) ---
-try:
-    cur.execute("ALTER TABLE random_rewards ADD COLUMN expiry_date TEXT")
-except sqlite3.OperationalError:
-    pass
-try:
-    cur.execute("ALTER TABLE random_rewards ADD COLUMN notified_24h INTEGER DEFAULT 0")
-except sqlite3.OperationalError:
-    pass
-try:
-    cur.execute("ALTER TABLE random_rewards ADD COLUMN expired INTEGER DEFAULT 0")
-except sqlite3.OperationalError:
-    pass
-# 🔧 добавляем недостающие поля победителя (если их ещё нет)
-try:
-    cur.execute("ALTER TABLE random_rewards ADD COLUMN winner_username TEXT")
-except sqlite3.OperationalError:
-    pass
-try:
-    cur.execute("ALTER TABLE random_rewards ADD COLUMN winner_fullname TEXT")
-except sqlite3.OperationalError:
-    pass
-conn.commit()
+
+class VenueMiddleware(BaseMiddleware):
+    """Самый внешний middleware: по боту апдейта выбирает заведение для всего, что ниже."""
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        token = data["bot"].token
+        v = next((v for v in VENUES if v.BOT_TOKEN == token), VENUES[0])
+        with use_venue(v):
+            return await handler(event, data)
+
+
+dp.update.outer_middleware(VenueMiddleware())
+
+
+class LogContextMiddleware(BaseMiddleware):
+    """Кладёт update_id / user_id (outer, на dp.update) и имя хендлера (inner) в контекст логов."""
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        tokens = []
+        if isinstance(event, Update):
+            tokens.append((LOG_CTX_UPDATE_ID, LOG_CTX_UPDATE_ID.set(event.update_id)))
+            user = data.get("event_from_user")
+            if user:
+                tokens.append((LOG_CTX_USER_ID, LOG_CTX_USER_ID.set(user.id)))
+        else:
+            handler_obj = data.get("handler")
+            if handler_obj is not None:
+                name = getattr(handler_obj.callback, "__name__", None)
+                tokens.append((LOG_CTX_HANDLER, LOG_CTX_HANDLER.set(name)))
+        try:
+            return await handler(event, data)
+        finally:
+            for var, token in reversed(tokens):
+                var.reset(token)
+
+
+dp.update.outer_middleware(LogContextMiddleware())
+dp.message.middleware(LogContextMiddleware())
+dp.callback_query.middleware(LogContextMiddleware())
+
+# ===== Storage =====
+# Весь SQL ходит через storage: SqliteStorage (по умолчанию, codes.db рядом со скриптом)
+# или PostgresStorage (DB_BACKEND=postgres, DATABASE_URL=postgresql://...).
+# Запросы пишутся один раз в переносимом виде с плейсхолдерами "?";
+# диалектные отличия (DDL, RETURNING, агрегаты строк) — внутри бэкендов.
+# Перенос данных SQLite -> Postgres: python bot.py --migrate-to-pg
+import re
+import functools
+from pathlib import Path
+
+DB_BACKEND = (os.getenv("DB_BACKEND", "sqlite") or "sqlite").lower()   # sqlite | postgres
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "2"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+PG_STATEMENT_CACHE = int(os.getenv("PG_STATEMENT_CACHE", "256"))
+# SQLite: PRAGMA при подключении (cache_size < 0 — в КиБ, как в самом SQLite)
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-20000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# read-only соединения для отчётов и списков (@read_only); 0 — всё через основное соединение
+SQLITE_READ_POOL = int(os.getenv("SQLITE_READ_POOL", "2"))
+# Ночное обслуживание БД (после отчёта в 01:00); 0 — выключено
+DB_MAINTENANCE = os.getenv("DB_MAINTENANCE", "1") == "1"
+# Архив: старые строки переезжают в отдельную БД (SQLite: ATTACH ... AS archive, Postgres: схема archive);
+# путь — ARCHIVE_DB_PATH, см. Venue
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "500"))
+RETENTION_CODES_DAYS = int(os.getenv("RETENTION_CODES_DAYS", "14"))            # 0 — не архивировать
+RETENTION_RESERVATIONS_DAYS = int(os.getenv("RETENTION_RESERVATIONS_DAYS", "90"))
+RETENTION_REWARDS_DAYS = int(os.getenv("RETENTION_REWARDS_DAYS", "90"))        # только погашенные/истёкшие
+
+# Схема в «общем» диалекте. INTEGER PRIMARY KEY AUTOINCREMENT и INTEGER
+# в Postgres превращаются в BIGSERIAL PRIMARY KEY / BIGINT (Telegram id не влезают в int4).
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    """
+    CREATE TABLE IF NOT EXISTS settings (
+      key TEXT PRIMARY KEY,
+      value TEXT NOT NULL,
+      updated_at TEXT NOT NULL,
+      updated_by INTEGER
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS guests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        phone TEXT NOT NULL,
+        user_id INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS feedbacks (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      user_id INTEGER NOT NULL,
+      text TEXT,
+      photo_id TEXT,
+      created_at TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS users (
+      user_id INTEGER PRIMARY KEY,
+      tg_first_name TEXT,
+      tg_last_name  TEXT,
+      tg_username   TEXT,
+      name          TEXT,
+      phone         TEXT,
+      guest_count   INTEGER NOT NULL DEFAULT 1,
+      source        TEXT,
+      approved      INTEGER NOT NULL DEFAULT 0,
+      blocked       INTEGER NOT NULL DEFAULT 0,
+      joined_at     TEXT NOT NULL,
+      last_seen     TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS reservations (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      user_id INTEGER,
+      guest_name TEXT NOT NULL,
+      guest_phone TEXT NOT NULL,
+      covers INTEGER NOT NULL,
+      r_date TEXT NOT NULL,  -- YYYY-MM-DD
+      r_time TEXT NOT NULL,  -- HH:MM
+      note TEXT,
+      status TEXT NOT NULL DEFAULT 'new',
+      created_at TEXT NOT NULL,
+      updated_at TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_res_date ON reservations(r_date)",
+    "CREATE INDEX IF NOT EXISTS idx_res_phone ON reservations(guest_phone)",
+    """
+    CREATE TABLE IF NOT EXISTS codes (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      user_id   INTEGER NOT NULL,
+      code      TEXT    NOT NULL,
+      issued_at TEXT    NOT NULL,
+      expires_at TEXT   NOT NULL,
+      day_key   TEXT    NOT NULL,   -- YYYY-MM-DD (Ташкент)
+      valid     INTEGER NOT NULL DEFAULT 1
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_codes_user_day ON codes(user_id, day_key)",
+    # prizes (гости с призами)
+    """
+    CREATE TABLE IF NOT EXISTS prizes (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      guest_name TEXT NOT NULL,
+      guest_phone TEXT NOT NULL,
+      prize TEXT NOT NULL,
+      user_id INTEGER,
+      created_at TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS random_rewards (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        prize TEXT NOT NULL,
+        reward_code TEXT NOT NULL,
+        date_issued TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_reward_code ON random_rewards(reward_code)",
+    # журнал обработанных апдейтов (см. Update ledger) — защищает от повторной доставки
+    """
+    CREATE TABLE IF NOT EXISTS processed_updates (
+      update_id INTEGER PRIMARY KEY,
+      user_id INTEGER,
+      processed_at TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_processed_updates_at ON processed_updates(processed_at)",
+    # ключи однократных операций пользователя: "<user_id>:<операция>"
+    """
+    CREATE TABLE IF NOT EXISTS op_keys (
+      op_key TEXT PRIMARY KEY,
+      user_id INTEGER,
+      result TEXT,
+      created_at TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_op_keys_at ON op_keys(created_at)",
+    # аналитика (см. Analytics): компактные агрегаты вместо сканов
+    """
+    CREATE TABLE IF NOT EXISTS user_activity (
+      user_id INTEGER NOT NULL,
+      day TEXT NOT NULL,
+      PRIMARY KEY (user_id, day)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_user_activity_day ON user_activity(day)",
+    """
+    CREATE TABLE IF NOT EXISTS user_funnel (
+      user_id INTEGER PRIMARY KEY,
+      cohort_day TEXT NOT NULL,
+      start_at TEXT,
+      contact_at TEXT,
+      code_at TEXT,
+      reservation_at TEXT,
+      redeem_at TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_daily (
+      day TEXT NOT NULL,
+      metric TEXT NOT NULL,
+      value INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (day, metric)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS cohort_weekly (
+      cohort_week TEXT NOT NULL,
+      week TEXT NOT NULL,
+      users INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (cohort_week, week)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tg_files (
+      key TEXT PRIMARY KEY,
+      file_id TEXT NOT NULL,
+      source TEXT,
+      created_at TEXT NOT NULL
+    )
+    """,
+]
+
+# Колонки, добавленные позже (ALTER TABLE ... ADD COLUMN, если ещё нет)
+SCHEMA_COLUMNS = [
+    ("feedbacks", "media_group_id TEXT"),
+    ("codes", "used_at TEXT"),       # погашен на входе (/check)
+    ("codes", "used_by INTEGER"),
+    # телефон только цифрами (normalize_phone) — для сопоставления гостей и призов по индексу
+    ("guests", "phone_norm TEXT"),
+    ("prizes", "phone_norm TEXT"),
+    ("prizes", "import_batch TEXT"),
+    # статус доставки приза: NULL — ещё не доставлен (разошлёт регистрация гостя или еженедельная рассылка)
+    ("prizes", "delivered_at TEXT"),
+    ("prizes", "delivery_attempts INTEGER DEFAULT 0"),
+    ("prizes", "last_error TEXT"),
+    ("random_rewards", "redeemed INTEGER DEFAULT 0"),
+    ("random_rewards", "redeemed_by_user_id INTEGER"),
+    ("random_rewards", "redeemed_by_username TEXT"),
+    ("random_rewards", "redeemed_by_fullname TEXT"),
+    ("random_rewards", "redeemed_at TEXT"),
+    ("random_rewards", "expiry_date TEXT"),
+    ("random_rewards", "notified_24h INTEGER DEFAULT 0"),
+    ("random_rewards", "expired INTEGER DEFAULT 0"),
+    # 🔧 поля победителя
+    ("random_rewards", "winner_username TEXT"),
+    ("random_rewards", "winner_fullname TEXT"),
+]
+
+SCHEMA_POST = [
+    "CREATE INDEX IF NOT EXISTS idx_feedbacks_group ON feedbacks(media_group_id)",
+    "CREATE INDEX IF NOT EXISTS idx_codes_day ON codes(day_key)",
+    "CREATE INDEX IF NOT EXISTS idx_codes_day_code ON codes(day_key, code)",
+    "CREATE INDEX IF NOT EXISTS idx_guests_phone_norm ON guests(phone_norm)",
+    "CREATE INDEX IF NOT EXISTS idx_prizes_phone_norm ON prizes(phone_norm)",
+    "CREATE INDEX IF NOT EXISTS idx_prizes_batch ON prizes(import_batch)",
+    # только недоставленные: поиск при регистрации гостя и выборка еженедельной рассылки
+    "CREATE INDEX IF NOT EXISTS idx_prizes_pending ON prizes(phone_norm) WHERE delivered_at IS NULL",
+    # счётчики по дням для строк, уже уехавших в архив (метрика: codes / res_date / res_created / rewards)
+    """
+    CREATE TABLE IF NOT EXISTS daily_rollups (
+      day_key TEXT NOT NULL,
+      metric  TEXT NOT NULL,
+      value   INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (day_key, metric)
+    )
+    """,
+]
+
+# таблицы, которые переносит --migrate-to-pg (в порядке копирования)
+STORAGE_TABLES = ["users", "guests", "codes", "reservations", "prizes", "random_rewards", "feedbacks", "daily_rollups", "settings",
+                  "user_activity", "user_funnel", "analytics_daily", "cohort_weekly", "tg_files"]
+# таблицы с копией схемы в архиве
+ARCHIVE_TABLES = ["codes", "reservations", "random_rewards"]
+
+# Отметка «апдейт обработан» текущего хендлера (см. Update ledger). Дописывается
+# перед COMMIT внешней транзакции — вместе с изменениями, которые сделал хендлер.
+_LEDGER_ENTRY: contextvars.ContextVar = contextvars.ContextVar("ledger_entry", default=None)
+LEDGER_INSERT = """
+    INSERT INTO processed_updates (update_id, user_id, processed_at) VALUES (?, ?, ?)
+    ON CONFLICT (update_id) DO NOTHING
+"""
+
+
+# True внутри @read_only: SELECT'ы вне транзакции SQLite отдаёт пулу read-only соединений
+_READ_ONLY: contextvars.ContextVar[bool] = contextvars.ContextVar("read_only", default=False)
+
+
+def read_only(fn):
+    """Отчёт/список, который только читает: его fetch* идут на SqliteReadPool (в потоке, mode=ro),
+    не занимая основное соединение и event loop. Записи внутри — как обычно; на Postgres ничего не меняет."""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        token = _READ_ONLY.set(True)
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            _READ_ONLY.reset(token)
+    return wrapper
+
+
+class Storage:
+    """Интерфейс хранилища: примитивы выполнения SQL + миграции схемы.
+
+    Репозиторные функции ниже (create_reservation, get_all_prizes, ...) пишут
+    SQL один раз с плейсхолдерами "?" и вызывают только эти методы."""
+    dialect = ""
+
+    async def connect(self) -> None: ...
+    async def close(self) -> None: ...
+    async def execute(self, sql: str, params: tuple = ()) -> int: ...
+    async def executemany(self, sql: str, seq: list[tuple]) -> None: ...
+    async def fetchone(self, sql: str, params: tuple = ()): ...
+    async def fetchall(self, sql: str, params: tuple = ()) -> list: ...
+    async def insert(self, sql: str, params: tuple = ()) -> int:
+        """INSERT в таблицу с id; возвращает id новой строки."""
+    async def add_column(self, table: str, column_ddl: str) -> None: ...
+    async def columns(self, table: str) -> list[str]: ...
+    async def prepare_archive(self) -> None: ...
+    async def backup_to(self, dest: str, pages: int, sleep: float, name: str = "main") -> None:
+        raise NotImplementedError("онлайн-бэкап есть только для SQLite; для Postgres — pg_dump")
+    def transaction(self):
+        """async-контекст: все вызовы storage внутри — одна транзакция.
+        Внутри не должно быть сетевых await'ов (send_message и т.п.)."""
+    def string_agg(self, expr: str, sep: str) -> str: ...
+
+    async def fetchval(self, sql: str, params: tuple = (), default=None):
+        row = await self.fetchone(sql, params)
+        return row[0] if row and row[0] is not None else default
+
+    def ddl(self, stmt: str) -> str:
+        return stmt
+
+    async def maintenance(self) -> dict:
+        """Плановое обслуживание; возвращает статистику для отчёта админам."""
+        counts = {}
+        for table in STORAGE_TABLES:
+            counts[table] = await self.fetchval(f"SELECT COUNT(*) FROM {table}", default=0)
+        return {"tables": counts}
+
+    async def get_meta(self, key: str) -> Optional[str]:
+        return await self.fetchval("SELECT value FROM meta WHERE key=?", (key,))
+
+    async def _flush_ledger(self) -> None:
+        entry = _LEDGER_ENTRY.get()
+        if entry is None or entry.recorded:
+            return
+        await self.execute(LEDGER_INSERT, (entry.update_id, entry.user_id, now_tz().isoformat()))
+        entry.recorded = True
+
+    async def set_meta(self, key: str, value: str) -> None:
+        await self.execute("""
+            INSERT INTO meta (key, value) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET value=excluded.value
+        """, (key, value))
+
+    @staticmethod
+    def schema_fingerprint() -> str:
+        return hashlib.sha1(repr((SCHEMA, SCHEMA_COLUMNS, SCHEMA_POST, ARCHIVE_TABLES)).encode()).hexdigest()[:16]
+
+    async def migrate(self) -> None:
+        # схема не менялась с прошлого запуска — DDL не гоняем (перезапуск быстрее)
+        await self.execute(self.ddl(SCHEMA[0]))
+        fingerprint = self.schema_fingerprint()
+        if await self.get_meta("schema_fingerprint") == fingerprint:
+            return
+        for stmt in SCHEMA:
+            await self.execute(self.ddl(stmt))
+        for table, column_ddl in SCHEMA_COLUMNS:
+            await self.add_column(table, self.ddl(column_ddl))
+        for stmt in SCHEMA_POST:
+            await self.execute(self.ddl(stmt))
+        # архивные копии таблиц — та же схема с префиксом archive.
+        await self.prepare_archive()
+        for stmt in SCHEMA:
+            m = re.search(r"CREATE TABLE IF NOT EXISTS (\w+)", stmt)
+            if m and m.group(1) in ARCHIVE_TABLES:
+                await self.execute(self.ddl(stmt.replace(m.group(0), f"CREATE TABLE IF NOT EXISTS archive.{m.group(1)}", 1)))
+        for table, column_ddl in SCHEMA_COLUMNS:
+            if table in ARCHIVE_TABLES:
+                await self.add_column(f"archive.{table}", self.ddl(column_ddl))
+        await self.set_meta("schema_fingerprint", fingerprint)
+        logger.info("[DB] схема обновлена (%s)", fingerprint)
+
+
+class _Transaction:
+    def __init__(self, begin, commit, rollback, before_commit=None):
+        self._begin, self._commit, self._rollback = begin, commit, rollback
+        self._before_commit = before_commit
+
+    async def __aenter__(self):
+        await self._begin()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            try:
+                if self._before_commit:
+                    await self._before_commit()
+            except BaseException:
+                await self._rollback()
+                raise
+            await self._commit()
+        else:
+            await self._rollback()
+        return False
+
+
+def _sqlite_ro_uri(path: str) -> str:
+    return Path(path).absolute().as_uri() + "?mode=ro"
+
+
+class SqliteReadPool:
+    """До size соединений mode=ro + query_only. Запрос идёт в потоке: в WAL читатель видит
+    последний коммит и не блокирует запись основного соединения (выдача/погашение кодов)."""
+
+    def __init__(self, path: str, archive_path: str, size: int):
+        self.path, self.archive_path = path, archive_path
+        self._idle: list[sqlite3.Connection] = []
+        self._sem = asyncio.Semaphore(size)
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(_sqlite_ro_uri(self.path), uri=True, check_same_thread=False,
+                               isolation_level=None, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+        conn.execute("PRAGMA query_only=1;")
+        conn.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE};")
+        conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE};")
+        conn.execute("ATTACH DATABASE ? AS archive", (_sqlite_ro_uri(self.archive_path),))
+        return conn
+
+    async def run(self, fn):
+        await self._sem.acquire()
+        try:
+            conn = self._idle.pop() if self._idle else self._open()
+        except BaseException:
+            self._sem.release()
+            raise
+        fut = asyncio.ensure_future(asyncio.to_thread(fn, conn))
+
+        def release(f):
+            # соединение возвращаем, только когда поток с ним закончил (даже если ждавший отменён)
+            if not f.cancelled():
+                f.exception()
+            self._idle.append(conn)
+            self._sem.release()
+
+        fut.add_done_callback(release)
+        metrics.inc("db_ro_queries_total")
+        return await asyncio.shield(fut)
+
+    def close(self) -> None:
+        while self._idle:
+            self._idle.pop().close()
+
+
+class SqliteStorage(Storage):
+    """Локальный файл SQLite (WAL). Все вызовы синхронные, но быстрые;
+    соединение одно на процесс — транзакции вкладываются по счётчику.
+    Чтения из @read_only-функций вне транзакции идут на readers (SqliteReadPool)."""
+    dialect = "sqlite"
+
+    def __init__(self, path: str, archive_path: str):
+        self.path = path
+        self.archive_path = archive_path
+        self.conn: Optional[sqlite3.Connection] = None
+        self.readers: Optional[SqliteReadPool] = None
+        self._tx_depth = 0
+
+    async def connect(self) -> None:
+        if self.conn is not None:
+            return
+        # isolation_level=None — автокоммит; явные транзакции через transaction()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        # auto_vacuum действует только на пустом файле; для старой базы включается в maintenance()
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self.conn.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE};")
+        self.conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE};")
+        self.conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS};")
+        self.conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        self.conn.execute("PRAGMA archive.journal_mode=WAL;")
+        if SQLITE_READ_POOL > 0:  # файлы уже созданы основным соединением — mode=ro их откроет
+            self.readers = SqliteReadPool(self.path, self.archive_path, SQLITE_READ_POOL)
+
+    async def close(self) -> None:
+        if self.readers is not None:
+            self.readers.close()
+            self.readers = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _read_only(self) -> bool:
+        # внутри транзакции читаем своим соединением — иначе не увидим свои же незакоммиченные записи
+        return self.readers is not None and self._tx_depth == 0 and _READ_ONLY.get()
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        return self.conn.execute(sql, params).rowcount
+
+    async def executemany(self, sql: str, seq: list[tuple]) -> None:
+        self.conn.executemany(sql, seq)
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        if self._read_only():
+            return await self.readers.run(lambda conn: conn.execute(sql, params).fetchone())
+        return self.conn.execute(sql, params).fetchone()
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list:
+        if self._read_only():
+            return await self.readers.run(lambda conn: conn.execute(sql, params).fetchall())
+        return self.conn.execute(sql, params).fetchall()
+
+    async def insert(self, sql: str, params: tuple = ()) -> int:
+        return self.conn.execute(sql, params).lastrowid
+
+    async def add_column(self, table: str, column_ddl: str) -> None:
+        try:
+            self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column_ddl}")
+        except sqlite3.OperationalError:
+            pass
+
+    async def columns(self, table: str) -> list[str]:
+        return [c[0] for c in self.conn.execute(f"SELECT * FROM {table} LIMIT 0").description]
+
+    async def prepare_archive(self) -> None:
+        pass  # база архива подключена в connect()
+
+    async def backup_to(self, dest: str, pages: int, sleep: float, name: str = "main") -> None:
+        """Online backup API: по `pages` страниц за шаг с паузой `sleep` между шагами.
+        Шаги идут в отдельном потоке через то же соединение — записи бота попадают
+        в копию без перезапуска бэкапа, а event loop между шагами свободен.
+        name="archive" — копия подключённой базы архива."""
+        def run():
+            dst = sqlite3.connect(dest)
+            try:
+                self.conn.backup(dst, pages=pages, sleep=sleep, name=name)
+                dst.execute("PRAGMA journal_mode=DELETE")  # копия — один самодостаточный файл, без -wal
+            finally:
+                dst.close()
+        await asyncio.to_thread(run)
+
+    def string_agg(self, expr: str, sep: str) -> str:
+        return f"GROUP_CONCAT({expr}, '{sep}')"
+
+    async def maintenance(self) -> dict:
+        # checkpoint/VACUUM могут занять секунды — в отдельном потоке и на своём соединении,
+        # чтобы не держать event loop и не мешать транзакциям основного соединения
+        return await asyncio.to_thread(_sqlite_maintenance, self.path)
+
+    def transaction(self):
+        async def begin():
+            if self._tx_depth == 0:
+                self.conn.execute("BEGIN IMMEDIATE")
+            self._tx_depth += 1
+
+        async def commit():
+            self._tx_depth -= 1
+            if self._tx_depth == 0:
+                self.conn.execute("COMMIT")
+
+        async def rollback():
+            self._tx_depth -= 1
+            if self._tx_depth == 0:
+                self.conn.execute("ROLLBACK")
+
+        async def before_commit():
+            if self._tx_depth == 1:
+                await self._flush_ledger()
+
+        return _Transaction(begin, commit, rollback, before_commit)
+
+
+def _wal_size(path: str) -> int:
+    try:
+        return os.path.getsize(path + "-wal")
+    except OSError:
+        return 0
+
+def _sqlite_maintenance(path: str) -> dict:
+    """wal_checkpoint(TRUNCATE) + optimize/ANALYZE + incremental_vacuum. Выполняется в потоке."""
+    started = time.monotonic()
+    conn = sqlite3.connect(path, isolation_level=None, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+    try:
+        stats = {"wal_before": _wal_size(path)}
+        pragma = lambda name: conn.execute(f"PRAGMA {name}").fetchone()[0]
+        stats["freelist_before"] = pragma("freelist_count")
+        if pragma("auto_vacuum") != 2:
+            # старая база без auto_vacuum: переключаем один раз, это требует полного VACUUM
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+            stats["full_vacuum"] = True
+        else:
+            conn.execute("PRAGMA incremental_vacuum")
+        conn.execute("PRAGMA analysis_limit=1000")
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA optimize")
+        busy, wal_pages, moved = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        stats.update(
+            checkpoint_busy=bool(busy),
+            wal_after=_wal_size(path),
+            page_size=pragma("page_size"),
+            page_count=pragma("page_count"),
+            freelist=pragma("freelist_count"),
+            tables={t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in STORAGE_TABLES},
+        )
+        stats["seconds"] = round(time.monotonic() - started, 2)
+        return stats
+    finally:
+        conn.close()
+
+
+_PG_TX_CONN: contextvars.ContextVar = contextvars.ContextVar("pg_tx_conn", default=None)
+
+
+class PostgresStorage(Storage):
+    """PostgreSQL через asyncpg: пул соединений, prepared statements
+    (кэш asyncpg на соединение, statement_cache_size=PG_STATEMENT_CACHE)."""
+    dialect = "postgres"
+
+    def __init__(self, dsn: str, min_size: int, max_size: int, statement_cache: int):
+        self.dsn = dsn
+        self.min_size, self.max_size = min_size, max_size
+        self.statement_cache = statement_cache
+        self.pool = None
+
+    async def connect(self) -> None:
+        if self.pool is not None:
+            return
+        try:
+            import asyncpg
+        except ImportError as e:
+            raise RuntimeError("DB_BACKEND=postgres требует пакет asyncpg (pip install asyncpg)") from e
+        if not self.dsn:
+            raise RuntimeError("DB_BACKEND=postgres: DATABASE_URL is empty. Set it in .env")
+        self.pool = await asyncpg.create_pool(
+            self.dsn, min_size=self.min_size, max_size=self.max_size,
+            statement_cache_size=self.statement_cache,
+        )
+
+    async def close(self) -> None:
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    @staticmethod
+    def _sql(sql: str) -> str:
+        return _pg_placeholders(sql)
+
+    def _conn(self):
+        return _PG_TX_CONN.get() or self.pool
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        status = await self._conn().execute(self._sql(sql), *params)
+        tail = status.rsplit(" ", 1)[-1] if status else ""
+        return int(tail) if tail.isdigit() else 0
+
+    async def executemany(self, sql: str, seq: list[tuple]) -> None:
+        await self._conn().executemany(self._sql(sql), seq)
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        return await self._conn().fetchrow(self._sql(sql), *params)
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list:
+        return await self._conn().fetch(self._sql(sql), *params)
+
+    async def insert(self, sql: str, params: tuple = ()) -> int:
+        return await self._conn().fetchval(self._sql(sql.rstrip().rstrip(";") + " RETURNING id"), *params)
+
+    async def add_column(self, table: str, column_ddl: str) -> None:
+        await self.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column_ddl}")
+
+    async def columns(self, table: str) -> list[str]:
+        async with self.pool.acquire() as conn:
+            stmt = await conn.prepare(f"SELECT * FROM {table} LIMIT 0")
+            return [a.name for a in stmt.get_attributes()]
+
+    async def prepare_archive(self) -> None:
+        await self.execute("CREATE SCHEMA IF NOT EXISTS archive")
+
+    def string_agg(self, expr: str, sep: str) -> str:
+        return f"string_agg({expr}, '{sep}')"
+
+    async def maintenance(self) -> dict:
+        # VACUUM/чекпойнты в Postgres делает autovacuum; обновим статистику планировщика
+        await self.execute("ANALYZE")
+        return await super().maintenance()
+
+    def ddl(self, stmt: str) -> str:
+        stmt = stmt.replace("INTEGER PRIMARY KEY AUTOINCREMENT", "BIGSERIAL PRIMARY KEY")
+        return re.sub(r"\bINTEGER\b", "BIGINT", stmt)
+
+    def transaction(self):
+        state = {}
+
+        async def begin():
+            if _PG_TX_CONN.get() is not None:
+                return  # вложенная — работает в уже открытой
+            conn = await self.pool.acquire()
+            tx = conn.transaction()
+            await tx.start()
+            state.update(conn=conn, tx=tx, token=_PG_TX_CONN.set(conn))
+
+        async def finish(ok: bool):
+            if not state:
+                return
+            try:
+                await (state["tx"].commit() if ok else state["tx"].rollback())
+            finally:
+                _PG_TX_CONN.reset(state["token"])
+                await self.pool.release(state["conn"])
+
+        async def before_commit():
+            if state:  # только внешняя транзакция
+                await self._flush_ledger()
+
+        return _Transaction(begin, lambda: finish(True), lambda: finish(False), before_commit)
+
+
+@functools.lru_cache(maxsize=1024)  # ограничен: запросы с IN (?, …) разной длины дают новые ключи
+def _pg_placeholders(sql: str) -> str:
+    """"?" -> "$1, $2, ..." (результат кэшируется по тексту запроса)."""
+    counter = iter(range(1, 10_000))
+    return re.sub(r"\?", lambda _: f"${next(counter)}", sql)
+
+
+def make_storage(v: Venue) -> Storage:
+    if DB_BACKEND in ("postgres", "postgresql", "pg"):
+        return PostgresStorage(v.database_url, PG_POOL_MIN, PG_POOL_MAX, PG_STATEMENT_CACHE)
+    return SqliteStorage(v.db_path, v.archive_db_path)
+
+
+storage = venue_local("storage", make_storage)
+
+
+async def migrate_sqlite_to_pg(batch: int = 1000):
+    """Копирует все таблицы из codes.db в Postgres (DATABASE_URL).
+
+    Повторный запуск безопасен: строки с существующим ключом пропускаются.
+    Запуск: python bot.py --migrate-to-pg"""
+    src = SqliteStorage(venue.db_path, venue.archive_db_path)
+    dst = PostgresStorage(venue.database_url, 1, 2, PG_STATEMENT_CACHE)
+    await src.connect()
+    await src.migrate()
+    await dst.connect()
+    await dst.migrate()
+    try:
+        for table in STORAGE_TABLES:
+            cursor = src.conn.execute(f"SELECT * FROM {table}")
+            cols = [c[0] for c in cursor.description]
+            marks = ", ".join("?" for _ in cols)
+            sql = f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({marks}) ON CONFLICT DO NOTHING"
+            copied = 0
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    break
+                async with dst.transaction():
+                    await dst.executemany(sql, [tuple(r) for r in rows])
+                copied += len(rows)
+            if "id" in cols:
+                await dst.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                    f"GREATEST((SELECT MAX(id) FROM {table}), 1))"
+                )
+            logger.info("[MIGRATE] %s: %d строк", table, copied)
+    finally:
+        await src.close()
+        await dst.close()
+
+
+async def storage_selftest() -> bool:
+    """Одни и те же проверки примитивов Storage на SQLite (временный файл) и Postgres.
+
+    Postgres — только если задан SELFTEST_DATABASE_URL (отдельная пустая база: прогоняется migrate()).
+    Запуск: python bot.py --storage-selftest"""
+    import tempfile
+    ok = True
+
+    def check(cond: bool, what: str):
+        nonlocal ok
+        ok = ok and cond
+        logger.info("[SELFTEST] %s %s", "OK  " if cond else "FAIL", what)
+
+    check(_pg_placeholders("a = ? AND b IN (?, ?)") == "a = $1 AND b IN ($2, $3)", "pg: ? → $n")
+    check(_pg_placeholders.cache_info().maxsize is not None, "pg: кэш плейсхолдеров ограничен")
+
+    async def run(name: str, st: Storage):
+        try:
+            await st.connect()
+            await st.migrate()
+            await st.migrate()  # повторно — без ошибок
+            check(True, f"{name}: migrate() дважды")
+            await st.execute("DROP TABLE IF EXISTS selftest_kv")
+            await st.execute(st.ddl(
+                "CREATE TABLE selftest_kv (id INTEGER PRIMARY KEY AUTOINCREMENT, k TEXT NOT NULL, n INTEGER)"))
+            first = await st.insert("INSERT INTO selftest_kv (k, n) VALUES (?, ?)", ("a", 1))
+            second = await st.insert("INSERT INTO selftest_kv (k, n) VALUES (?, ?)", ("b", 2))
+            check(second == first + 1, f"{name}: insert() возвращает id")
+            await st.executemany("INSERT INTO selftest_kv (k, n) VALUES (?, ?)", [(f"k{i}", i) for i in range(10, 110)])
+            check(await st.fetchval("SELECT COUNT(*) FROM selftest_kv") == 102, f"{name}: executemany")
+            wanted = list(range(10, 60))
+            rows = await st.fetchall(
+                f"SELECT k FROM selftest_kv WHERE n IN ({', '.join('?' for _ in wanted)}) AND k <> ? ORDER BY n",
+                (*wanted, "k10"))
+            check([r[0] for r in rows] == [f"k{i}" for i in wanted[1:]], f"{name}: {len(wanted) + 1} параметров по порядку")
+            check(await st.execute("UPDATE selftest_kv SET n = n + 1 WHERE n >= ?", (100,)) == 10,
+                  f"{name}: execute() возвращает число строк")
+            check(await st.fetchone("SELECT k FROM selftest_kv WHERE k = ?", ("нет",)) is None
+                  and await st.fetchval("SELECT n FROM selftest_kv WHERE k = ?", ("нет",), default=-1) == -1,
+                  f"{name}: пустой результат")
+
+            async with st.transaction():
+                await st.execute("INSERT INTO selftest_kv (k, n) VALUES (?, ?)", ("tx", 1))
+            check(await st.fetchval("SELECT COUNT(*) FROM selftest_kv WHERE k = 'tx'") == 1, f"{name}: commit")
+            try:
+                async with st.transaction():
+                    await st.execute("INSERT INTO selftest_kv (k, n) VALUES (?, ?)", ("rb", 1))
+                    async with st.transaction():  # вложенная — часть внешней
+                        await st.execute("INSERT INTO selftest_kv (k, n) VALUES (?, ?)", ("rb", 2))
+                    raise RuntimeError("selftest")
+            except RuntimeError:
+                pass
+            check(await st.fetchval("SELECT COUNT(*) FROM selftest_kv WHERE k = 'rb'") == 0,
+                  f"{name}: rollback вместе с вложенной")
+
+            await st.set_meta("selftest", "1")
+            await st.set_meta("selftest", "2")
+            check(await st.get_meta("selftest") == "2", f"{name}: upsert (ON CONFLICT)")
+            total = await read_only(st.fetchval)("SELECT COUNT(*) FROM selftest_kv")
+            check(total == 103, f"{name}: чтение через @read_only")
+            await st.execute("DROP TABLE selftest_kv")
+            await st.execute("DELETE FROM meta WHERE key = 'selftest'")
+        except Exception as e:
+            check(False, f"{name}: {type(e).__name__}: {e}")
+        finally:
+            await st.close()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        await run("sqlite", SqliteStorage(os.path.join(tmp, "t.db"), os.path.join(tmp, "t_archive.db")))
+    pg_dsn = os.getenv("SELFTEST_DATABASE_URL", "")
+    if pg_dsn:
+        await run("postgres", PostgresStorage(pg_dsn, 1, 2, PG_STATEMENT_CACHE))
+    else:
+        logger.info("[SELFTEST] SKIP postgres: SELFTEST_DATABASE_URL не задан")
+    return ok
+
 
 # ===== Helpers =====
+def normalize_phone(phone: Optional[str]) -> str:
+    """Только цифры, с кодом страны: "+998 90 123-45-67" / "901234567" -> "998901234567"."""
+    digits = "".join(ch for ch in (phone or "") if ch.isdigit())
+    if len(digits) == 9:  # местный номер без кода Узбекистана
+        digits = "998" + digits
+    return digits
+
+async def backfill_phone_norm():
+    """Заполняет phone_norm у старых строк guests/prizes (один раз после миграции)."""
+    for table, col in (("guests", "phone"), ("prizes", "guest_phone")):
+        rows = await storage.fetchall(f"SELECT id, {col} FROM {table} WHERE phone_norm IS NULL")
+        if rows:
+            async with storage.transaction():
+                await storage.executemany(f"UPDATE {table} SET phone_norm = ? WHERE id = ?",
+                                          [(normalize_phone(phone), rid) for rid, phone in rows])
+            logger.info("[DB] phone_norm заполнен: %s, %d строк", table, len(rows))
+
+async def backfill_expiry_tz():
+    """expiry_date раньше писался в UTC, остальные даты — по Ташкенту; приводим к одному смещению,
+    иначе текстовое сравнение в правилах архива ошибается на 5 часов."""
+    rows = await storage.fetchall("SELECT id, expiry_date FROM random_rewards WHERE expiry_date LIKE '%+00:00'")
+    if rows:
+        async with storage.transaction():
+            await storage.executemany("UPDATE random_rewards SET expiry_date = ? WHERE id = ?",
+                                      [(datetime.fromisoformat(v).astimezone(TZ).isoformat(), rid) for rid, v in rows])
+        logger.info("[DB] expiry_date переведён в %s: %d строк", TZ.key, len(rows))
+
 def now_tz() -> datetime:
     return datetime.now(TZ)
 
@@ -327,144 +1520,1490 @@ def ymd(dt: datetime | date) -> str:
         return dt.strftime("%Y-%m-%d")
     return dt.strftime("%Y-%m-%d")
 
-def upsert_user_from_tg(msg: Message, source: Optional[str] = None):
+async def upsert_user_from_tg(msg: Message, source: Optional[str] = None):
     uid = msg.from_user.id
     fn  = (msg.from_user.first_name or "").strip()
     ln  = (msg.from_user.last_name  or "").strip()
     un  = (msg.from_user.username   or "").strip()
     now = now_tz().isoformat()
-    cur.execute("SELECT user_id FROM users WHERE user_id=?", (uid,))
-    if cur.fetchone() is None:
-        expiry = (datetime.now(timezone.utc) + timedelta(days=7)).isoformat()
-        cur.execute("""
-          INSERT INTO users (user_id, tg_first_name, tg_last_name, tg_username, name, phone, guest_count,
-                             source, approved, blocked, joined_at, last_seen)
-          VALUES (?, ?, ?, ?, NULL, NULL, 1, ?, 0, 0, ?, ?)
-        """, (uid, fn, ln, un, (source or None), now, now))
-    else:
-        cur.execute("""
-          UPDATE users SET tg_first_name=?, tg_last_name=?, tg_username=?, last_seen=? WHERE user_id=?
-        """, (fn, ln, un, now, uid))
-    conn.commit()
+    await storage.execute("""
+      INSERT INTO users (user_id, tg_first_name, tg_last_name, tg_username, name, phone, guest_count,
+                         source, approved, blocked, joined_at, last_seen)
+      VALUES (?, ?, ?, ?, NULL, NULL, 1, ?, 0, 0, ?, ?)
+      ON CONFLICT (user_id) DO UPDATE SET
+        tg_first_name=excluded.tg_first_name, tg_last_name=excluded.tg_last_name,
+        tg_username=excluded.tg_username, last_seen=excluded.last_seen
+    """, (uid, fn, ln, un, (source or None), now, now))
 
 def is_admin(user_id: int) -> bool:
-    return str(user_id) in [str(x) for x in ADMIN_IDS]
+    return str(user_id) in [str(x) for x in venue.ADMIN_IDS]
+
+
+# ===== Guest identity =====
+# Гость — строка users (профиль Telegram, доступ) и не больше одной строки guests (телефон), обе по user_id.
+# Профиль читается одним запросом с join и запоминается на время апдейта (GuestProfileMiddleware):
+# is_blocked / is_approved / is_registered / _guest_contact в одном хендлере больше не ходят в БД по отдельности.
+GUEST_UNIQUE_INDEXES = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_guests_user_id ON guests(user_id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_guests_phone_norm ON guests(phone_norm)",
+    "DROP INDEX IF EXISTS idx_guests_phone_norm",  # перекрыт ux_guests_phone_norm
+]
+
+
+class GuestProfile:
+    __slots__ = ("user_id", "name", "phone", "blocked", "approved")
+
+    def __init__(self, user_id: int, name: Optional[str], phone: Optional[str], blocked, approved):
+        self.user_id, self.name, self.phone = user_id, name, phone
+        self.blocked, self.approved = bool(blocked), bool(approved)
+
+    @property
+    def registered(self) -> bool:
+        return self.phone is not None
+
+
+# {user_id: GuestProfile} текущего апдейта; None — вне апдейта (задачи, CLI): читаем каждый раз
+_GUEST_PROFILES: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("guest_profiles", default=None)
+
+
+async def guest_profile(user_id: int) -> GuestProfile:
+    memo = _GUEST_PROFILES.get()
+    if memo is not None and user_id in memo:
+        metrics.inc("guest_profile_total", result="hit")
+        return memo[user_id]
+    row = await storage.fetchone("""
+        SELECT g.name, g.phone, u.blocked, u.approved
+        FROM (SELECT CAST(? AS BIGINT) AS user_id) k
+        LEFT JOIN users u ON u.user_id = k.user_id
+        LEFT JOIN guests g ON g.user_id = k.user_id
+    """, (user_id,))
+    metrics.inc("guest_profile_total", result="miss")
+    profile = GuestProfile(user_id, *row)
+    if memo is not None:
+        memo[user_id] = profile
+    return profile
+
 
+def forget_guest_profile(user_id: int) -> None:
+    """После записи в users/guests — следующий guest_profile() в этом апдейте перечитает."""
+    memo = _GUEST_PROFILES.get()
+    if memo:
+        memo.pop(user_id, None)
 
-def is_blocked(user_id: int) -> bool:
-    cur.execute("SELECT blocked FROM users WHERE user_id=?", (user_id,))
-    r = cur.fetchone()
-    return bool(r and r[0])
 
-def is_approved(user_id: int) -> bool:
-    if ACCESS_MODE != "closed":
+class GuestProfileMiddleware(BaseMiddleware):
+    """outer (dp.update): свой кэш профилей на каждый апдейт."""
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        token = _GUEST_PROFILES.set({})
+        try:
+            return await handler(event, data)
+        finally:
+            _GUEST_PROFILES.reset(token)
+
+
+dp.update.outer_middleware(GuestProfileMiddleware())
+
+
+async def merge_duplicate_guests(dry_run: bool = False) -> list[str]:
+    """Схлопывает дубли guests: на каждый user_id и phone_norm остаётся самая свежая строка (max id) —
+    её и отдавали прежние запросы с ORDER BY id DESC. Возвращает отчёт, строка на удалённую запись."""
+    rows = await storage.fetchall("""
+        SELECT id, user_id, name, phone, phone_norm FROM guests
+        WHERE user_id IN (SELECT user_id FROM guests GROUP BY user_id HAVING COUNT(*) > 1)
+           OR phone_norm IN (SELECT phone_norm FROM guests GROUP BY phone_norm HAVING COUNT(*) > 1)
+        ORDER BY id DESC
+    """)
+    by_user: dict[int, int] = {}
+    by_phone: dict[str, int] = {}
+    drop: list[int] = []
+    report: list[str] = []
+    for gid, user_id, name, phone, norm in rows:
+        kept = by_user.get(user_id) or (by_phone.get(norm) if norm else None)
+        if kept:
+            drop.append(gid)
+            why = "тот же user_id" if by_user.get(user_id) == kept else "тот же телефон"
+            report.append(f"#{gid} {name} {phone} (user {user_id}) → #{kept}, {why}")
+            continue
+        by_user[user_id] = gid
+        if norm:
+            by_phone[norm] = gid
+    if drop and not dry_run:
+        async with storage.transaction():
+            await storage.executemany("DELETE FROM guests WHERE id = ?", [(gid,) for gid in drop])
+    return report
+
+
+async def ensure_guest_identity():
+    """Дубли guests → отчёт админам, затем уникальные индексы (при старте, после backfill_phone_norm)."""
+    report = await merge_duplicate_guests()
+    if report:
+        for line in report:
+            logger.info("[GUESTS] удалён дубль %s", line)
+        text = f"🧹 Схлопнуты дубли гостей: <b>{len(report)}</b>\n" + "\n".join(html.escape(l) for l in report[:20])
+        if len(report) > 20:
+            text += f"\n… и ещё {len(report) - 20} (см. лог)"
+        await notify_admins(text)
+    for stmt in GUEST_UNIQUE_INDEXES:
+        await storage.execute(stmt)
+
+
+async def merge_guests_cli(dry_run: bool):
+    """python bot.py --merge-guests [--dry-run]: отчёт о дублях guests (и удаление без --dry-run)."""
+    await storage.connect()
+    try:
+        await storage.migrate()
+        await backfill_phone_norm()
+        report = await merge_duplicate_guests(dry_run=dry_run)
+        print(f"{'найдено' if dry_run else 'удалено'} дублей: {len(report)}")
+        for line in report:
+            print("  " + line)
+        if not dry_run:
+            for stmt in GUEST_UNIQUE_INDEXES:
+                await storage.execute(stmt)
+    finally:
+        await storage.close()
+
+
+async def is_blocked(user_id: int) -> bool:
+    return (await guest_profile(user_id)).blocked
+
+async def is_approved(user_id: int) -> bool:
+    if venue.ACCESS_MODE != "closed":
         return True
-    cur.execute("SELECT approved FROM users WHERE user_id=?", (user_id,))
-    r = cur.fetchone()
-    return bool(r and r[0])
+    return (await guest_profile(user_id)).approved
+
+async def is_registered(user_id: int) -> bool:
+    return (await guest_profile(user_id)).registered
+
+async def approve_user(user_id: int):
+    await storage.execute("UPDATE users SET approved=1, blocked=0 WHERE user_id=?", (user_id,))
+    forget_guest_profile(user_id)
+
+async def block_user(user_id: int):
+    await storage.execute("UPDATE users SET blocked=1, approved=0 WHERE user_id=?", (user_id,))
+    forget_guest_profile(user_id)
 
-def approve_user(user_id: int):
-    cur.execute("UPDATE users SET approved=1, blocked=0 WHERE user_id=?", (user_id,))
-    conn.commit()
+@read_only
+async def count_all_users() -> int:
+    return await storage.fetchval("SELECT COUNT(*) FROM users", default=0)
 
-def block_user(user_id: int):
-    cur.execute("UPDATE users SET blocked=1, approved=0 WHERE user_id=?", (user_id,))
-    conn.commit()
+@read_only
+async def count_users_inactive_since(limit_date: str) -> int:
+    # все минус активные с limit_date — по user_activity (индекс по day), без скана users
+    active = await active_users(limit_date[:10], ymd(now_tz()))
+    return max(0, await count_all_users() - active)
+
+@read_only
+async def last_joined_at() -> Optional[str]:
+    return await storage.fetchval("SELECT joined_at FROM users ORDER BY joined_at DESC LIMIT 1")
+
+async def active_subscriber_ids(since: str) -> list[int]:
+    rows = await storage.fetchall("""
+        SELECT user_id FROM users
+        WHERE approved = 1 AND blocked = 0 AND last_seen >= ?
+    """, (since,))
+    return [r[0] for r in rows]
 
 async def safe_reply(msg: Message, text: str, **kwargs):
     """Безопасная отправка сообщения пользователю (с меню, если возможно)."""
     try:
         await msg.answer(text, reply_markup=main_reply_kb(), **kwargs)
     except Exception as e:
-        print(f"[safe_reply][WARN] Не удалось отправить сообщение: {e}")
+        logger.warning("[safe_reply] Не удалось отправить сообщение: %s", e)
 
 # ===== Codes: window & discounts =====
-CODES_WINDOW_START = _parse_hhmm(os.getenv("CODES_WINDOW_START", "12:00"))
-CODES_WINDOW_END   = _parse_hhmm(os.getenv("CODES_WINDOW_END", "19:00"))
-VALID_UNTIL_HHMM   = _parse_hhmm(os.getenv("VALID_UNTIL_HHMM", "22:00"))
+SETTINGS_POLL_SEC = int(os.getenv("SETTINGS_POLL_SEC", "30"))  # как часто проверять версию настроек в БД
+
+LUCK_PRIZES = [
+    "🍺 Бокал пива",
+    "🎟 Браслет который решает",
+    "🍽 Кофе на выбор ",
+    "🥗 Салат греческий",
+    "🥗 Салат Оливье",
+    "💨 Кальян",
+    "🎁 40% скидка на браслет",
+    "🎁 50% скидка на браслет",
+    "🎁 30% скидка на браслет",
+    "🍺 2 Бокала пива",
+    "🥗 Салат Цезарь",
+    "🥗 Наливка ",
+    "🎟 Бесплатный браслет другу с которым вы пришли",
+]
+
+
+# ===== Settings (DB) =====
+# Рабочие параметры (скидки, окно кодов, расписание, ссылки) меняются админом через /set
+# и лежат в таблице settings. Всё, чего нет в таблице, берётся из .env/кода.
+# Хендлеры читают неизменяемый снимок SETTINGS через cfg() — без запросов в БД;
+# новый снимок собирается целиком и подменяется одной ссылкой. Номер версии лежит
+# в meta (settings_version): другие процессы сверяют его раз в SETTINGS_POLL_SEC.
+from types import MappingProxyType
+
+
+def _strict_hhmm(raw: str) -> tuple[int, int]:
+    h, sep, m = raw.strip().partition(":")
+    if not sep or not h.isdigit() or not m.isdigit() or int(h) > 23 or int(m) > 59:
+        raise ValueError("нужно время в формате ЧЧ:ММ")
+    return int(h), int(m)
+
+
+def _strict_discounts(raw: str) -> dict[int, int]:
+    out = _parse_discounts(raw)
+    if not out or any(d > 6 or p > 100 for d, p in out.items()):
+        raise ValueError("нужно «день:процент» через запятую, день 0=Пн…6=Вс, процент 0–100")
+    return out
+
+
+def _strict_weekday(raw: str) -> int:
+    if not raw.strip().isdigit() or int(raw) > 6:
+        raise ValueError("нужен день недели 0=Пн…6=Вс")
+    return int(raw)
+
+
+def _strict_url(raw: str) -> str:
+    url = raw.strip()
+    if not url.startswith(("http://", "https://")):
+        raise ValueError("нужна ссылка http(s)://…")
+    return url
+
+
+def _strict_list(raw: str) -> list[str]:
+    items = [x.strip() for x in raw.split("|") if x.strip()]
+    if not items:
+        raise ValueError("нужен хотя бы один вариант, разделитель «|»")
+    return items
+
+
+def _fmt_hhmm(v: tuple[int, int]) -> str:
+    return f"{v[0]:02d}:{v[1]:02d}"
+
+
+# ключ -> (описание, разбор строки, обратно в строку, значение по умолчанию)
+# Значения по умолчанию — функции: берут значения текущего заведения (после /reload — свежие из .env).
+SETTING_TYPES = {
+    "discounts": ("скидки по дням (0=Пн…6=Вс)", _strict_discounts,
+                  lambda v: ",".join(f"{d}:{p}" for d, p in sorted(v.items())), lambda: venue.DISCOUNTS),
+    "codes_window_start": ("начало окна выдачи кодов", _strict_hhmm, _fmt_hhmm, lambda: venue.CODES_WINDOW_START),
+    "codes_window_end": ("конец окна выдачи кодов", _strict_hhmm, _fmt_hhmm, lambda: venue.CODES_WINDOW_END),
+    "valid_until": ("код действует до (на следующий день)", _strict_hhmm, _fmt_hhmm, lambda: venue.VALID_UNTIL_HHMM),
+    "reminder_time": ("напоминание об окне кодов", _strict_hhmm, _fmt_hhmm, lambda: venue.REMINDER_TIME),
+    "report_time": ("ежедневный отчёт + обслуживание БД", _strict_hhmm, _fmt_hhmm, lambda: venue.REPORT_TIME),
+    "prize_day": ("день рассылки призов (0=Пн…6=Вс)", _strict_weekday, str, lambda: venue.PRIZE_DAY),
+    "prize_time": ("время рассылки призов", _strict_hhmm, _fmt_hhmm, lambda: (venue.PRIZE_HOUR, venue.PRIZE_MINUTE)),
+    "menu_url": ("ссылка на меню", _strict_url, str, lambda: venue.MENU_URL),
+    "luck_prizes": ("призы «Испытай удачу» (через |)", _strict_list, " | ".join, lambda: LUCK_PRIZES),
+}
+
+
+class SettingsSnapshot:
+    """Неизменяемый снимок настроек. Меняется только заменой целиком."""
+    __slots__ = ("version", "values", "overridden")
+
+    def __init__(self, version: int, values: dict, overridden: frozenset = frozenset()):
+        self.version = version
+        self.values = MappingProxyType(dict(values))
+        self.overridden = overridden  # ключи, заданные в БД (а не из .env)
+
+
+def _default_settings() -> dict:
+    return {key: spec[3]() for key, spec in SETTING_TYPES.items()}
+
+
+SETTINGS = venue_local("settings", lambda v: SettingsSnapshot(0, _default_settings()))
+# Будится при каждой смене снимка (планировщик пересчитывает время задач).
+# Событие одноразовое: после set() на его место кладётся новое.
+settings_changed = venue_local("settings_changed", lambda v: asyncio.Event())
+
+
+def cfg(key: str):
+    return SETTINGS.values[key]
+
+
+async def settings_version() -> int:
+    return int(await storage.get_meta("settings_version") or 0)
+
+
+async def load_settings(force: bool = False) -> bool:
+    """Собирает новый снимок, если версия в БД сменилась (или force). True — снимок заменён."""
+    version = await settings_version()
+    if not force and version == SETTINGS.version:
+        return False
+    values = _default_settings()
+    overridden = set()
+    for key, raw in await storage.fetchall("SELECT key, value FROM settings"):
+        spec = SETTING_TYPES.get(key)
+        if not spec:
+            continue
+        try:
+            values[key] = spec[1](raw)
+            overridden.add(key)
+        except ValueError as e:
+            logger.warning("[SETTINGS] %s=%r в БД некорректно (%s) — беру значение из .env", key, raw, e)
+    venue.settings = SettingsSnapshot(version, values, frozenset(overridden))
+    metrics.set("settings_version", version)
+    fired, venue.settings_changed = venue.settings_changed, asyncio.Event()
+    fired.set()
+    logger.info("[SETTINGS] снимок v%s: переопределено %s", version, ", ".join(sorted(overridden)) or "ничего")
+    return True
+
+
+async def set_setting(key: str, raw: Optional[str], user_id: int):
+    """Записывает (raw=None — сбрасывает к .env) настройку и публикует новый снимок.
+
+    ValueError — неизвестный ключ или неверное значение.
+    """
+    spec = SETTING_TYPES.get(key)
+    if not spec:
+        raise ValueError(f"неизвестный ключ, доступны: {', '.join(SETTING_TYPES)}")
+    async with storage.transaction():
+        if raw is None:
+            await storage.execute("DELETE FROM settings WHERE key=?", (key,))
+        else:
+            await storage.execute("""
+                INSERT INTO settings (key, value, updated_at, updated_by) VALUES (?,?,?,?)
+                ON CONFLICT (key) DO UPDATE SET
+                  value=excluded.value, updated_at=excluded.updated_at, updated_by=excluded.updated_by
+            """, (key, spec[2](spec[1](raw)), now_tz().isoformat(), user_id))
+        await storage.set_meta("settings_version", str(await settings_version() + 1))
+    await load_settings()
+    return cfg(key)
+
+
+_WEEKDAY_AT = ["в понедельник", "во вторник", "в среду", "в четверг", "в пятницу", "в субботу", "в воскресенье"]
+
+
+def prize_when_text() -> str:
+    """«в воскресенье 18:00» — когда уйдёт следующая рассылка призов."""
+    return f"{_WEEKDAY_AT[cfg('prize_day')]} {_fmt_hhmm(cfg('prize_time'))}"
+
+
+def settings_text() -> str:
+    snap = SETTINGS
+    lines = [f"⚙️ <b>Настройки</b> (версия {snap.version})", ""]
+    for key, (title, _, fmt, _) in SETTING_TYPES.items():
+        mark = "🗄" if key in snap.overridden else "📄"
+        lines.append(f"{mark} <code>{key}</code> = <b>{html.escape(fmt(snap.values[key]))}</b>\n    {title}")
+    lines += ["", "🗄 — задано через /set, 📄 — из .env",
+              "Изменить: <code>/set ключ значение</code>, сбросить к .env: <code>/set ключ -</code>"]
+    return "\n".join(lines)
 
-# 0=Mon ... 6=Sun
-DISCOUNTS = {0: 40, 1: 30, 2: 30, 3: 30, 4: 20, 5: 20, 6: 30}  # Sun=30%
 
 def discount_for_date(dt: datetime) -> int:
-    return DISCOUNTS.get(dt.weekday(), 0)
+    return cfg("discounts").get(dt.weekday(), 0)
 
 def today_discount() -> int:
     return discount_for_date(now_tz())
 
 def is_in_window(dt: datetime) -> bool:
-    s_h, s_m = CODES_WINDOW_START
-    e_h, e_m = CODES_WINDOW_END
+    s_h, s_m = cfg("codes_window_start")
+    e_h, e_m = cfg("codes_window_end")
     start = dt.replace(hour=s_h, minute=s_m, second=0, microsecond=0)
     end   = dt.replace(hour=e_h, minute=e_m, second=0, microsecond=0)
     return start <= dt <= end
 
 def valid_until_for_day(dt: datetime) -> datetime:
-    v_h, v_m = VALID_UNTIL_HHMM
+    v_h, v_m = cfg("valid_until")
     return (dt + timedelta(days=1)).replace(hour=v_h, minute=v_m, second=0, microsecond=0)
 
+# ===== Signed codes (HMAC) =====
+# CODE_FORMAT=hmac: код сам несёт день, тип, скидку/номер приза и подпись, поэтому
+# подделку и «не тот день» видно без БД (на кассе, во втором заведении). Строка в БД
+# остаётся только для учёта однократного погашения.
+# 13 символов base32 (без I, O, 0, 1) = 65 бит:
+#   kid 3 | день 10 (дней от 2024-01-01 по модулю 1024) | тип 1 | значение 7 | nonce 19 | HMAC 25
+# HMAC-SHA256 по 40 битам полезной нагрузки ключом kid. Ротация: новый ключ
+# добавляется в CODE_HMAC_KEYS и делается активным, старый держится, пока живут его коды.
+CODE_FORMAT = (os.getenv("CODE_FORMAT", "random") or "random").lower()   # random | hmac
+CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+CODE_KIND_BRACELET, CODE_KIND_REWARD = 0, 1
+_SIGNED_LEN = 13
+_MAC_BITS = 25
+_DAY_EPOCH = date(2024, 1, 1)
+
+
+def _parse_hmac_keys(raw: str) -> dict[int, bytes]:
+    """'1:secret1,2:secret2' -> {1: b'secret1', 2: b'secret2'}; kid 0..7."""
+    keys = {}
+    for part in (raw or "").split(","):
+        kid, _, secret = part.strip().partition(":")
+        if kid.strip().isdigit() and 0 <= int(kid) <= 7 and secret.strip():
+            keys[int(kid)] = secret.strip().encode()
+    return keys
+
+
+CODE_HMAC_KEYS = _parse_hmac_keys(os.getenv("CODE_HMAC_KEYS", ""))
+CODE_HMAC_ACTIVE = int(os.getenv("CODE_HMAC_ACTIVE", "0") or 0) or max(CODE_HMAC_KEYS, default=0)
+
+if CODE_FORMAT == "hmac" and CODE_HMAC_ACTIVE not in CODE_HMAC_KEYS:
+    logger.error("[CODES] CODE_FORMAT=hmac, но ключ CODE_HMAC_ACTIVE=%s не задан в CODE_HMAC_KEYS — "
+                 "выдаю обычные случайные коды", CODE_HMAC_ACTIVE)
+    CODE_FORMAT = "random"
+
+
+class SignedCode:
+    __slots__ = ("kid", "day", "kind", "value", "nonce")
+
+    def __init__(self, kid: int, day: date, kind: int, value: int, nonce: int):
+        self.kid, self.day, self.kind, self.value, self.nonce = kid, day, kind, value, nonce
+
+
+def normalize_code(raw: str) -> str:
+    return "".join(ch for ch in (raw or "").upper() if ch not in " -_")
+
+
+def fmt_code(code: str) -> str:
+    """Подписанный код показываем группами: XXXX-XXXX-XXXXX."""
+    if len(code) == _SIGNED_LEN:
+        return f"{code[:4]}-{code[4:8]}-{code[8:]}"
+    return code
+
+
+def _mac(key: bytes, payload: int) -> int:
+    digest = hmac.new(key, payload.to_bytes(5, "big"), hashlib.sha256).digest()
+    return int.from_bytes(digest[:4], "big") >> (32 - _MAC_BITS)
+
+
+def _b32(n: int, length: int) -> str:
+    out = []
+    for _ in range(length):
+        out.append(CODE_ALPHABET[n & 31])
+        n >>= 5
+    return "".join(reversed(out))
+
+
+def sign_code(kind: int, value: int, day: date, keys: Optional[dict[int, bytes]] = None,
+              kid: Optional[int] = None, nonce: Optional[int] = None) -> str:
+    keys = CODE_HMAC_KEYS if keys is None else keys
+    kid = CODE_HMAC_ACTIVE if kid is None else kid
+    nonce = random.getrandbits(19) if nonce is None else nonce
+    day_n = (day - _DAY_EPOCH).days % 1024
+    payload = (kid << 37) | (day_n << 27) | (kind << 26) | ((value & 127) << 19) | nonce
+    return _b32((payload << _MAC_BITS) | _mac(keys[kid], payload), _SIGNED_LEN)
+
+
+def verify_code(code: str, today: date, keys: Optional[dict[int, bytes]] = None) -> Optional[SignedCode]:
+    """Разбирает подписанный код; None — не наш формат, неизвестный ключ или подпись не сходится."""
+    keys = CODE_HMAC_KEYS if keys is None else keys
+    if len(code) != _SIGNED_LEN:
+        return None
+    n = 0
+    for ch in code:
+        i = CODE_ALPHABET.find(ch)
+        if i < 0:
+            return None
+        n = (n << 5) | i
+    payload, mac = n >> _MAC_BITS, n & ((1 << _MAC_BITS) - 1)
+    kid = payload >> 37
+    key = keys.get(kid)
+    if key is None or not hmac.compare_digest(_mac(key, payload).to_bytes(4, "big"), mac.to_bytes(4, "big")):
+        return None
+    # день хранится по модулю 1024 — берём ближайшую к сегодня дату не из будущего
+    day_n = (payload >> 27) & 1023
+    back = ((today - _DAY_EPOCH).days - day_n) % 1024
+    return SignedCode(kid, today - timedelta(days=back), (payload >> 26) & 1, (payload >> 19) & 127, payload & 0x7FFFF)
+
+
+def codes_selftest(samples: int = 200_000, forgeries: int = 1_000_000):
+    """Проверка формата: обратимость, коллизии, подделки, ротация ключей.
+
+    Запуск: python bot.py --codes-selftest"""
+    rng = random.Random(2024)
+    keys = {1: b"old-secret", 2: b"new-secret"}
+    today = now_tz().date()
+    ok = True
+
+    def check(cond: bool, what: str):
+        nonlocal ok
+        ok = ok and cond
+        logger.info("[SELFTEST] %s %s", "OK  " if cond else "FAIL", what)
+
+    codes = []
+    t0 = time.perf_counter()
+    for i in range(samples):
+        day = today - timedelta(days=rng.randint(0, 7))
+        kind, value, nonce = rng.randint(0, 1), rng.randint(0, 100), rng.getrandbits(19)
+        code = sign_code(kind, value, day, keys, kid=2, nonce=nonce)
+        sc = verify_code(code, today, keys)
+        if not sc or (sc.day, sc.kind, sc.value, sc.nonce, sc.kid) != (day, kind, value, nonce, 2):
+            check(False, f"обратимость: {code}")
+            break
+        codes.append(code)
+    sign_us = (time.perf_counter() - t0) / samples * 1e6
+    check(len(codes) == samples, f"обратимость {samples} кодов (sign+verify {sign_us:.1f} мкс)")
+
+    # коллизии: 10k кодов одного дня и одной скидки
+    same = {sign_code(0, 30, today, keys, kid=2) for _ in range(10_000)}
+    check(10_000 - len(same) < 300, f"коллизии nonce на 10k кодов дня: {10_000 - len(same)} "
+                                    f"(ожидаемо ~{10_000 ** 2 / 2 / 2 ** 19:.0f}; выдача перегенерирует дубль)")
+
+    # подмена одного символа: подпись должна не сойтись
+    tampered = accepted = 0
+    for code in codes[:20_000]:
+        pos = rng.randrange(_SIGNED_LEN)
+        ch = rng.choice([c for c in CODE_ALPHABET if c != code[pos]])
+        tampered += 1
+        accepted += verify_code(code[:pos] + ch + code[pos + 1:], today, keys) is not None
+    check(accepted <= 2, f"подмена символа: принято {accepted} из {tampered} (ожидаемо ~{tampered / 2 ** _MAC_BITS:.3f})")
+
+    # случайные строки
+    accepted = sum(verify_code("".join(rng.choice(CODE_ALPHABET) for _ in range(_SIGNED_LEN)), today, keys) is not None
+                   for _ in range(forgeries))
+    check(accepted <= 3, f"случайные строки: принято {accepted} из {forgeries} "
+                         f"(ожидаемо ~{forgeries * 2 / 8 / 2 ** _MAC_BITS:.3f})")
+
+    # ротация: старый kid проверяется, пока ключ есть; после удаления — нет
+    old = sign_code(0, 40, today, keys, kid=1)
+    check(verify_code(old, today, keys) is not None, "ротация: код старого ключа принимается")
+    check(verify_code(old, today, {2: keys[2]}) is None, "ротация: после удаления ключа код отклоняется")
+    check(verify_code(old, today, {1: b"other", 2: keys[2]}) is None, "чужой секрет с тем же kid отклоняется")
+
+    # перенос дня через модуль 1024
+    far = _DAY_EPOCH + timedelta(days=1023)
+    sc = verify_code(sign_code(0, 10, far, keys, kid=2), far + timedelta(days=1), keys)
+    check(sc is not None and sc.day == far, "день через границу модуля 1024")
+    logger.info("[SELFTEST] %s", "всё OK" if ok else "ЕСТЬ ОШИБКИ")
+    return ok
+
+
+async def new_bracelet_code(now: datetime) -> str:
+    if CODE_FORMAT == "hmac":
+        return sign_code(CODE_KIND_BRACELET, discount_for_date(now), now.date())
+    return gen_code(6)
+
+
+async def new_reward_code(now: datetime, prize_no: int) -> str:
+    """Код приза «Испытай удачу»; уникальность проверяем по idx_reward_code."""
+    while True:
+        if CODE_FORMAT == "hmac":
+            code = sign_code(CODE_KIND_REWARD, prize_no, now.date())
+        else:
+            code = ''.join(random.choice(CODE_ALPHABET) for _ in range(6))
+        if not await storage.fetchval("SELECT 1 FROM random_rewards WHERE reward_code=?", (code,)):
+            return code
+
+
 def gen_code(n: int = 6) -> str:
-    alphabet = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
-    return "".join(random.choice(alphabet) for _ in range(n))
+    return "".join(random.choice(CODE_ALPHABET) for _ in range(n))
 
-def user_code_for_day(user_id: int, day_key: str):
-    cur.execute("SELECT id, code, issued_at, expires_at, valid FROM codes WHERE user_id=? AND day_key=? LIMIT 1",
-                (user_id, day_key))
-    return cur.fetchone()
+async def user_code_for_day(user_id: int, day_key: str):
+    return await storage.fetchone(
+        "SELECT id, code, issued_at, expires_at, valid FROM codes WHERE user_id=? AND day_key=? LIMIT 1",
+        (user_id, day_key))
 
-def create_code_for_user(user_id: int):
+async def create_code_for_user(user_id: int):
     now = now_tz()
     day_key = ymd(now)
-    row = user_code_for_day(user_id, day_key)
+    row = await user_code_for_day(user_id, day_key)
     if row:
         _id, code, issued_at, expires_at, valid = row
         return code, datetime.fromisoformat(issued_at), datetime.fromisoformat(expires_at)
-    code = gen_code(6)
+    code = await new_bracelet_code(now)
+    while code_index.find(code, now.date()):  # на входе код должен однозначно указывать на гостя
+        code = await new_bracelet_code(now)
     issued_at = now
     expires_at = valid_until_for_day(now)
-    cur.execute("""
+    cid = await storage.insert("""
       INSERT INTO codes (user_id, code, issued_at, expires_at, day_key, valid)
       VALUES (?, ?, ?, ?, ?, 1)
     """, (user_id, code, issued_at.isoformat(), expires_at.isoformat(), day_key))
-    conn.commit()
+    code_index.add(code, DoorCode(cid, user_id, day_key, expires_at.isoformat()))
+    await track(user_id, "code")
     return code, issued_at, expires_at
 
-def invalidate_expired():
-    cur.execute("UPDATE codes SET valid=0 WHERE valid=1 AND expires_at<=?", (now_tz().isoformat(),))
-    conn.commit()
+async def count_valid_codes() -> int:
+    # срок действия проверяется при чтении по expires_at — массовый UPDATE valid=0 не нужен,
+    # valid=0 значит только «аннулирован вручную»
+    return await storage.fetchval(
+        "SELECT COUNT(*) FROM codes WHERE valid=1 AND expires_at>?", (now_tz().isoformat(),), default=0)
+
+# ===== QR codes & Telegram file_id cache =====
+# Код гостю приходит ещё и QR-картинкой: на входе его сканируют, а не перепечатывают.
+# PNG рисуется в отдельном пуле потоков (qrcode+Pillow — чистый CPU, цикл не блокируем).
+# После первой загрузки Telegram отдаёт file_id — храним его в tg_files, и повторный
+# показ (например, «Мои призы») уходит без загрузки файла. Ключи: qr:<код>,
+# asset:map, asset:menu_cover. Для файлов-ассетов в source лежит путь+mtime+размер:
+# заменили картинку на диске — file_id перевыпускается сам.
+from concurrent.futures import ThreadPoolExecutor
+from aiogram.types import BufferedInputFile, FSInputFile
+
+QR_CODES = os.getenv("QR_CODES", "1") == "1"
+QR_WORKERS = int(os.getenv("QR_WORKERS", "2"))
+QR_CACHE_KEEP_DAYS = int(os.getenv("QR_CACHE_KEEP_DAYS", "30"))
+ASSET_MAP_PATH = os.getenv("ASSET_MAP_PATH", "")            # картинка со схемой проезда
+ASSET_MENU_COVER_PATH = os.getenv("ASSET_MENU_COVER_PATH", "")  # обложка меню
+FILE_ID_CACHE_SIZE = 2048
+
+_qr_pool: Optional[ThreadPoolExecutor] = None
+_qr_available: Optional[bool] = None
+_file_ids = venue_local("file_ids", lambda v: OrderedDict())   # key -> (file_id, source); file_id у каждого бота свой
+
+
+def qr_enabled() -> bool:
+    global _qr_available
+    if not QR_CODES:
+        return False
+    if _qr_available is None:
+        try:
+            import qrcode  # noqa: F401
+            import PIL  # noqa: F401
+            _qr_available = True
+        except ImportError:
+            logger.warning("[QR] нет пакетов qrcode/Pillow (pip install qrcode pillow) — коды только текстом")
+            _qr_available = False
+    return _qr_available
+
+
+def _render_qr(text: str) -> bytes:
+    import qrcode
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=10, border=2)
+    qr.add_data(text)
+    qr.make(fit=True)
+    buf = io.BytesIO()
+    qr.make_image().save(buf, format="PNG")
+    return buf.getvalue()
+
+
+async def render_qr(text: str) -> bytes:
+    global _qr_pool
+    if _qr_pool is None:
+        _qr_pool = ThreadPoolExecutor(max_workers=QR_WORKERS, thread_name_prefix="qr")
+    started = time.perf_counter()
+    png = await asyncio.get_running_loop().run_in_executor(_qr_pool, _render_qr, text)
+    metrics.inc("qr_render_seconds_total", time.perf_counter() - started)
+    metrics.inc("qr_rendered_total")
+    return png
+
+
+def shutdown_qr_pool():
+    if _qr_pool is not None:
+        _qr_pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def cached_file_id(key: str, source: str = "") -> Optional[str]:
+    hit = _file_ids.get(key)
+    if hit is None:
+        row = await storage.fetchone("SELECT file_id, source FROM tg_files WHERE key=?", (key,))
+        if row:
+            hit = (row[0], row[1] or "")
+            _file_ids[key] = hit
+    if hit is None or hit[1] != source:
+        return None
+    _file_ids.move_to_end(key)
+    return hit[0]
+
+
+async def remember_file_id(key: str, file_id: str, source: str = ""):
+    _file_ids[key] = (file_id, source)
+    _file_ids.move_to_end(key)
+    while len(_file_ids) > FILE_ID_CACHE_SIZE:
+        _file_ids.popitem(last=False)
+    await storage.execute("""
+        INSERT INTO tg_files (key, file_id, source, created_at) VALUES (?,?,?,?)
+        ON CONFLICT (key) DO UPDATE SET file_id=excluded.file_id, source=excluded.source, created_at=excluded.created_at
+    """, (key, file_id, source, now_tz().isoformat()))
+
+
+async def forget_file_id(key: str):
+    _file_ids.pop(key, None)
+    await storage.execute("DELETE FROM tg_files WHERE key=?", (key,))
+
+
+async def send_cached_photo(chat_id: int, key: str, make_file, source: str = "", **kwargs) -> Optional[Message]:
+    """send_photo по file_id из кэша; при промахе — make_file() (корутина -> InputFile) и запоминаем file_id.
+
+    Telegram может не принять старый file_id (файл удалён, другой бот) — тогда один раз перезаливаем."""
+    file_id = await cached_file_id(key, source)
+    if file_id:
+        try:
+            sent = await bot.send_photo(chat_id, photo=file_id, **kwargs)
+            metrics.inc("tg_file_cache_total", result="hit")
+            return sent
+        except TelegramBadRequest as e:
+            logger.warning("[FILES] file_id для %s отклонён (%s) — загружаю заново", key, e)
+            await forget_file_id(key)
+    metrics.inc("tg_file_cache_total", result="miss")
+    sent = await bot.send_photo(chat_id, photo=await make_file(), **kwargs)
+    if sent.photo:
+        await remember_file_id(key, sent.photo[-1].file_id, source)
+    return sent
+
+
+async def send_code_qr(chat_id: int, code: str, caption: str, **kwargs) -> bool:
+    """QR с кодом + подпись. False — QR выключен/не удался, вызывающий шлёт обычный текст."""
+    if not qr_enabled():
+        return False
+
+    async def make():
+        return BufferedInputFile(await render_qr(code), filename=f"{code}.png")
+
+    try:
+        await send_cached_photo(chat_id, f"qr:{code}", make, caption=caption, **kwargs)
+        return True
+    except Exception as e:
+        logger.warning("[QR] не удалось отправить QR %s: %s", code, e)
+        return False
+
+
+def _asset_source(path: str) -> Optional[str]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f"{path}:{int(st.st_mtime)}:{st.st_size}"
+
+
+async def send_asset(chat_id: int, key: str, path: str, caption: str, **kwargs) -> bool:
+    """Статичная картинка (схема проезда, обложка меню) через тот же кэш file_id."""
+    source = _asset_source(path) if path else None
+    if not source:
+        return False
+
+    async def make():
+        return FSInputFile(path)
+
+    try:
+        await send_cached_photo(chat_id, key, make, source=source, caption=caption, **kwargs)
+        return True
+    except Exception as e:
+        logger.warning("[FILES] не удалось отправить %s: %s", key, e)
+        return False
+
+
+async def prune_file_cache():
+    """QR старых кодов больше не покажут — чистим их file_id; ассеты не трогаем."""
+    limit = (now_tz() - timedelta(days=QR_CACHE_KEEP_DAYS)).isoformat()
+    n = await storage.execute("DELETE FROM tg_files WHERE key LIKE 'qr:%' AND created_at < ?", (limit,))
+    if n:
+        logger.info("[FILES] удалено file_id старых QR: %s", n)
+
+
+# ===== Door check (/check CODE) =====
+# На входе код браслета проверяется по индексу в памяти: коды за сегодня и вчера
+# (вчерашние действуют до VALID_UNTIL следующего дня). Индекс прогревается при
+# старте и пополняется при выдаче; если кода в нём нет (выдан другим процессом,
+# перезапуск) — запрос в БД по индексу codes(day_key, code). Погашение — один
+# UPDATE с условием «ещё не погашен»: из двух одновременных /check пройдёт один.
+def is_staff(user_id: int) -> bool:
+    return is_admin(user_id) or user_id in venue.STAFF_IDS
+
+
+class DoorCode:
+    __slots__ = ("id", "user_id", "day_key", "expires_at", "valid", "used_at")
+
+    def __init__(self, id: int, user_id: int, day_key: str, expires_at: str, valid: int = 1, used_at: Optional[str] = None):
+        self.id, self.user_id, self.day_key = id, user_id, day_key
+        self.expires_at, self.valid, self.used_at = expires_at, valid, used_at
+
+
+class CodeIndex:
+    """{day_key: {code: DoorCode}} только за сегодня и вчера."""
+
+    def __init__(self):
+        self.days: dict[str, dict[str, DoorCode]] = {}
+        self._today: Optional[date] = None
+        self._keep: tuple[str, str] = ("", "")
+
+    def _live_days(self, today: date) -> tuple[str, str]:
+        if today != self._today:  # смена суток: позавчерашние коды выбрасываем
+            self._today = today
+            self._keep = (ymd(today), ymd(today - timedelta(days=1)))
+            self.days = {day: codes for day, codes in self.days.items() if day in self._keep}
+        return self._keep
+
+    def warm(self, rows, today: date):
+        self.days = {day: {} for day in self._live_days(today)}
+        for cid, user_id, code, day_key, expires_at, valid, used_at in rows:
+            if day_key in self.days:
+                self.days[day_key][code] = DoorCode(cid, user_id, day_key, expires_at, valid, used_at)
+
+    def add(self, code: str, entry: DoorCode):
+        self.days.setdefault(entry.day_key, {})[code] = entry
+
+    def find(self, code: str, today: date) -> Optional[DoorCode]:
+        for day in self._live_days(today):
+            entry = self.days.get(day, {}).get(code)
+            if entry:
+                return entry
+        return None
+
+    def __len__(self):
+        return sum(len(v) for v in self.days.values())
+
+
+code_index = venue_local("code_index", lambda v: CodeIndex())
+
+_DOOR_CODE_SQL = """
+    SELECT id, user_id, code, day_key, expires_at, valid, used_at FROM codes
+    WHERE day_key IN (?, ?) AND code = ?
+"""
+
+
+async def warm_code_index():
+    today = now_tz().date()
+    code_index.warm(await storage.fetchall("""
+        SELECT id, user_id, code, day_key, expires_at, valid, used_at FROM codes
+        WHERE day_key >= ?
+    """, (ymd(today - timedelta(days=1)),)), today)
+    metrics.set("door_index_codes", len(code_index))
+
+
+async def find_door_code(code: str) -> Optional[DoorCode]:
+    today = now_tz().date()
+    entry = code_index.find(code, today)
+    if entry:
+        metrics.inc("door_lookups_total", source="memory")
+        return entry
+    metrics.inc("door_lookups_total", source="db")
+    row = await storage.fetchone(_DOOR_CODE_SQL, (ymd(today), ymd(today - timedelta(days=1)), code))
+    if not row:
+        return None
+    cid, user_id, code, day_key, expires_at, valid, used_at = row
+    entry = DoorCode(cid, user_id, day_key, expires_at, valid, used_at)
+    code_index.add(code, entry)
+    return entry
+
+
+async def mark_code_used(entry: DoorCode, staff_id: int) -> bool:
+    """True — погасили мы; False — код уже погашен/аннулирован/истёк (в т.ч. параллельно)."""
+    now = now_tz().isoformat()
+    n = await storage.execute("""
+        UPDATE codes SET used_at=?, used_by=?
+        WHERE id=? AND valid=1 AND used_at IS NULL AND expires_at > ?
+    """, (now, staff_id, entry.id, now))
+    if n:
+        entry.used_at = now
+        return True
+    row = await storage.fetchone("SELECT valid, used_at FROM codes WHERE id=?", (entry.id,))
+    if row:
+        entry.valid, entry.used_at = row
+    return False
+
+
+async def door_guest(user_id: int) -> str:
+    row = await storage.fetchone("""
+        SELECT g.name, g.phone, u.tg_first_name, u.tg_username FROM users u
+        LEFT JOIN guests g ON g.user_id = u.user_id WHERE u.user_id = ? LIMIT 1
+    """, (user_id,))
+    if not row:
+        return f"id {user_id}"
+    name, phone, first_name, username = row
+    who = html.escape(name or first_name or f"id {user_id}")
+    return who + (f" ({html.escape(phone)})" if phone else "") + (f" @{html.escape(username)}" if username else "")
+
+
+def offline_reject(code: str, kind: int, max_age_days: int) -> Optional[tuple[str, str]]:
+    """Проверка подписанного кода без БД: (result, причина) если код точно не годится.
+
+    Коды старого формата (6 символов) пропускаем дальше — их проверяет только БД."""
+    if len(code) != _SIGNED_LEN or not CODE_HMAC_KEYS:
+        return None
+    today = now_tz().date()
+    sc = verify_code(code, today)
+    if sc is None or sc.kind != kind:
+        metrics.inc("code_offline_rejects_total", reason="forged")
+        return "forged", "подпись не сходится — код поддельный или набран с ошибкой"
+    if (today - sc.day).days > max_age_days:
+        metrics.inc("code_offline_rejects_total", reason="expired")
+        return "expired", f"выдан {sc.day.strftime('%d.%m')}, срок вышел"
+    return None
+
+
+async def check_code(code: str, staff_id: int) -> str:
+    started = time.perf_counter()
+    rejected = offline_reject(code, CODE_KIND_BRACELET, 1)
+    if rejected:
+        metrics.inc("door_checks_total", result=rejected[0])
+        return f"❌ Код <code>{html.escape(fmt_code(code))}</code>: {rejected[1]}."
+    entry = await find_door_code(code)
+    if not entry:
+        metrics.inc("door_checks_total", result="not_found")
+        return f"❌ Код <code>{html.escape(fmt_code(code))}</code> не найден (проверяются коды за сегодня и вчера)."
+    expires = datetime.fromisoformat(entry.expires_at)
+    if entry.valid and not entry.used_at and expires > now_tz():
+        ok = await mark_code_used(entry, staff_id)
+    else:
+        ok = False
+    shown = fmt_code(code)
+    disc = discount_for_date(datetime.strptime(entry.day_key, "%Y-%m-%d"))
+    guest = await door_guest(entry.user_id)
+    if ok:
+        result, head = "ok", f"✅ <b>Код {shown} принят</b> — скидка <b>{disc}%</b>"
+        await track(entry.user_id, "visit")
+    elif entry.used_at:
+        used = datetime.fromisoformat(entry.used_at).strftime("%d.%m %H:%M")
+        result, head = "reused", f"⛔️ <b>Код {shown} уже погашен</b> {used}"
+    elif not entry.valid:
+        result, head = "annulled", f"⛔️ <b>Код {shown} аннулирован</b>"
+    else:
+        result, head = "expired", f"⌛️ <b>Код {shown} истёк</b>"
+    metrics.inc("door_checks_total", result=result)
+    return (f"{head}\n👤 {guest}\n📅 выдан на {entry.day_key}, действует до {expires.strftime('%d.%m %H:%M')}"
+            f"\n⏱ {(time.perf_counter() - started) * 1000:.0f} мс")
+
+
+@dp.message(Command("check"))
+async def check_cmd(msg: Message):
+    if not is_staff(msg.from_user.id): return
+    parts = (msg.text or "").split(maxsplit=1)
+    if len(parts) < 2:
+        return await msg.answer("Использование: <code>/check CODE</code>")
+    await msg.answer(await check_code(normalize_code(parts[1]), msg.from_user.id))
+
+
+def bench_check(active: int = 10_000, lookups: int = 200_000):
+    """Бенчмарк /check: индекс в памяти против запроса в БД (с индексом codes(day_key, code) и без).
+
+    Запуск: python bot.py --bench-check"""
+    rng = random.Random(7)
+    today = now_tz().date()
+    days = (ymd(today), ymd(today - timedelta(days=1)))
+    expires = (now_tz() + timedelta(hours=12)).isoformat()
+    codes = set()
+    while len(codes) < active:
+        codes.add("".join(rng.choice("ABCDEFGHJKLMNPQRSTUVWXYZ23456789") for _ in range(6)))
+    rows = [(i + 1, 1000 + i, c, days[i % 2], expires, 1, None) for i, c in enumerate(sorted(codes))]
+    # + 60 дней истории, как в живой базе до архивации
+    history = [(active + i + 1, i, f"H{i:05d}", ymd(today - timedelta(days=2 + i % 60)), expires, 1, None)
+               for i in range(active * 6)]
+
+    mem = sqlite3.connect(":memory:")
+    mem.execute("""CREATE TABLE codes (id INTEGER PRIMARY KEY, user_id INTEGER, code TEXT, day_key TEXT,
+                   expires_at TEXT, valid INTEGER, used_at TEXT, used_by INTEGER)""")
+    mem.executemany("INSERT INTO codes VALUES (?, ?, ?, ?, ?, ?, ?, NULL)", rows + history)
+
+    idx = CodeIndex()
+    t0 = time.perf_counter()
+    idx.warm(rows, today)
+    warm_ms = (time.perf_counter() - t0) * 1000
+
+    probes = [rng.choice(rows)[2] for _ in range(lookups)]
+    t0 = time.perf_counter()
+    for c in probes:
+        idx.find(c, today)
+    mem_ns = (time.perf_counter() - t0) / lookups * 1e9
+
+    def sql_ns(n: int) -> float:
+        t0 = time.perf_counter()
+        for c in probes[:n]:
+            mem.execute(_DOOR_CODE_SQL, (days[0], days[1], c)).fetchone()
+        return (time.perf_counter() - t0) / n * 1e9
+
+    scan_ns = sql_ns(200)
+    mem.execute("CREATE INDEX idx_codes_day_code ON codes(day_key, code)")
+    idx_ns = sql_ns(20_000)
+
+    t0 = time.perf_counter()
+    now = now_tz().isoformat()
+    for cid in range(1, 2001):
+        mem.execute("UPDATE codes SET used_at=?, used_by=1 WHERE id=? AND valid=1 AND used_at IS NULL AND expires_at > ?",
+                    (now, cid, now))
+    upd_us = (time.perf_counter() - t0) / 2000 * 1e6
+    mem.close()
+
+    logger.info("[BENCH] check: %d активных кодов (+%d в истории), прогрев индекса %.1f мс", active, len(history), warm_ms)
+    logger.info("[BENCH] поиск в памяти: %.0f нс/код на %d запросов", mem_ns, lookups)
+    logger.info("[BENCH] SQL по codes(day_key, code): %.0f нс/код (x%.0f медленнее памяти)", idx_ns, idx_ns / max(mem_ns, 1))
+    logger.info("[BENCH] SQL без индекса (скан): %.0f мкс/код", scan_ns / 1000)
+    logger.info("[BENCH] атомарное погашение (UPDATE ... used_at IS NULL): %.1f мкс", upd_us)
+
+
+# ===== Retention / archive =====
+# (таблица, условие «строка устарела», параметры по (cutoff_day, now_utc), счётчики для daily_rollups)
+def _retention_rules() -> list[tuple[str, str, tuple, list[tuple[str, str]]]]:
+    today = now_tz().date()
+    now = now_tz().isoformat()  # expiry_date хранится с тем же смещением (+05:00), см. backfill_expiry_tz
+    rules = []
+    if RETENTION_CODES_DAYS > 0:
+        cutoff = ymd(today - timedelta(days=RETENTION_CODES_DAYS))
+        rules.append(("codes", "day_key < ?", (cutoff,), [("codes", "day_key")]))
+    if RETENTION_RESERVATIONS_DAYS > 0:
+        cutoff = ymd(today - timedelta(days=RETENTION_RESERVATIONS_DAYS))
+        rules.append(("reservations", "r_date < ?", (cutoff,),
+                      [("res_date", "r_date"), ("res_created", "substr(created_at, 1, 10)")]))
+    if RETENTION_REWARDS_DAYS > 0:
+        cutoff = ymd(today - timedelta(days=RETENTION_REWARDS_DAYS))
+        rules.append(("random_rewards",
+                      "substr(date_issued, 1, 10) < ? AND (redeemed = 1 OR expired = 1 OR expiry_date < ?)",
+                      (cutoff, now), [("rewards", "substr(date_issued, 1, 10)")]))
+    return rules
+
+async def _archive_table(table: str, where: str, params: tuple, rollups: list[tuple[str, str]]) -> int:
+    cols = ", ".join(await storage.columns(table))
+    moved = 0
+    while True:
+        # одна пачка = одна транзакция: счётчики, копия в архив и удаление видны вместе
+        async with storage.transaction():
+            rows = await storage.fetchall(
+                f"SELECT id FROM {table} WHERE {where} ORDER BY id LIMIT ?", (*params, ARCHIVE_BATCH))
+            ids = tuple(r[0] for r in rows)
+            if not ids:
+                break
+            marks = ", ".join("?" for _ in ids)
+            for metric, day_expr in rollups:
+                await storage.execute(f"""
+                    INSERT INTO daily_rollups (day_key, metric, value)
+                    SELECT {day_expr}, '{metric}', COUNT(*) FROM {table} WHERE id IN ({marks}) GROUP BY {day_expr}
+                    ON CONFLICT (day_key, metric) DO UPDATE SET value = daily_rollups.value + excluded.value
+                """, ids)
+            await storage.execute(
+                f"INSERT INTO archive.{table} ({cols}) SELECT {cols} FROM {table} WHERE id IN ({marks}) "
+                f"ON CONFLICT DO NOTHING", ids)
+            await storage.execute(f"DELETE FROM {table} WHERE id IN ({marks})", ids)
+        moved += len(ids)
+        await asyncio.sleep(0)  # между пачками отдаём event loop
+    return moved
+
+async def archive_old_rows() -> dict[str, int]:
+    """Переносит устаревшие строки в архив пачками по ARCHIVE_BATCH. Возвращает {таблица: перенесено}."""
+    moved = {}
+    for table, where, params, rollups in _retention_rules():
+        moved[table] = await _archive_table(table, where, params, rollups)
+        if moved[table]:
+            metrics.inc("archived_rows_total", moved[table], table=table)
+            logger.info("[ARCHIVE] %s: %d строк", table, moved[table])
+    return moved
+
+async def rollup_value(metric: str, start_key: str, end_key: Optional[str] = None) -> int:
+    """Сумма по уже заархивированным строкам за дни [start_key, end_key]."""
+    return await storage.fetchval(
+        "SELECT SUM(value) FROM daily_rollups WHERE metric=? AND day_key BETWEEN ? AND ?",
+        (metric, start_key, end_key or start_key), default=0)
+
+# ===== Reservations: capacity =====
+RES_SLOT_MINUTES   = int(os.getenv("RES_SLOT_MINUTES", "30"))       # шаг слота
+RES_SLOTS_START    = _parse_hhmm(os.getenv("RES_SLOTS_START", "12:00"))  # первый слот
+RES_SLOTS_END      = _parse_hhmm(os.getenv("RES_SLOTS_END", "23:00"))    # последний слот
+RES_SEATS_PER_SLOT = int(os.getenv("RES_SEATS_PER_SLOT", "40"))     # гостей на один слот
+RES_SEATS_PER_DAY  = int(os.getenv("RES_SEATS_PER_DAY", "160"))     # гостей на весь день
+
+class CapacityIndex:
+    """Занятость мест в памяти: гостей на (дата, слот) и на дату.
+
+    Проверка свободных мест — два обращения к dict, без запросов в БД.
+    Индекс прогревается из reservations при старте и обновляется
+    в create_reservation / set_res_status. Отменённые брони не считаются."""
+
+    def __init__(self, slot_minutes: int, start: tuple[int, int], end: tuple[int, int],
+                 seats_per_slot: int, seats_per_day: int):
+        self.slot_minutes = max(1, slot_minutes)
+        self.first_slot = start[0] * 60 + start[1]
+        self.last_slot = end[0] * 60 + end[1]
+        self.seats_per_slot = seats_per_slot
+        self.seats_per_day = seats_per_day
+        self.by_slot: dict[tuple[str, int], int] = {}   # (YYYY-MM-DD, минута начала слота) -> гостей
+        self.by_day: dict[str, int] = {}                # YYYY-MM-DD -> гостей
+
+    def slot_of(self, r_time: str) -> Optional[int]:
+        """HH:MM -> минута начала слота; None, если время вне часов приёма броней."""
+        try:
+            h, m = r_time.split(":")
+            minute = int(h) * 60 + int(m)
+        except (ValueError, AttributeError):
+            return None
+        if minute < self.first_slot or minute > self.last_slot:
+            return None
+        return minute - (minute - self.first_slot) % self.slot_minutes
+
+    def slots(self) -> list[int]:
+        return list(range(self.first_slot, self.last_slot + 1, self.slot_minutes))
+
+    @staticmethod
+    def fmt_slot(slot: int) -> str:
+        return f"{slot // 60:02d}:{slot % 60:02d}"
+
+    def _apply(self, r_date: str, r_time: str, covers: int) -> None:
+        slot = self.slot_of(r_time)
+        if slot is None:
+            slot = -1  # бронь вне сетки (старые записи) — учитываем только в дневном лимите
+        key = (r_date, slot)
+        self.by_slot[key] = self.by_slot.get(key, 0) + covers
+        self.by_day[r_date] = self.by_day.get(r_date, 0) + covers
+
+    def add(self, r_date: str, r_time: str, covers: int) -> None:
+        self._apply(r_date, r_time, covers)
+
+    def remove(self, r_date: str, r_time: str, covers: int) -> None:
+        self._apply(r_date, r_time, -covers)
+
+    def free_seats(self, r_date: str, r_time: str) -> int:
+        slot = self.slot_of(r_time)
+        if slot is None:
+            return 0
+        return max(0, min(self.seats_per_slot - self.by_slot.get((r_date, slot), 0),
+                          self.seats_per_day - self.by_day.get(r_date, 0)))
+
+    def can_book(self, r_date: str, r_time: str, covers: int) -> bool:
+        return self.free_seats(r_date, r_time) >= covers
+
+    def open_slots(self, r_date: str, covers: int = 1) -> list[str]:
+        day_free = self.seats_per_day - self.by_day.get(r_date, 0)
+        if day_free < covers:
+            return []
+        return [
+            self.fmt_slot(s) for s in self.slots()
+            if self.seats_per_slot - self.by_slot.get((r_date, s), 0) >= covers
+        ]
+
+    def day_load(self, r_date: str) -> int:
+        return self.by_day.get(r_date, 0)
+
+    def warm(self, rows) -> None:
+        self.by_slot.clear()
+        self.by_day.clear()
+        for r_date, r_time, covers in rows:
+            self._apply(r_date, r_time, covers)
+
+
+capacity = venue_local("capacity", lambda v: CapacityIndex(
+    RES_SLOT_MINUTES, RES_SLOTS_START, RES_SLOTS_END, RES_SEATS_PER_SLOT, RES_SEATS_PER_DAY))
+
+async def warm_capacity_index():
+    since = ymd(now_tz() - timedelta(days=1))
+    capacity.warm(await storage.fetchall("""
+        SELECT r_date, r_time, covers FROM reservations
+        WHERE r_date >= ? AND status != 'cancelled'
+    """, (since,)))
+
+# ===== Analytics =====
+# Воронка гостя: start → contact → code → reservation → redeem.
+# Вместо сканов больших таблиц держим маленькие агрегаты, которые обновляются
+# по ходу работы:
+#   user_activity(user_id, day) — одна строка на активный день гостя (DAU/WAU/MAU);
+#   user_funnel — когорта (день первого визита) и когда гость впервые прошёл каждый этап;
+#   analytics_daily(day, metric, value) — счётчики: dau, new, ev:<этап> (события дня),
+#       fn:<этап> (сколько гостей когорты этого дня дошли до этапа);
+#   cohort_weekly(cohort_week, week, users) — удержание недельных когорт.
+# /analytics читает только их. Старые данные один раз переносит backfill_analytics().
+FUNNEL_STAGES = ["start", "contact", "code", "reservation", "redeem"]
+FUNNEL_TITLES = {"start": "Запустили бота", "contact": "Оставили контакт", "code": "Получили код",
+                 "reservation": "Забронировали", "redeem": "Погасили приз"}
+
+# день -> кто уже отмечен в этот день, чтобы не писать в БД на каждый апдейт
+_activity_seen = venue_local("activity_seen", lambda v: {})
+
+
+def week_key(day: str) -> str:
+    d = datetime.strptime(day, "%Y-%m-%d").date()
+    return ymd(d - timedelta(days=d.weekday()))
+
+
+async def _bump(day: str, metric: str, value: int = 1):
+    await storage.execute("""
+        INSERT INTO analytics_daily (day, metric, value) VALUES (?, ?, ?)
+        ON CONFLICT (day, metric) DO UPDATE SET value = analytics_daily.value + excluded.value
+    """, (day, metric, value))
+
+
+async def _ensure_funnel(user_id: int, day: str, now: str):
+    if await storage.execute("""
+        INSERT INTO user_funnel (user_id, cohort_day, start_at) VALUES (?, ?, ?)
+        ON CONFLICT (user_id) DO NOTHING
+    """, (user_id, day, now)):
+        await _bump(day, "new")
+        await _bump(day, "fn:start")
+        await _bump(day, "ev:start")
+
+
+async def touch_activity(user_id: int):
+    """Отмечает гостя активным сегодня (первый апдейт за день пишет в БД, остальные — нет)."""
+    now = now_tz()
+    day = ymd(now)
+    if day not in _activity_seen:
+        _activity_seen.clear()
+        _activity_seen[day] = set()
+    if user_id in _activity_seen[day]:
+        return
+    async with storage.transaction():
+        await _ensure_funnel(user_id, day, now.isoformat())
+        if await storage.execute(
+                "INSERT INTO user_activity (user_id, day) VALUES (?, ?) ON CONFLICT DO NOTHING", (user_id, day)):
+            await _bump(day, "dau")
+            week = week_key(day)
+            if await storage.fetchval("SELECT COUNT(*) FROM user_activity WHERE user_id=? AND day BETWEEN ? AND ?",
+                                      (user_id, week, day), default=0) == 1:
+                cohort = await storage.fetchval("SELECT cohort_day FROM user_funnel WHERE user_id=?", (user_id,))
+                await storage.execute("""
+                    INSERT INTO cohort_weekly (cohort_week, week, users) VALUES (?, ?, 1)
+                    ON CONFLICT (cohort_week, week) DO UPDATE SET users = cohort_weekly.users + 1
+                """, (week_key(cohort), week))
+    _activity_seen[day].add(user_id)
+
+
+async def track(user_id: Optional[int], stage: str):
+    """Гость прошёл этап воронки: +1 событие дня, а если впервые — +1 к его когорте."""
+    if not user_id:
+        return
+    now = now_tz()
+    day = ymd(now)
+    async with storage.transaction():
+        await _ensure_funnel(user_id, day, now.isoformat())
+        await _bump(day, f"ev:{stage}")
+        if stage in FUNNEL_STAGES and await storage.execute(
+                f"UPDATE user_funnel SET {stage}_at=? WHERE user_id=? AND {stage}_at IS NULL", (now.isoformat(), user_id)):
+            cohort = await storage.fetchval("SELECT cohort_day FROM user_funnel WHERE user_id=?", (user_id,))
+            await _bump(cohort, f"fn:{stage}")
+
+
+class AnalyticsMiddleware(BaseMiddleware):
+    """После хендлера отмечает активность гостя. Висит на message/callback_query, то есть
+    внутри InflightMiddleware — запись успевает до остановки."""
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        result = await handler(event, data)
+        user = data.get("event_from_user")
+        if user and not user.is_bot:
+            try:
+                await touch_activity(user.id)
+            except Exception as e:
+                logger.warning("[ANALYTICS] activity %s: %s", user.id, e)
+        return result
+
+
+dp.message.outer_middleware(AnalyticsMiddleware())
+dp.callback_query.outer_middleware(AnalyticsMiddleware())
+
+
+async def backfill_analytics():
+    """Один раз строит агрегаты по уже накопленным данным (дату контакта не знаем — берём день регистрации)."""
+    if await storage.get_meta("analytics_backfill"):
+        return
+    started = time.monotonic()
+    async with storage.transaction():
+        # WHERE 1=1 в INSERT ... SELECT — иначе SQLite примет ON CONFLICT за часть JOIN
+        await storage.execute("""
+            INSERT INTO user_funnel (user_id, cohort_day, start_at)
+            SELECT user_id, substr(joined_at, 1, 10), joined_at FROM users WHERE 1=1
+            ON CONFLICT (user_id) DO NOTHING
+        """)
+        await storage.execute("""
+            UPDATE user_funnel SET contact_at = start_at
+            WHERE contact_at IS NULL AND user_id IN (SELECT user_id FROM guests)
+        """)
+        for stage, sql in (
+            ("code", "SELECT MIN(issued_at) FROM codes c WHERE c.user_id = user_funnel.user_id"),
+            ("reservation", "SELECT MIN(created_at) FROM reservations r WHERE r.user_id = user_funnel.user_id"),
+            ("redeem", "SELECT MIN(redeemed_at) FROM random_rewards w "
+                       "WHERE w.user_id = user_funnel.user_id AND w.redeemed = 1"),
+        ):
+            await storage.execute(f"UPDATE user_funnel SET {stage}_at = ({sql}) WHERE {stage}_at IS NULL")
+        for col in ("cohort_day", "substr(last_seen, 1, 10)"):
+            src = "user_funnel" if col == "cohort_day" else "users"
+            await storage.execute(f"""
+                INSERT INTO user_activity (user_id, day) SELECT user_id, {col} FROM {src} WHERE 1=1
+                ON CONFLICT DO NOTHING
+            """)
+        await storage.execute("DELETE FROM analytics_daily WHERE metric = 'dau' OR metric = 'new' OR metric LIKE 'fn:%'")
+        await storage.execute("""
+            INSERT INTO analytics_daily (day, metric, value)
+            SELECT day, 'dau', COUNT(*) FROM user_activity GROUP BY day
+        """)
+        await storage.execute("""
+            INSERT INTO analytics_daily (day, metric, value)
+            SELECT cohort_day, 'new', COUNT(*) FROM user_funnel GROUP BY cohort_day
+        """)
+        for stage in FUNNEL_STAGES:
+            await storage.execute(f"""
+                INSERT INTO analytics_daily (day, metric, value)
+                SELECT cohort_day, 'fn:{stage}', COUNT({stage}_at) FROM user_funnel GROUP BY cohort_day
+            """)
+        # удержание: первые активности гостя в каждой неделе
+        cohorts = dict(await storage.fetchall("SELECT user_id, cohort_day FROM user_funnel"))
+        weekly: dict[tuple[str, str], set] = {}
+        for uid, day in await storage.fetchall("SELECT user_id, day FROM user_activity"):
+            if uid in cohorts:
+                weekly.setdefault((week_key(cohorts[uid]), week_key(day)), set()).add(uid)
+        await storage.execute("DELETE FROM cohort_weekly")
+        await storage.executemany("INSERT INTO cohort_weekly (cohort_week, week, users) VALUES (?, ?, ?)",
+                                  [(c, w, len(u)) for (c, w), u in weekly.items()])
+        await storage.set_meta("analytics_backfill", now_tz().isoformat())
+    logger.info("[ANALYTICS] агрегаты построены по истории за %.1f с", time.monotonic() - started)
+
+
+async def active_users(start: str, end: str) -> int:
+    return await storage.fetchval("SELECT COUNT(DISTINCT user_id) FROM user_activity WHERE day BETWEEN ? AND ?",
+                                  (start, end), default=0)
+
+
+async def analytics_sums(start: str, end: str) -> dict[str, int]:
+    rows = await storage.fetchall("""
+        SELECT metric, SUM(value) FROM analytics_daily WHERE day BETWEEN ? AND ? GROUP BY metric
+    """, (start, end))
+    return {metric: int(value or 0) for metric, value in rows}
+
+
+@read_only
+async def analytics_report(start: str, end: str, weeks: int = 6) -> str:
+    started = time.perf_counter()
+    sums = await analytics_sums(start, end)
+    end_d = datetime.strptime(end, "%Y-%m-%d").date()
+    days = (end_d - datetime.strptime(start, "%Y-%m-%d").date()).days + 1
+    wau = await active_users(ymd(end_d - timedelta(days=6)), end)
+    mau = await active_users(ymd(end_d - timedelta(days=29)), end)
+    dau = await storage.fetchval("SELECT value FROM analytics_daily WHERE day=? AND metric='dau'", (end,), default=0)
+
+    def pct(a: int, b: int) -> str:
+        return f"{a * 100 / b:.0f}%" if b else "—"
+
+    lines = [f"📈 <b>Аналитика {start} — {end}</b> ({days} дн.)", "",
+             f"👥 DAU ({end}): <b>{dau}</b> · среднее за период: <b>{sums.get('dau', 0) / days:.1f}</b>",
+             f"👥 WAU: <b>{wau}</b> · MAU: <b>{mau}</b> · новых: <b>{sums.get('new', 0)}</b>", "",
+             "🔻 <b>Воронка гостей, пришедших в период</b>"]
+    # этапы не строго последовательны (код можно взять без брони), поэтому доля — от всех пришедших
+    base = sums.get("fn:start", 0)
+    for stage in FUNNEL_STAGES:
+        n = sums.get(f"fn:{stage}", 0)
+        lines.append(f"— {FUNNEL_TITLES[stage]}: <b>{n}</b>" + ("" if stage == "start" else f" ({pct(n, base)})"))
+    lines += ["", "📊 <b>События за период</b>",
+              f"— Кодов выдано: <b>{sums.get('ev:code', 0)}</b> · предъявлено на входе: <b>{sums.get('ev:visit', 0)}</b>"
+              f" ({pct(sums.get('ev:visit', 0), sums.get('ev:code', 0))})",
+              f"— Броней: <b>{sums.get('ev:reservation', 0)}</b>",
+              f"— Розыгрышей: <b>{sums.get('ev:luck', 0)}</b> · призов погашено: <b>{sums.get('ev:redeem', 0)}</b>"
+              f" ({pct(sums.get('ev:redeem', 0), sums.get('ev:luck', 0))})"]
+
+    # удержание: последние недельные когорты, заканчивая неделей end
+    last_week = week_key(end)
+    first_week = ymd(datetime.strptime(last_week, "%Y-%m-%d").date() - timedelta(weeks=weeks - 1))
+    rows = await storage.fetchall("""
+        SELECT cohort_week, week, users FROM cohort_weekly
+        WHERE cohort_week BETWEEN ? AND ? ORDER BY cohort_week, week
+    """, (first_week, last_week))
+    table: dict[str, dict[int, int]] = {}
+    for cohort, week, users in rows:
+        offset = (datetime.strptime(week, "%Y-%m-%d") - datetime.strptime(cohort, "%Y-%m-%d")).days // 7
+        table.setdefault(cohort, {})[offset] = users
+    if table:
+        lines += ["", "🔁 <b>Удержание по неделям</b> (когорта: размер | нед.1 нед.2 …)"]
+        for cohort, cells in table.items():
+            size = cells.get(0, 0)
+            tail = " ".join(pct(cells.get(i, 0), size) for i in range(1, max(cells) + 1))
+            lines.append(f"<code>{cohort[5:]}</code>: {size} | {tail or '—'}")
+    lines.append(f"\n⏱ {(time.perf_counter() - started) * 1000:.0f} мс")
+    return "\n".join(lines)
+
+
+def _analytics_range(args: list[str]) -> tuple[str, str]:
+    """'' → последние 7 дней; 'N' → последние N дней; 'YYYY-MM-DD [YYYY-MM-DD]' → период."""
+    today = now_tz().date()
+    if not args:
+        return ymd(today - timedelta(days=6)), ymd(today)
+    if len(args) == 1 and args[0].isdigit():
+        return ymd(today - timedelta(days=max(1, int(args[0])) - 1)), ymd(today)
+    start = datetime.strptime(args[0], "%Y-%m-%d").date()
+    end = datetime.strptime(args[1], "%Y-%m-%d").date() if len(args) > 1 else today
+    return ymd(min(start, end)), ymd(max(start, end))
+
+
+@dp.message(Command("analytics"))
+async def analytics_cmd(msg: Message):
+    if not is_admin(msg.from_user.id): return
+    try:
+        start, end = _analytics_range((msg.text or "").split()[1:3])
+    except ValueError:
+        return await msg.answer("Формат: <code>/analytics</code>, <code>/analytics 30</code> "
+                                "или <code>/analytics 2025-01-01 2025-01-31</code>")
+    await msg.answer(await analytics_report(start, end))
+
 
 # ===== Reservations =====
-def create_reservation(user_id: Optional[int], name: str, phone: str, covers: int, r_date: str, r_time: str, note: Optional[str]):
+async def create_reservation(user_id: Optional[int], name: str, phone: str, covers: int, r_date: str, r_time: str, note: Optional[str],
+                             op: Optional[str] = None):
+    """Создаёт бронь. Возвращает id или None, если на это время не осталось мест.
+
+    op — ключ операции (см. claim_op): повтор с тем же ключом даёт DuplicateOp с id первой брони."""
+    covers = max(1, covers)
+    if not capacity.can_book(r_date, r_time, covers):
+        return None
+    # место занимаем до await, чтобы параллельная бронь его уже не увидела
+    capacity.add(r_date, r_time, covers)
     now = now_tz().isoformat()
-    cur.execute("""
-        INSERT INTO reservations (user_id, guest_name, guest_phone, covers, r_date, r_time, note, status, created_at, updated_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, 'new', ?, ?)
-    """, (user_id, name.strip(), phone.strip(), max(1, covers), r_date, r_time, (note or None), now, now))
-    conn.commit()
-    return cur.lastrowid
-
-def get_reservations_by_date(r_date: str):
-    cur.execute("""
+    try:
+        async with storage.transaction():
+            if op:
+                await claim_op(user_id, op)
+            rid = await storage.insert("""
+                INSERT INTO reservations (user_id, guest_name, guest_phone, covers, r_date, r_time, note, status, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 'new', ?, ?)
+            """, (user_id, name.strip(), phone.strip(), covers, r_date, r_time, (note or None), now, now))
+            if op:
+                await set_op_result(user_id, op, rid)
+            await track(user_id, "reservation")
+        return rid
+    except Exception:
+        capacity.remove(r_date, r_time, covers)
+        raise
+
+@read_only
+async def get_reservations_by_date(r_date: str):
+    return await storage.fetchall("""
         SELECT id, guest_name, guest_phone, covers, r_time, status, note
         FROM reservations WHERE r_date=? ORDER BY r_time ASC
     """, (r_date,))
-    return cur.fetchall()
 
-def find_reservations_by_phone(phone: str):
-    cur.execute("""
+@read_only
+async def find_reservations_by_phone(phone: str):
+    return await storage.fetchall("""
         SELECT id, guest_name, guest_phone, covers, r_date, r_time, status
         FROM reservations WHERE guest_phone LIKE ?
         ORDER BY r_date DESC, r_time DESC
     """, (f"%{phone}%",))
-    return cur.fetchall()
 
-def set_res_status(res_id: int, status: str):
-    cur.execute("UPDATE reservations SET status=?, updated_at=? WHERE id=?", (status, now_tz().isoformat(), res_id))
-    conn.commit()
+async def set_res_status(res_id: int, status: str):
+    async with storage.transaction():
+        row = await storage.fetchone("SELECT r_date, r_time, covers, status FROM reservations WHERE id=?", (res_id,))
+        await storage.execute("UPDATE reservations SET status=?, updated_at=? WHERE id=?", (status, now_tz().isoformat(), res_id))
+    if row:
+        r_date, r_time, covers, old_status = row
+        if old_status != "cancelled" and status == "cancelled":
+            capacity.remove(r_date, r_time, covers)
+        elif old_status == "cancelled" and status != "cancelled":
+            capacity.add(r_date, r_time, covers)
+
+def bench_capacity(days: int = 31, bookings: int = 6000, queries: int = 200_000):
+    """Бенчмарк проверок доступности: индекс в памяти против SQL-агрегата.
+
+    Запуск: python bot.py --bench-capacity"""
+    rng = random.Random(42)
+    idx = CapacityIndex(RES_SLOT_MINUTES, RES_SLOTS_START, RES_SLOTS_END, 10**9, 10**9)
+    slots = [idx.fmt_slot(s) for s in idx.slots()]
+    start = now_tz().date()
+    dates = [ymd(start + timedelta(days=i)) for i in range(days)]
+    rows = [(rng.choice(dates), rng.choice(slots), rng.randint(1, 8)) for _ in range(bookings)]
+
+    mem = sqlite3.connect(":memory:")
+    mem.execute("CREATE TABLE reservations (r_date TEXT, r_time TEXT, covers INTEGER, status TEXT)")
+    mem.execute("CREATE INDEX idx_res_date ON reservations(r_date)")
+    mem.executemany("INSERT INTO reservations VALUES (?, ?, ?, 'new')", rows)
+
+    t0 = time.perf_counter()
+    idx.warm(rows)
+    warm_s = time.perf_counter() - t0
+
+    probes = [(rng.choice(dates), rng.choice(slots)) for _ in range(queries)]
+    t0 = time.perf_counter()
+    for d, t in probes:
+        idx.free_seats(d, t)
+    mem_ns = (time.perf_counter() - t0) / queries * 1e9
+
+    t0 = time.perf_counter()
+    for d, _ in probes[:2000]:
+        idx.open_slots(d)
+    slots_us = (time.perf_counter() - t0) / 2000 * 1e6
+
+    sql_n = min(queries, 5000)
+    t0 = time.perf_counter()
+    for d, t in probes[:sql_n]:
+        mem.execute("SELECT COALESCE(SUM(covers), 0) FROM reservations WHERE r_date=? AND r_time=? AND status != 'cancelled'", (d, t)).fetchone()
+        mem.execute("SELECT COALESCE(SUM(covers), 0) FROM reservations WHERE r_date=? AND status != 'cancelled'", (d,)).fetchone()
+    sql_ns = (time.perf_counter() - t0) / sql_n * 1e9
+    mem.close()
+
+    logger.info("[BENCH] capacity: %d броней за %d дн., прогрев %.1f мс", bookings, days, warm_s * 1000)
+    logger.info("[BENCH] free_seats (индекс): %.0f нс/запрос на %d запросов", mem_ns, queries)
+    logger.info("[BENCH] open_slots (индекс): %.1f мкс/день", slots_us)
+    logger.info("[BENCH] SQL SUM по дате+слоту: %.0f нс/запрос (x%.0f медленнее)", sql_ns, sql_ns / max(mem_ns, 1))
 
 # ===== Notifications =====
 def _notify_targets() -> List[Union[int, str]]:
-    targets = list(ADMIN_NOTIFY_CHAT_IDS) + [x for x in ADMIN_IDS]
+    targets = list(venue.ADMIN_NOTIFY_CHAT_IDS) + [x for x in venue.ADMIN_IDS]
     seen = set()
     res = []
     for t in targets:
@@ -482,7 +3021,7 @@ async def notify_admins(text: str, kb: Optional[InlineKeyboardBuilder] = None):
             else:
                 await bot.send_message(cid, text, disable_web_page_preview=True)
         except Exception as e:
-            print(f"[NOTIFY][ERROR] chat_id={cid}: {e}")
+            logger.error("[NOTIFY] chat_id=%s: %s", cid, e)
 
     # ===== Button labels (constants) =====
 BTN_REG  = "🧾 Регистрация"
@@ -502,7 +3041,7 @@ def main_reply_kb() -> ReplyKeyboardMarkup:
             [KeyboardButton(text=BTN_CODE), KeyboardButton(text=BTN_RES)],
             [KeyboardButton(text=BTN_LUCK), KeyboardButton(text=BTN_PRIZE)],
             [KeyboardButton(text=BTN_MENU), KeyboardButton(text=BTN_ADDR)],
-            [KeyboardButton(text=BTN_FEED)]
+            [KeyboardButton(text=BTN_FEED), KeyboardButton(text=BTN_MY_CARD)]
         ],
         resize_keyboard=True,
         one_time_keyboard=False,
@@ -517,38 +3056,123 @@ def inline_main_kb() -> InlineKeyboardBuilder:
     kb.button(text=BTN_RES,  callback_data="reserve")
     kb.button(text=BTN_ADDR, callback_data="address")
     kb.button(text=BTN_MENU, callback_data="menu_food")
-    kb.button(text=BTN_ACT,  url=CHANNEL_URL)
+    kb.button(text=BTN_ACT,  url=venue.CHANNEL_URL)
     kb.button(text=BTN_LUCK, callback_data="try_luck")
     kb.adjust(1)
     return kb
 
-def admin_panel_kb() -> InlineKeyboardBuilder:
-    kb = InlineKeyboardBuilder()
+# ===== Flood throttling =====
+# Лимиты по действиям: "действие=запросов/секунд", например "luck=2/60,code=4/60,prize=4/60"
+def _parse_throttle_limits(raw: str) -> dict[str, tuple[float, float]]:
+    out: dict[str, tuple[float, float]] = {}
+    for part in (raw or "").split(","):
+        name, _, spec = part.strip().partition("=")
+        burst, _, period = spec.partition("/")
+        try:
+            burst_f, period_f = float(burst), float(period)
+        except ValueError:
+            continue
+        if name and burst_f > 0 and period_f > 0:
+            out[name.strip()] = (burst_f, period_f)
+    return out
+
+THROTTLE_LIMITS = _parse_throttle_limits(os.getenv("THROTTLE_LIMITS", "luck=2/60,code=4/60,prize=4/60,card=6/60"))
+THROTTLE_MAX_KEYS = int(os.getenv("THROTTLE_MAX_KEYS", "10000"))
 
-    # Раздел "Брони"
-    kb.button(text="📅 Брони на сегодня", callback_data="adm_today")
-    kb.button(text="📊 Статистика за день", callback_data="adm_stats")
+# какие апдейты к какому действию относятся (текст кнопки / команда / callback_data)
+THROTTLE_ACTIONS = {
+    BTN_LUCK: "luck", "try_luck": "luck",
+    BTN_CODE: "code", "/code": "code", "get_code": "code",
+    BTN_PRIZE: "prize",
+    BTN_MY_CARD: "card",
+}
 
-    # Раздел "Пользователи"
-    kb.button(text="👥 Пользователи", callback_data="adm_users")
-    kb.button(text="🧊 Неактивные", callback_data="adm_inactive")
 
-    # Раздел "Призы"
-    kb.button(text="🎁 Список призов", callback_data="adm_prizes")
-    kb.button(text="➕ Добавить приз", callback_data="adm_add_prize")
+class _Bucket:
+    __slots__ = ("tokens", "updated", "warned_until")
 
-    # Раздел "Техническое"
-    kb.button(text="🔑 Проверить / Удалить код", callback_data="redeem_code")
-    kb.button(text="🧹 Очистить коды", callback_data="adm_purge")
-    kb.button(text="♻️ Перезапуск", callback_data="adm_restart")
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+        self.warned_until = 0.0
 
-    kb.adjust(2)
-    return kb
 
+class ThrottleMiddleware(BaseMiddleware):
+    """Token bucket на (user_id, действие) для дорогих кнопок.
+
+    Бакеты живут в LRU (OrderedDict) не больше THROTTLE_MAX_KEYS штук.
+    Ответ «не так быстро» отправляется не чаще одного раза, пока бакет пуст;
+    остальные лишние нажатия просто отбрасываются. Админы не ограничиваются."""
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self.buckets: "OrderedDict[tuple[int, str], _Bucket]" = OrderedDict()
+
+    @staticmethod
+    def _action(event: TelegramObject) -> Optional[str]:
+        if isinstance(event, CallbackQuery):
+            return THROTTLE_ACTIONS.get(event.data or "")
+        if isinstance(event, Message) and event.text:
+            key = event.text.strip()
+            if key.startswith("/"):
+                key = key.split()[0].split("@")[0]
+            return THROTTLE_ACTIONS.get(key)
+        return None
+
+    def hit(self, user_id: int, action: str, now: float) -> tuple[bool, float, bool]:
+        """Списывает токен. Возвращает (пропустить, сколько ждать, нужно ли предупредить)."""
+        limit = THROTTLE_LIMITS.get(action)
+        if not limit:
+            return True, 0.0, False
+        burst, period = limit
+        rate = burst / period
+        key = (user_id, action)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = _Bucket(burst, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+            bucket.updated = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return True, 0.0, False
+        retry_after = (1 - bucket.tokens) / rate
+        warn = now >= bucket.warned_until
+        if warn:
+            bucket.warned_until = now + retry_after
+        return False, retry_after, warn
+
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        action = self._action(event)
+        user = data.get("event_from_user")
+        if not action or not user or is_admin(user.id):
+            return await handler(event, data)
+        allowed, retry_after, warn = self.hit(user.id, action, time.monotonic())
+        metrics.set("throttle_buckets", len(self.buckets))
+        if allowed:
+            return await handler(event, data)
+        metrics.inc("throttled_total", action=action)
+        text = f"⏳ Не так быстро! Попробуйте через {max(1, int(retry_after + 0.999))} сек."
+        try:
+            if isinstance(event, CallbackQuery):
+                await event.answer(text if warn else None)
+            elif warn:
+                await event.answer(text)
+        except Exception as e:
+            logger.warning("[THROTTLE] не удалось ответить: %s", e)
+        return None
+
+
+throttle_mw = ThrottleMiddleware(THROTTLE_MAX_KEYS)
+dp.message.outer_middleware(throttle_mw)
+dp.callback_query.outer_middleware(throttle_mw)
 
 
 # ===== Commands =====
-async def set_commands():
+async def set_commands(force: bool = False):
     # Команды для обычных пользователей
     user_cmds = [
         BotCommand(command="start", description="Главное меню"),
@@ -559,29 +3183,36 @@ async def set_commands():
     admin_cmds = [
         BotCommand(command="admin", description="Админ-панель"),
         BotCommand(command="stats", description="Быстрый отчёт за день"),
+        BotCommand(command="settings", description="⚙️ Настройки"),
         BotCommand(command="restart", description="♻️ Перезапуск бота"),
     ]
+    # те же команды и админы, что при прошлом запуске — не дёргаем Telegram API
+    fingerprint = hashlib.sha1(repr((
+        [(c.command, c.description) for c in user_cmds + admin_cmds], sorted(venue.ADMIN_IDS), bot.id,
+    )).encode()).hexdigest()[:16]
+    if not force and await storage.get_meta("commands_fingerprint") == fingerprint:
+        return
+
     await bot.set_my_commands(user_cmds, scope=BotCommandScopeDefault())
     await bot.set_my_commands(admin_cmds)
 
 
 
-    for admin_id in ADMIN_IDS:
+    for admin_id in venue.ADMIN_IDS:
         try:
             await bot.set_my_commands(admin_cmds, scope=BotCommandScopeChat(chat_id=admin_id))
         except Exception:
             pass
+    await storage.set_meta("commands_fingerprint", fingerprint)
 
 # ===== Access gate =====
 async def _guard_access_and_notify_admins(msg: Message) -> bool:
-    if is_blocked(msg.from_user.id):
+    if await is_blocked(msg.from_user.id):
         await msg.answer("Доступ закрыт.")
         return True
-    if ACCESS_MODE == "closed":
-        cur.execute("SELECT approved FROM users WHERE user_id=?", (msg.from_user.id,))
-        r = cur.fetchone()
-        if not (r and r[0]):
-            await msg.answer(ACCESS_HINT)
+    if venue.ACCESS_MODE == "closed":
+        if not await is_approved(msg.from_user.id):
+            await msg.answer(venue.ACCESS_HINT)
             kb = InlineKeyboardBuilder()
             kb.button(text=f"✅ Одобрить {msg.from_user.id}", callback_data=f"approve:{msg.from_user.id}")
             kb.button(text=f"⛔ Заблокировать {msg.from_user.id}", callback_data=f"block:{msg.from_user.id}")
@@ -591,7 +3222,7 @@ async def _guard_access_and_notify_admins(msg: Message) -> bool:
                 f"ID: <code>{msg.from_user.id}</code>\n"
                 f"Имя: {msg.from_user.first_name or ''} {msg.from_user.last_name or ''} @{msg.from_user.username or ''}"
             )
-            for admin_id in ADMIN_IDS:
+            for admin_id in venue.ADMIN_IDS:
                 try:
                     await bot.send_message(admin_id, txt, reply_markup=kb.as_markup())
                 except Exception:
@@ -604,17 +3235,14 @@ async def cmd_start(msg: Message):
     user_id = msg.from_user.id
     name = msg.from_user.full_name
 
-    upsert_user_from_tg(msg)
+    await upsert_user_from_tg(msg)
 
     # Проверка доступа (ожидает модерации — выход)
     if await _guard_access_and_notify_admins(msg):
         return
 
     # ✅ Если доступ есть, проверяем — есть ли уже номер
-    cur.execute("SELECT 1 FROM guests WHERE user_id = ?", (user_id,))
-    has_phone = cur.fetchone()
-
-    if not has_phone:
+    if not await is_registered(user_id):
         kb = ReplyKeyboardMarkup(
             keyboard=[[KeyboardButton(text="📱 Поделиться номером", request_contact=True)]],
             resize_keyboard=True
@@ -634,11 +3262,6 @@ async def cmd_start(msg: Message):
 )
 
 
-def is_registered(user_id: int) -> bool:
-    cur.execute("SELECT 1 FROM guests WHERE user_id = ?", (user_id,))
-    return bool(cur.fetchone())
-
-
 @dp.message(F.text == BTN_REG)
 async def btn_register_guest(msg: Message):
     kb = ReplyKeyboardMarkup(
@@ -649,7 +3272,7 @@ async def btn_register_guest(msg: Message):
     
 @dp.message(F.text == BTN_FEED)
 async def feedback_start(msg: Message):
-    if not is_registered(msg.from_user.id):
+    if not await is_registered(msg.from_user.id):
         await msg.answer("⛔ Сначала зарегистрируйтесь — нажмите /start и отправьте номер телефона.")
         return
 
@@ -663,7 +3286,7 @@ async def feedback_start(msg: Message):
 
 @dp.message(F.text == BTN_CODE)
 async def btn_get_code(msg: Message):
-    if not is_registered(msg.from_user.id):
+    if not await is_registered(msg.from_user.id):
         await msg.answer("⛔ Сначала зарегистрируйтесь — нажмите /start и отправьте номер телефона.")
         return
     await code_cmd(msg)
@@ -671,29 +3294,28 @@ async def btn_get_code(msg: Message):
 
 @dp.message(F.text == BTN_RES)
 async def btn_reserve(msg: Message):
-    if not is_registered(msg.from_user.id):
+    if not await is_registered(msg.from_user.id):
         await msg.answer("⛔ Сначала зарегистрируйтесь — нажмите /start и отправьте номер телефона.")
         return
     await start_reserve_flow_from_message(msg)
 
 @dp.message(F.text == BTN_MENU)
 async def btn_menu_food(msg: Message):
-    if not is_registered(msg.from_user.id):
+    if not await is_registered(msg.from_user.id):
         await msg.answer("⛔ Сначала зарегистрируйтесь — нажмите /start и отправьте номер телефона.")
         return
 
-    url = "https://Shishkaone.myresto.online"
-    await msg.answer(
-        f"🍽 <b>Меню ресторана SHISHKA RESTOBAR</b>\n\n"
-        f"Ознакомьтесь с блюдами и напитками по ссылке ниже 👇\n"
-        f"🔗 <a href='{url}'>Открыть меню</a>",
-        disable_web_page_preview=False
-    )
+    url = cfg("menu_url")
+    text = (f"🍽 <b>Меню ресторана SHISHKA RESTOBAR</b>\n\n"
+            f"Ознакомьтесь с блюдами и напитками по ссылке ниже 👇\n"
+            f"🔗 <a href='{url}'>Открыть меню</a>")
+    if not await send_asset(msg.chat.id, "asset:menu_cover", ASSET_MENU_COVER_PATH, text):
+        await msg.answer(text, disable_web_page_preview=False)
 
 
 @dp.message(F.text == BTN_LUCK)
 async def btn_try_luck(msg: Message):
-    if not is_registered(msg.from_user.id):
+    if not await is_registered(msg.from_user.id):
         await msg.answer("⛔ Сначала зарегистрируйтесь — нажмите /start и отправьте номер телефона.")
         return
     await run_try_luck_from_message(msg)
@@ -701,25 +3323,229 @@ async def btn_try_luck(msg: Message):
 
 @dp.message(F.text == BTN_ACT)
 async def btn_promos_exact(msg: Message):
-    if not is_registered(msg.from_user.id):
+    if not await is_registered(msg.from_user.id):
         await msg.answer("⛔ Сначала зарегистрируйтесь — нажмите /start и отправьте номер телефона.")
         return
-    await msg.answer("🎉 Акции / события: следите в нашем канале!\n" + CHANNEL_URL)
+    await msg.answer("🎉 Акции / события: следите в нашем канале!\n" + venue.CHANNEL_URL)
 
 @dp.message(F.text == BTN_ADDR)
 async def btn_address(msg: Message):
-    if not is_registered(msg.from_user.id):
+    if not await is_registered(msg.from_user.id):
         await msg.answer("⛔ Сначала зарегистрируйтесь — нажмите /start и отправьте номер телефона.")
         return
     kb = InlineKeyboardBuilder()
-    kb.button(text="🗺 Открыть на карте", url=MAP_URL)
+    kb.button(text="🗺 Открыть на карте", url=venue.MAP_URL)
     kb.adjust(1)
-    await msg.answer(
-        f"📍 <b>{ADDRESS}</b>\n"
-        "Ждём вас в Shishka Restobar 🍸",
-        reply_markup=kb.as_markup()
-    )
-    
+    text = f"📍 <b>{venue.ADDRESS}</b>\nЖдём вас в Shishka Restobar 🍸"
+    if not await send_asset(msg.chat.id, "asset:map", ASSET_MAP_PATH, text, reply_markup=kb.as_markup()):
+        await msg.answer(text, reply_markup=kb.as_markup())
+
+# ===== Loyalty card (iiko cache) =====
+IIKO_CACHE_FRESH    = float(os.getenv("IIKO_CACHE_FRESH", "300"))      # сек: отдаём без обновления
+IIKO_CACHE_HARD_TTL = float(os.getenv("IIKO_CACHE_HARD_TTL", "86400")) # сек: старше — только живой запрос
+IIKO_NEGATIVE_TTL   = float(os.getenv("IIKO_NEGATIVE_TTL", "600"))     # сек: помним «нет в iiko»
+IIKO_CACHE_MAX      = int(os.getenv("IIKO_CACHE_MAX", "5000"))
+
+
+class _CardEntry:
+    __slots__ = ("info", "fetched_at")
+
+    def __init__(self, info: Optional[dict], fetched_at: float):
+        self.info = info              # None — гостя нет в iiko (negative cache)
+        self.fetched_at = fetched_at
+
+
+class IikoCardCache:
+    """stale-while-revalidate кэш customer/info по нормализованному телефону.
+
+    Свежая запись отдаётся сразу; устаревшая (старше IIKO_CACHE_FRESH) тоже отдаётся
+    сразу, а в фоне запускается одно обновление на ключ. Старше IIKO_CACHE_HARD_TTL
+    или промах — ждём живой запрос. Ошибки iiko не кэшируются."""
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self.entries: "OrderedDict[str, _CardEntry]" = OrderedDict()
+        self.inflight: dict[str, asyncio.Task] = {}
+
+    def _put(self, key: str, info: Optional[dict]):
+        self.entries[key] = _CardEntry(info, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_keys:
+            self.entries.popitem(last=False)
+        metrics.set("iiko_cache_size", len(self.entries))
+
+    async def _fetch(self, key: str) -> Optional[dict]:
+        started = time.monotonic()
+        try:
+            info = await asyncio.to_thread(fetch_iiko_customer, "+" + key)
+        finally:
+            metrics.inc("iiko_fetch_seconds_total", time.monotonic() - started)
+        self._put(key, info)
+        return info
+
+    def _refresh(self, key: str) -> asyncio.Task:
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = asyncio.create_task(self._fetch(key))
+            task.add_done_callback(lambda t: self._refresh_done(key, t))
+        return task
+
+    def _refresh_done(self, key: str, task: asyncio.Task):
+        self.inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            metrics.inc("iiko_cache_total", result="error")
+            iiko_log.warning("[IIKO] обновление %s: %s", key, task.exception())
+
+    async def get(self, phone: str) -> tuple[Optional[dict], Optional[float]]:
+        """(info, возраст данных в секундах). IikoError — если отдать нечего."""
+        key = normalize_phone(phone)
+        entry = self.entries.get(key)
+        age = time.monotonic() - entry.fetched_at if entry else None
+        if entry is not None and entry.info is None and age < IIKO_NEGATIVE_TTL:
+            metrics.inc("iiko_cache_total", result="negative")
+            return None, age
+        if entry is not None and entry.info is not None and age < IIKO_CACHE_HARD_TTL:
+            self.entries.move_to_end(key)
+            if age < IIKO_CACHE_FRESH:
+                metrics.inc("iiko_cache_total", result="hit")
+            else:
+                metrics.inc("iiko_cache_total", result="stale")
+                self._refresh(key)
+            return entry.info, age
+        # промах или старше жёсткого TTL: ждём живой запрос (ошибку iiko пробрасываем)
+        metrics.inc("iiko_cache_total", result="miss")
+        # shield: отмена ожидающего хендлера не должна обрывать общий запрос
+        return await asyncio.shield(self._refresh(key)), 0.0
+
+
+iiko_cards = IikoCardCache(IIKO_CACHE_MAX)
+
+
+def _card_fields(info: dict) -> tuple[Optional[str], Optional[float], Optional[str]]:
+    """(номер карты, баланс, уровень) из ответа customer/info."""
+    cards = info.get("cards") or []
+    number = (cards[0].get("number") or cards[0].get("Number")) if cards else None
+    wallets = info.get("walletBalances") or []
+    balance = info.get("balance")
+    if wallets:
+        try:
+            balance = sum(float(w.get("balance") or 0) for w in wallets)
+        except (TypeError, ValueError):  # нечисловой баланс кошелька — покажем как есть
+            balance = ", ".join(str(w.get("balance")) for w in wallets)
+    categories = info.get("categories") or []
+    level = ", ".join(c.get("name", "") for c in categories if c.get("name")) or None
+    return number, balance, level
+
+
+@dp.message(F.text == BTN_MY_CARD)
+async def btn_my_card(msg: Message):
+    contact = await _guest_contact(msg.from_user.id)
+    if not contact:
+        await msg.answer("⛔ Сначала зарегистрируйтесь — нажмите /start и отправьте номер телефона.")
+        return
+    try:
+        info, age = await iiko_cards.get(contact[1])
+    except IikoError:
+        await msg.answer("😔 Не удалось получить данные карты. Попробуйте чуть позже.")
+        return
+    if not info:
+        await msg.answer("📇 Карта гостя по вашему номеру не найдена.\nОформите её у администратора Shishka Restobar 🍸")
+        return
+    await msg.answer(card_text(info, contact[0], age))
+
+
+def card_text(info: dict, fallback_name: str, age: Optional[float]) -> str:
+    number, balance, level = _card_fields(info)
+    # имя/номер/уровень — из iiko и от гостя: без экранирования «<» или «&» ломают разбор HTML
+    lines = ["📇 <b>Моя карта</b>", f"👤 {html.escape(str(info.get('name') or fallback_name))}"]
+    if number:
+        lines.append(f"💳 Номер: <code>{html.escape(str(number))}</code>")
+    if balance is not None:
+        try:
+            shown = f"{float(balance):g}"
+        except (TypeError, ValueError):  # iiko прислал пустую строку или не число
+            shown = html.escape(str(balance)) or "—"
+        lines.append(f"💰 Баланс: <b>{shown}</b>")
+    if level:
+        lines.append(f"⭐ Уровень: <b>{html.escape(str(level))}</b>")
+    if age and age >= IIKO_CACHE_FRESH:
+        lines.append(f"\n🕒 Данные на {max(1, int(age // 60))} мин назад, обновляются…")
+    return "\n".join(lines)
+
+
+async def iiko_selftest() -> bool:
+    """Карта гостя против заглушки iiko на 127.0.0.1: разбор ответа, экранирование, кэш, ошибки.
+
+    Запуск: python bot.py --iiko-selftest"""
+    global IIKO_BASE_URL
+    ok = True
+
+    def check(cond: bool, what: str):
+        nonlocal ok
+        ok = ok and cond
+        logger.info("[SELFTEST] %s %s", "OK  " if cond else "FAIL", what)
+
+    customers = {
+        "998900000001": {"name": "Азиз", "cards": [{"number": "777"}], "walletBalances": [{"balance": 10}, {"balance": 2.5}],
+                         "categories": [{"name": "Gold"}]},
+        "998900000002": {"name": "<A & B>", "balance": None},
+        "998900000003": {"name": "C", "balance": ""},
+        "998900000004": {"name": "D", "walletBalances": [{"balance": "n/a"}]},
+    }
+    hits: list[str] = []
+
+    async def token(request):
+        return web.json_response({"token": "t"})
+
+    async def info(request):
+        phone = normalize_phone((await request.json()).get("phone"))
+        hits.append(phone)
+        if phone == "998900000500":
+            return web.Response(status=500)
+        if phone not in customers:
+            return web.Response(status=404)
+        return web.json_response(customers[phone])
+
+    app = web.Application()
+    app.router.add_get("/auth/access_token", token)
+    app.router.add_post("/loyalty/customer/info", info)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    saved_url, IIKO_BASE_URL = IIKO_BASE_URL, f"http://127.0.0.1:{port}"
+    cache = IikoCardCache(100)
+    try:
+        data, _ = await cache.get("+998 90 000-00-01")
+        text = card_text(data, "guest", 0)
+        check("777" in text and "12.5" in text and "Gold" in text, "карта: номер, сумма кошельков, уровень")
+        await cache.get("998900000001")
+        check(hits.count("998900000001") == 1, "повторный запрос — из кэша")
+        data, _ = await cache.get("998900000002")
+        check("&lt;A &amp; B&gt;" in card_text(data, "guest", 0) and "Баланс" not in card_text(data, "guest", 0),
+              "имя экранировано, balance=null не показан")
+        data, _ = await cache.get("998900000003")
+        check("Баланс: <b>—</b>" in card_text(data, "guest", 0), "пустой баланс → «—»")
+        data, _ = await cache.get("998900000004")
+        check("Баланс: <b>n/a</b>" in card_text(data, "guest", 0), "нечисловой баланс кошелька — как есть")
+        data, _ = await cache.get("998900000009")
+        await cache.get("998900000009")
+        check(data is None and hits.count("998900000009") == 1, "нет в iiko → None и negative-кэш")
+        for _ in range(2):
+            try:
+                await cache.get("998900000500")
+                check(False, "HTTP 500 → IikoError")
+            except IikoError:
+                pass
+        check(hits.count("998900000500") == 2, "HTTP 500 → IikoError, ошибка не кэшируется")
+    except Exception as e:
+        check(False, f"{type(e).__name__}: {e}")
+    finally:
+        IIKO_BASE_URL = saved_url
+        await runner.cleanup()
+    return ok
+
 @dp.message(Command("version"))
 async def version(msg: Message):
     await msg.answer(APP_VERSION)
@@ -728,17 +3554,34 @@ async def version(msg: Message):
 async def feedback_done(msg: Message):
     WAIT_FEEDBACK.pop(msg.from_user.id, None)
     await msg.answer("✅ Спасибо за отзыв! Мы его посмотрим как можно скорее.")
-async def _send_to_owner(text: str = "", photo_file_id: str | None = None):
+
+def _owner_targets() -> list[Union[int, str]]:
     # ЛИЧНО ТЕБЕ: отправляем всем ADMIN_IDS; если пусто — в первый из ADMIN_NOTIFY_CHAT_IDS
-    targets: list[Union[int, str]] = ADMIN_IDS[:] or (ADMIN_NOTIFY_CHAT_IDS[:1])
-    for cid in targets:
+    return venue.ADMIN_IDS[:] or (venue.ADMIN_NOTIFY_CHAT_IDS[:1])
+
+async def _send_to_owner(text: str = "", photo_file_id: str | None = None):
+    for cid in _owner_targets():
         try:
             if photo_file_id:
                 await bot.send_photo(cid, photo=photo_file_id, caption=text or " ")
             else:
                 await bot.send_message(cid, text, disable_web_page_preview=True)
         except Exception as e:
-            print("[FEEDBACK][ERROR]", e)
+            logger.error("[FEEDBACK] %s", e)
+
+async def _send_album_to_owner(caption: str, photo_file_ids: list[str]):
+    """Одно send_media_group на админа вместо send_photo на каждое фото."""
+    for cid in _owner_targets():
+        for i in range(0, len(photo_file_ids), 10):  # лимит Telegram — 10 медиа в альбоме
+            chunk = photo_file_ids[i:i + 10]
+            media = [
+                InputMediaPhoto(media=fid, caption=caption[:1024] if (i == 0 and j == 0) else None)
+                for j, fid in enumerate(chunk)
+            ]
+            try:
+                await bot.send_media_group(cid, media=media)
+            except Exception as e:
+                logger.error("[FEEDBACK] альбом для %s: %s", cid, e)
 
 def _fmt_user_line(m: Message) -> str:
     u = m.from_user
@@ -746,67 +3589,241 @@ def _fmt_user_line(m: Message) -> str:
     uname = f"@{u.username}" if u.username else ""
     return f"👤 {name} {uname}\n🆔 <code>{u.id}</code>"
 
-@dp.message(lambda m: m.from_user and m.from_user.id in WAIT_FEEDBACK and (m.text or m.caption))
-async def feedback_text(msg: Message):
-    # текст/подпись
-    text = (msg.text or msg.caption or "").strip()
-    header = "💬 <b>Новый отзыв</b>\n" + _fmt_user_line(msg)
-    body = f"\n\n{text}" if text else ""
-    await _send_to_owner(header + body)
-    # подтверждение гостю (можно убрать, если много сообщений)
-    await msg.answer("✅ Большое спасибо.")
+# ===== Feedbacks storage =====
+async def save_feedback(user_id: int, text: Optional[str], photo_id: Optional[str] = None,
+                        media_group_id: Optional[str] = None) -> int:
+    return await storage.insert("""
+        INSERT INTO feedbacks (user_id, text, photo_id, media_group_id, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, (user_id, (text or None), photo_id, media_group_id, now_tz().isoformat()))
+
+async def save_feedback_album(user_id: int, caption: Optional[str], photo_ids: list[str], media_group_id: str):
+    now = now_tz().isoformat()
+    async with storage.transaction():
+        await storage.executemany("""
+            INSERT INTO feedbacks (user_id, text, photo_id, media_group_id, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(user_id, (caption or None) if i == 0 else None, fid, media_group_id, now)
+              for i, fid in enumerate(photo_ids)])
+
+# один «пункт» инбокса — либо одиночная запись, либо весь альбом
+_FEEDBACK_ITEM_KEY = "COALESCE(media_group_id, 'id' || id)"
+
+async def count_feedback_items() -> int:
+    return await storage.fetchval(f"SELECT COUNT(DISTINCT {_FEEDBACK_ITEM_KEY}) FROM feedbacks", default=0)
+
+@read_only
+async def get_feedback_items(offset: int, limit: int):
+    return await storage.fetchall(f"""
+        SELECT MIN(id), MIN(user_id), MIN(created_at), {storage.string_agg('text', ' ')}, COUNT(photo_id)
+        FROM feedbacks
+        GROUP BY {_FEEDBACK_ITEM_KEY}
+        ORDER BY MIN(id) DESC
+        LIMIT ? OFFSET ?
+    """, (limit, offset))
+
+async def get_feedback_photos(feedback_id: int) -> list[str]:
+    rows = await storage.fetchall("""
+        SELECT photo_id FROM feedbacks
+        WHERE photo_id IS NOT NULL
+          AND (id = ? OR media_group_id = (SELECT media_group_id FROM feedbacks WHERE id = ?))
+        ORDER BY id ASC
+    """, (feedback_id, feedback_id))
+    return [r[0] for r in rows]
+
+# ===== Feedback albums =====
+FEEDBACK_ALBUM_WINDOW = float(os.getenv("FEEDBACK_ALBUM_WINDOW", "1.5"))  # сек. ожидания остальных фото альбома
+
+# (user_id, media_group_id) -> {"msg": первое сообщение, "photos": [...], "captions": [...], "task": таймер}
+FEEDBACK_ALBUMS = venue_local("feedback_albums", lambda v: {})   # (user_id, media_group_id) -> буфер
+
+async def _flush_feedback_album(key: tuple[int, str], delay: float):
+    await asyncio.sleep(delay)
+    album = FEEDBACK_ALBUMS.pop(key, None)
+    if not album:
+        return
+    msg: Message = album["msg"]
+    caption = "\n".join(album["captions"]).strip()
+    try:
+        await save_feedback_album(msg.from_user.id, caption, album["photos"], key[1])
+    except Exception as e:
+        logger.error("[FEEDBACK] не удалось сохранить альбом: %s", e)
+    header = f"🖼 <b>Фото к отзыву</b> ({len(album['photos'])} шт.)\n" + _fmt_user_line(msg)
+    await _send_album_to_owner(header + (f"\n\n{caption}" if caption else ""), album["photos"])
+    try:
+        await msg.answer(f"🖼 Фото получено: {len(album['photos'])} шт.")
+    except Exception as e:
+        logger.warning("[FEEDBACK] не удалось ответить гостю: %s", e)
+
+async def flush_feedback_albums():
+    """Досрочно отправляет все накопленные альбомы (при остановке бота)."""
+    for key, album in list(FEEDBACK_ALBUMS.items()):
+        album["task"].cancel()
+        await _flush_feedback_album(key, 0)
 
 @dp.message(lambda m: m.from_user and m.from_user.id in WAIT_FEEDBACK and m.photo)
 async def feedback_photo(msg: Message):
     # берём самое большое фото
     file_id = msg.photo[-1].file_id
     caption = (msg.caption or "").strip()
+    if msg.media_group_id:
+        # копим альбом и отправляем его целиком, когда фото перестанут приходить
+        key = (msg.from_user.id, msg.media_group_id)
+        album = FEEDBACK_ALBUMS.setdefault(key, {"msg": msg, "photos": [], "captions": [], "task": None})
+        album["photos"].append(file_id)
+        if caption:
+            album["captions"].append(caption)
+        if album["task"]:
+            album["task"].cancel()
+        album["task"] = asyncio.create_task(_flush_feedback_album(key, FEEDBACK_ALBUM_WINDOW))
+        return
+    await save_feedback(msg.from_user.id, caption, photo_id=file_id)
     header = "🖼 <b>Фото к отзыву</b>\n" + _fmt_user_line(msg)
     body = f"\n\n{caption}" if caption else ""
     await _send_to_owner(header + body, photo_file_id=file_id)
     await msg.answer("🖼 Фото получено.")
 
+@dp.message(lambda m: m.from_user and m.from_user.id in WAIT_FEEDBACK and (m.text or m.caption))
+async def feedback_text(msg: Message):
+    # текст/подпись
+    text = (msg.text or msg.caption or "").strip()
+    await save_feedback(msg.from_user.id, text)
+    header = "💬 <b>Новый отзыв</b>\n" + _fmt_user_line(msg)
+    body = f"\n\n{text}" if text else ""
+    await _send_to_owner(header + body)
+    # подтверждение гостю (можно убрать, если много сообщений)
+    await msg.answer("✅ Большое спасибо.")
+
+# ===== Admin: feedback inbox =====
+FEEDBACK_PAGE_SIZE = 5
+
+async def _feedback_page(page: int) -> tuple[str, InlineKeyboardBuilder]:
+    total = await count_feedback_items()
+    pages = max(1, (total + FEEDBACK_PAGE_SIZE - 1) // FEEDBACK_PAGE_SIZE)
+    page = min(max(0, page), pages - 1)
+    rows = await get_feedback_items(page * FEEDBACK_PAGE_SIZE, FEEDBACK_PAGE_SIZE)
+    kb = InlineKeyboardBuilder()
+    if not rows:
+        kb.button(text="⬅️ Панель", callback_data="ap:users")
+        return "💬 Отзывов пока нет.", kb
+    lines = [f"💬 <b>Отзывы</b> (стр. {page + 1}/{pages}, всего {total})"]
+    for fid, uid, created_at, text, photos in rows:
+        try:
+            when = datetime.fromisoformat(created_at).strftime("%d.%m %H:%M")
+        except Exception:
+            when = created_at
+        line = f"#{fid} {when} 🆔 <code>{uid}</code>"
+        if photos:
+            line += f" 🖼×{photos}"
+            kb.button(text=f"🖼 #{fid}", callback_data=f"fb_show:{fid}")
+        if text:
+            # сначала обрезаем, потом экранируем — иначе можно разрезать «&lt;» пополам
+            line += "\n" + html.escape(text if len(text) <= 300 else text[:300] + "…")
+        lines.append(line)
+    kb.adjust(FEEDBACK_PAGE_SIZE)
+    nav = InlineKeyboardBuilder()
+    if page > 0:
+        nav.button(text="◀️", callback_data=f"fb_page:{page - 1}")
+    nav.button(text="🔄", callback_data=f"fb_page:{page}")
+    if page < pages - 1:
+        nav.button(text="▶️", callback_data=f"fb_page:{page + 1}")
+    nav.button(text="⬅️ Панель", callback_data="ap:users")
+    kb.attach(nav)
+    return "\n\n".join(lines), kb
+
+@dp.message(Command("feedbacks"))
+async def feedbacks_cmd(msg: Message):
+    if not is_admin(msg.from_user.id): return
+    text, kb = await _feedback_page(0)
+    await msg.answer(text, reply_markup=kb.as_markup())
+
+@dp.callback_query(F.data.startswith("fb_page:"))
+async def cb_feedback_page(cb: CallbackQuery):
+    if not is_admin(cb.from_user.id): return await cb.answer()
+    try:
+        page = int(cb.data.split(":", 1)[1])
+    except ValueError:
+        return await cb.answer()
+    text, kb = await _feedback_page(page)
+    try:
+        await cb.message.edit_text(text, reply_markup=kb.as_markup())
+    except Exception:
+        pass  # "message is not modified" при повторном обновлении
+    await cb.answer()
+
+@dp.callback_query(F.data.startswith("fb_show:"))
+async def cb_feedback_show(cb: CallbackQuery):
+    if not is_admin(cb.from_user.id): return await cb.answer()
+    try:
+        fid = int(cb.data.split(":", 1)[1])
+    except ValueError:
+        return await cb.answer()
+    photos = await get_feedback_photos(fid)
+    if not photos:
+        return await cb.answer("Фото не найдены")
+    if len(photos) == 1:
+        await cb.message.answer_photo(photos[0], caption=f"🖼 Отзыв #{fid}")
+    else:
+        for i in range(0, len(photos), 10):
+            await cb.message.answer_media_group([InputMediaPhoto(media=p) for p in photos[i:i + 10]])
+    await cb.answer()
+
+async def register_guest(name: str, phone: str, user_id: int) -> bool:
+    """Сохраняет гостя и привязывает его призы. True — гость уже был (по телефону или user_id).
+
+    Одна строка на user_id и на phone_norm (ux_guests_*): новый телефон пользователя заменяет старый,
+    телефон, уже записанный на другого пользователя, переходит к этому."""
+    async with storage.transaction():
+        phone_norm = normalize_phone(phone)
+        by_phone = await storage.fetchval("SELECT id FROM guests WHERE phone_norm = ?", (phone_norm,))
+        by_user = await storage.fetchval("SELECT id FROM guests WHERE user_id = ?", (user_id,))
+        if by_phone and by_user and by_phone != by_user:
+            await storage.execute("DELETE FROM guests WHERE id = ?", (by_user,))
+        exists = by_phone or by_user
+        if exists:
+            await storage.execute("UPDATE guests SET name = ?, phone = ?, user_id = ?, phone_norm = ? WHERE id = ?",
+                                  (name, phone, user_id, phone_norm, exists))
+        else:
+            await storage.insert("INSERT INTO guests (name, phone, user_id, phone_norm) VALUES (?, ?, ?, ?)",
+                                 (name, phone, user_id, phone_norm))
+        # Привязка приза к user_id, если телефон совпадает
+        await storage.execute("UPDATE prizes SET user_id = ? WHERE phone_norm = ? AND delivered_at IS NULL",
+                              (user_id, phone_norm))
+        await track(user_id, "contact")
+    forget_guest_profile(user_id)
+    return bool(exists)
+
 @dp.message(F.contact)
 async def contact_handler(msg: Message):
     """Обработка контакта, сохраняем в базу guests"""
+    # только свой номер (кнопка «Поделиться номером»): по пересланной чужой карточке гость получил бы
+    # чужие призы и данные карты iiko
+    if msg.contact.user_id != msg.from_user.id:
+        await msg.answer("⚠️ Можно зарегистрировать только свой номер — нажмите кнопку «📱 Поделиться номером».")
+        return
     phone = msg.contact.phone_number
     name = msg.from_user.full_name
     user_id = msg.from_user.id
 
-    cur.execute("SELECT id FROM guests WHERE phone = ?", (phone,))
-    exists = cur.fetchone()
+    exists = await register_guest(name, phone, user_id)
 
     if exists:
-        cur.execute(
-            "UPDATE guests SET name = ?, user_id = ? WHERE phone = ?",
-            (name, user_id, phone)
-        )
         await msg.answer("✅ Ваш профиль обновлён! Теперь вы можете получать призы 🎁")
     else:
-        cur.execute(
-            "INSERT INTO guests (name, phone, user_id) VALUES (?, ?, ?)",
-            (name, phone, user_id)
-        )
-
         # 🔧 Временно отключена интеграция с iiko:
         # register_guest_in_iiko(name, phone, user_id)
 
         await msg.answer("✅ Вы зарегистрированы! Теперь вы участвуете в акциях 🎉")
 
-    # Привязка приза к user_id, если телефон совпадает
-    cur.execute("""
-        UPDATE prizes
-        SET user_id = ?
-        WHERE guest_phone = ?
-    """, (user_id, phone))
-
-    conn.commit()
-
     # Главное меню после успешной регистрации
     await msg.answer(
         "📋 Добро пожаловать в SHISHKA RESTOBAR! С браслетом действуют особые цены 🍸",
         reply_markup=main_reply_kb()
     )
+    # призы, ждавшие этого телефона, — сразу, не дожидаясь еженедельной рассылки
+    delivered = await deliver_pending_prizes(user_id, normalize_phone(phone))
+    if delivered:
+        await notify_admins(f"📤 {html.escape(name)} зарегистрировался — доставлено призов: {delivered}")
 
 
 
@@ -816,7 +3833,7 @@ async def myid(msg: Message):
 
 @dp.message(Command("address"))
 async def address_cmd(msg: Message):
-    await msg.answer(f"📍 <b>Адрес:</b> {ADDRESS}\n🗺 <a href='{MAP_URL}'>Открыть на карте</a>", disable_web_page_preview=True)
+    await msg.answer(f"📍 <b>Адрес:</b> {venue.ADDRESS}\n🗺 <a href='{venue.MAP_URL}'>Открыть на карте</a>", disable_web_page_preview=True)
 
 @dp.message(Command("users"))
 async def count_users(msg: Message):
@@ -824,83 +3841,23 @@ async def count_users(msg: Message):
     if not is_admin(msg.from_user.id):
         return
 
-    cur.execute("SELECT COUNT(*) FROM users")
-    total = cur.fetchone()[0]
-
-    cur.execute("SELECT joined_at FROM users ORDER BY joined_at DESC LIMIT 1")
-    last = cur.fetchone()
-    last_join = datetime.fromisoformat(last[0]).strftime("%d.%m %H:%M") if last else "—"
+    total = await count_all_users()
+    last = await last_joined_at()
+    last_join = datetime.fromisoformat(last).strftime("%d.%m %H:%M") if last else "—"
 
     await msg.answer(f"👥 Всего пользователей: <b>{total}</b>\n🕒 Последний вход: {last_join}")
 
 @dp.callback_query(F.data == "address")
 async def cb_address(cb: CallbackQuery):
-    await cb.message.answer(f"📍 <b>Адрес:</b> {ADDRESS}\n🗺 <a href='{MAP_URL}'>Открыть на карте</a>", disable_web_page_preview=True)
+    await cb.message.answer(f"📍 <b>Адрес:</b> {venue.ADDRESS}\n🗺 <a href='{venue.MAP_URL}'>Открыть на карте</a>", disable_web_page_preview=True)
     await cb.answer()
 # ===== Helpers to reuse for ReplyKeyboard buttons =====
-@dp.callback_query(F.data == "adm_users")
-async def cb_adm_users(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id): 
-        return await cb.answer()
-    cur.execute("SELECT COUNT(*) FROM users")
-    total = cur.fetchone()[0]
-    await cb.message.answer(f"👥 Всего пользователей: <b>{total}</b>")
-    await cb.answer()
-
-
-@dp.callback_query(F.data == "adm_inactive")
-async def cb_adm_inactive(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id):
-        return await cb.answer()
-    limit_date = (now_tz() - timedelta(days=30)).isoformat()
-    cur.execute("SELECT COUNT(*) FROM users WHERE last_seen < ?", (limit_date,))
-    inactive = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM users")
-    total = cur.fetchone()[0]
-    await cb.message.answer(f"🧊 Неактивных более 30 дней: <b>{inactive}</b> из {total}")
-    await cb.answer()
-
-
-@dp.callback_query(F.data == "adm_prizes")
-async def cb_adm_prizes(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id): 
-        return await cb.answer()
-    cur.execute("SELECT id, guest_name, guest_phone, prize FROM prizes")
-    rows = cur.fetchall()
-    if not rows:
-        await cb.message.answer("🎁 Список призов пуст.")
-        return await cb.answer()
-    lines = [f"#{pid} {name} ({phone}) — {prize}" for pid, name, phone, prize in rows]
-    await cb.message.answer("🎁 <b>Призы:</b>\n" + "\n".join(lines))
-    await cb.answer()
-
-
-@dp.callback_query(F.data == "adm_add_prize")
-async def cb_adm_add_prize(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id):
-        return await cb.answer()
-    await cb.message.answer(
-        "Введите вручную:\n<code>/add_prize Имя +9989XXXXXXX Приз</code>\n"
-        "Пример:\n<code>/add_prize Азиз +998901234567 Кальян</code>"
-    )
-    await cb.answer()
-
-
-@dp.callback_query(F.data == "adm_restart")
-async def cb_adm_restart(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id):
-        return await cb.answer()
-    await cb.message.answer("♻️ Перезапуск бота...\n(занимает несколько секунд)")
-    import os, sys
-    os.execv(sys.executable, ['python'] + sys.argv)
-
 async def start_reserve_flow_from_message(msg: Message):
     """Запускаем мастер бронирования от текстовой кнопки."""
-    if is_blocked(msg.from_user.id) or (ACCESS_MODE == "closed" and not is_approved(msg.from_user.id)):
-        await msg.answer(ACCESS_HINT)
+    if await is_blocked(msg.from_user.id) or (venue.ACCESS_MODE == "closed" and not await is_approved(msg.from_user.id)):
+        await msg.answer(venue.ACCESS_HINT)
         return
-    RES_TMP[msg.from_user.id] = {"step": "name", "data": {}}
-    await msg.answer("📝 Введите имя для брони:")
+    await res_wizard_open(msg, msg.from_user.id)
 
 async def run_try_luck_from_message(msg: Message):
     """Розыгрыш призов от текстовой кнопки (логика из cb_try_luck)."""
@@ -908,60 +3865,47 @@ async def run_try_luck_from_message(msg: Message):
     now = now_tz()
     today = now.date()
 
-    # Проверяем, играл ли гость в последние 7 дней
-    cur.execute(
-        "SELECT date_issued FROM random_rewards WHERE user_id=? ORDER BY date_issued DESC LIMIT 1",
-        (user_id,),
-    )
-    row = cur.fetchone()
-    if row:
-        last_play = datetime.fromisoformat(row[0]).date()
-        if (today - last_play).days < 7:
-            await msg.answer("🎮 Вы уже играли на этой неделе! Попробуйте позже 😉")
-            return
-
-    # Рандомайзер призов
-    prizes = [
-        "🍺 Бокал пива",
-        "🎟 Браслет который решает",
-        "🍽 Кофе на выбор ",
-        "🥗 Салат греческий",
-        "🥗 Салат Оливье",
-        "💨 Кальян",
-        "🎁 40% скидка на браслет",
-        "🎁 50% скидка на браслет",
-        "🎁 30% скидка на браслет",
-        "🍺 2 Бокала пива",
-        "🥗 Салат Цезарь",
-        "🥗 Наливка ",
-        "🎟 Бесплатный браслет другу с которым вы пришли",
-
-        
-    ]
-    prize = random.choice(prizes)
+    # Рандомайзер призов (список — /set luck_prizes)
+    prizes = cfg("luck_prizes")
+    prize_no = random.randrange(len(prizes))
+    prize = prizes[prize_no]
 
-    # Генерируем уникальный код
-    reward_code = ''.join(random.choice("ABCDEFGHJKLMNPQRSTUVWXYZ23456789") for _ in range(6))
+    # Генерируем уникальный код (в формате hmac в нём зашит номер приза)
+    reward_code = await new_reward_code(now, prize_no)
 
             # === Сохраняем приз сразу с датой окончания ===
-    expiry_date = (datetime.now(timezone.utc) + timedelta(days=7)).isoformat()
-
-    cur.execute("""
-    INSERT INTO random_rewards 
-    (user_id, prize, reward_code, date_issued, expiry_date, notified_24h, expired,
-     winner_username, winner_fullname)
-    VALUES (?, ?, ?, ?, ?, 0, 0, ?, ?)
-""", (
-    user_id,
-    prize,
-    reward_code,
-    now.isoformat(),
-    expiry_date,
-    msg.from_user.username,
-    msg.from_user.full_name
-))
-
-    conn.commit()
+    expiry_date = (now + timedelta(days=7)).isoformat()  # по Ташкенту, как date_issued
+
+    # проверка «раз в 7 дней» и запись приза — одной транзакцией; ключ операции
+    # не даёт выдать второй приз, если два нажатия пришли разными апдейтами
+    try:
+        async with storage.transaction():
+            # Проверяем, играл ли гость в последние 7 дней
+            row = await storage.fetchone(
+                "SELECT date_issued FROM random_rewards WHERE user_id=? ORDER BY date_issued DESC LIMIT 1",
+                (user_id,),
+            )
+            if row and (today - datetime.fromisoformat(row[0]).date()).days < 7:
+                raise DuplicateOp("luck", None)
+            await claim_op(user_id, f"luck:{ymd(today)}", reward_code)
+            await storage.insert("""
+            INSERT INTO random_rewards 
+            (user_id, prize, reward_code, date_issued, expiry_date, notified_24h, expired,
+             winner_username, winner_fullname)
+            VALUES (?, ?, ?, ?, ?, 0, 0, ?, ?)
+        """, (
+            user_id,
+            prize,
+            reward_code,
+            now.isoformat(),
+            expiry_date,
+            msg.from_user.username,
+            msg.from_user.full_name
+        ))
+    except DuplicateOp:
+        await msg.answer("🎮 Вы уже играли на этой неделе! Попробуйте позже 😉")
+        return
+    await track(user_id, "luck")
 
 
     # Сообщение пользователю
@@ -969,167 +3913,282 @@ async def run_try_luck_from_message(msg: Message):
         text = (
             f"🎉 <b>Поздравляем!</b>\n"
             f"Вы выиграли <b>{prize}</b>!\n\n"
-            f"Передайте другу этот купон:\n<code>{reward_code}</code>\n"
+            f"Передайте другу этот купон:\n<code>{fmt_code(reward_code)}</code>\n"
             f"Он даёт 50% скидку на браслет! 🩶"
         )
     else:
         text = (
             f"🎉 <b>Поздравляем!</b>\n"
             f"Вы выиграли <b>{prize}</b>!\n"
-            f"Ваш код: <code>{reward_code}</code>\n\n"
+            f"Ваш код: <code>{fmt_code(reward_code)}</code>\n\n"
             f"Покажите этот код при визите в Shishka Restobar 💫"
         )
-    await safe_reply(msg, text)
+    if not await send_code_qr(msg.chat.id, reward_code, text, reply_markup=main_reply_kb()):
+        await safe_reply(msg, text)
 
     # Уведомим админов
-    await notify_admins(f"🎲 Игрок @{msg.from_user.username or msg.from_user.full_name} выиграл: {prize} (код: {reward_code})")
+    await notify_admins(f"🎲 Игрок @{msg.from_user.username or msg.from_user.full_name} выиграл: {prize} (код: {fmt_code(reward_code)})")
 
 @dp.callback_query(F.data == "menu_food")
 async def cb_menu_food(cb: CallbackQuery):
-    url = "https://Shishkaone.myresto.online"
-    await cb.message.answer(
-        f"🍽 <b>Меню ресторана SHISHKA RESTOBAR</b>\n\n"
-        f"Посмотреть все блюда можно по ссылке 👇\n"
-        f"🔗 <a href='{url}'>Открыть меню</a>",
-        disable_web_page_preview=False
-    )
+    url = cfg("menu_url")
+    text = (f"🍽 <b>Меню ресторана SHISHKA RESTOBAR</b>\n\n"
+            f"Посмотреть все блюда можно по ссылке 👇\n"
+            f"🔗 <a href='{url}'>Открыть меню</a>")
+    if not await send_asset(cb.message.chat.id, "asset:menu_cover", ASSET_MENU_COVER_PATH, text):
+        await cb.message.answer(text, disable_web_page_preview=False)
     await cb.answer()
 
 
 @dp.callback_query(F.data == "promos")
 async def cb_promos(cb: CallbackQuery):
-    await cb.message.answer("🎉 Акции / события: следите в нашем канале!\n" + CHANNEL_URL)
+    await cb.message.answer("🎉 Акции / события: следите в нашем канале!\n" + venue.CHANNEL_URL)
     await cb.answer()
 
 # codes: callback & /code
 @dp.callback_query(F.data == "get_code")
 async def cb_get_code(cb: CallbackQuery):
-    if is_blocked(cb.from_user.id) or (ACCESS_MODE == "closed" and not is_approved(cb.from_user.id)):
-        await cb.message.answer(ACCESS_HINT); return await cb.answer()
+    if await is_blocked(cb.from_user.id) or (venue.ACCESS_MODE == "closed" and not await is_approved(cb.from_user.id)):
+        await cb.message.answer(venue.ACCESS_HINT); return await cb.answer()
     now = now_tz()
     if not is_in_window(now):
-        s_h,s_m=CODES_WINDOW_START; e_h,e_m=CODES_WINDOW_END
+        s_h,s_m=cfg("codes_window_start"); e_h,e_m=cfg("codes_window_end")
         await cb.message.answer(f"Коды выдаются только с <b>{s_h:02d}:{s_m:02d}</b> до <b>{e_h:02d}:{e_m:02d}</b>.")
         return await cb.answer()
-    code, issued_at, expires_at = create_code_for_user(cb.from_user.id)
+    code, issued_at, expires_at = await create_code_for_user(cb.from_user.id)
     disc = today_discount()
-    await cb.message.answer(
-        "🎟 <b>Ваш код на браслет</b>\n"
-        f"Код: <code>{code}</code>\n"
-        f"Скидка сегодня: <b>{disc}%</b>\n"
-        f"Выдан: {issued_at.strftime('%H:%M')} | Действует до: {expires_at.strftime('%H:%M')}"
-    )
+    text = ("🎟 <b>Ваш код на браслет</b>\n"
+            f"Код: <code>{fmt_code(code)}</code>\n"
+            f"Скидка сегодня: <b>{disc}%</b>\n"
+            f"Выдан: {issued_at.strftime('%H:%M')} | Действует до: {expires_at.strftime('%H:%M')}")
+    if not await send_code_qr(cb.message.chat.id, code, text):
+        await cb.message.answer(text)
     await cb.answer()
 
 @dp.message(Command("code"))
 async def code_cmd(msg: Message):
-    if is_blocked(msg.from_user.id) or (ACCESS_MODE == "closed" and not is_approved(msg.from_user.id)):
-        return await msg.answer(ACCESS_HINT)
+    if await is_blocked(msg.from_user.id) or (venue.ACCESS_MODE == "closed" and not await is_approved(msg.from_user.id)):
+        return await msg.answer(venue.ACCESS_HINT)
     now = now_tz()
     if not is_in_window(now):
-        s_h,s_m=CODES_WINDOW_START; e_h,e_m=CODES_WINDOW_END
+        s_h,s_m=cfg("codes_window_start"); e_h,e_m=cfg("codes_window_end")
         return await msg.answer(f"Коды выдаются только с <b>{s_h:02d}:{s_m:02d}</b> до <b>{e_h:02d}:{e_m:02d}</b>.")
-    code, issued_at, expires_at = create_code_for_user(msg.from_user.id)
+    code, issued_at, expires_at = await create_code_for_user(msg.from_user.id)
     disc = today_discount()
-    await msg.answer(
-        "🎟 <b>Ваш код на браслет</b>\n"
-        f"Код: <code>{code}</code>\n"
-        f"Скидка сегодня: <b>{disc}%</b>\n"
-        f"Выдан: {issued_at.strftime('%H:%M')} | Действует до: {expires_at.strftime('%H:%M')}"
-    )
+    text = ("🎟 <b>Ваш код на браслет</b>\n"
+            f"Код: <code>{fmt_code(code)}</code>\n"
+            f"Скидка сегодня: <b>{disc}%</b>\n"
+            f"Выдан: {issued_at.strftime('%H:%M')} | Действует до: {expires_at.strftime('%H:%M')}")
+    if not await send_code_qr(msg.chat.id, code, text):
+        await msg.answer(text)
 
 # ===== Reservations wizard =====
-RES_TMP: dict[int, dict] = {}
+# Мастер брони — одно сообщение, которое редактируется по нажатиям кнопок:
+# дата -> время -> гости -> подтверждение. Имя и телефон берутся из guests.
+# callback_data: rs:d:YYYYMMDD | rs:t:HHMM | rs:c:N | rs:b:<шаг> | rs:w | rs:ok | rs:x
+RES_TMP = venue_local("res_tmp", lambda v: {})   # user_id -> черновик брони
 # ждём от пользователя отзыв (режим обратной связи)
-WAIT_FEEDBACK: dict[int, dict] = {}
+WAIT_FEEDBACK = venue_local("wait_feedback", lambda v: {})
+
+RES_DAYS_AHEAD = int(os.getenv("RES_DAYS_AHEAD", "14"))
+RES_MAX_COVERS = int(os.getenv("RES_MAX_COVERS", "10"))
+WEEKDAYS_RU = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+def _res_dates() -> list[date]:
+    today = now_tz().date()
+    return [today + timedelta(days=i) for i in range(RES_DAYS_AHEAD)]
+
+def _res_open_slots(r_date: str, covers: int = 1) -> list[str]:
+    """Свободные слоты; на сегодня — только те, что ещё не прошли."""
+    slots = capacity.open_slots(r_date, covers)
+    now = now_tz()
+    if r_date == ymd(now):
+        cutoff = now.strftime("%H:%M")
+        slots = [s for s in slots if s > cutoff]
+    return slots
+
+def _res_summary(st: dict) -> str:
+    # имя, телефон и пожелание — ввод гостя, в HTML-сообщение только экранированными
+    lines = ["🍽 <b>Бронь стола</b>", f"👤 {html.escape(st['name'])} | 📞 {html.escape(st['phone'])}"]
+    if st.get("date"):
+        d = datetime.strptime(st["date"], "%Y-%m-%d")
+        lines.append(f"📆 {WEEKDAYS_RU[d.weekday()]} {d.strftime('%d.%m')}")
+    if st.get("time"):
+        lines.append(f"⏰ {st['time']}")
+    if st.get("covers"):
+        lines.append(f"👥 Гостей: {st['covers']}")
+    if st.get("note"):
+        lines.append(f"✍️ {html.escape(st['note'])}")
+    return "\n".join(lines)
+
+def _res_view(st: dict, notice: str = "") -> tuple[str, InlineKeyboardBuilder]:
+    """Текст и клавиатура для текущего шага мастера."""
+    kb = InlineKeyboardBuilder()
+    text = _res_summary(st) + "\n\n" + (notice + "\n" if notice else "")
+    if not st.get("date"):
+        text += "Выберите дату:"
+        for d in _res_dates():
+            key = ymd(d)
+            label = f"{WEEKDAYS_RU[d.weekday()]} {d.day}"
+            if _res_open_slots(key):
+                kb.button(text=label, callback_data=f"rs:d:{d.strftime('%Y%m%d')}")
+            else:
+                kb.button(text=f"✖️ {d.day}", callback_data="rs:b:d")
+        kb.adjust(7)
+    elif not st.get("time"):
+        text += "Выберите время:"
+        for t in _res_open_slots(st["date"]):
+            kb.button(text=t, callback_data=f"rs:t:{t.replace(':', '')}")
+        kb.adjust(4)
+        kb.attach(InlineKeyboardBuilder().button(text="⬅️ Дата", callback_data="rs:b:d"))
+    elif not st.get("covers"):
+        text += "Сколько будет гостей?"
+        free = min(RES_MAX_COVERS, capacity.free_seats(st["date"], st["time"]))
+        for n in range(1, free + 1):
+            kb.button(text=str(n), callback_data=f"rs:c:{n}")
+        kb.adjust(5)
+        kb.attach(InlineKeyboardBuilder().button(text="⬅️ Время", callback_data="rs:b:t"))
+    else:
+        text += "Всё верно?"
+        kb.button(text="✅ Подтвердить", callback_data="rs:ok")
+        kb.button(text="✍️ Пожелание", callback_data="rs:w")
+        kb.button(text="⬅️ Гости", callback_data="rs:b:c")
+        kb.adjust(1, 2)
+    kb.attach(InlineKeyboardBuilder().button(text="❌ Отмена", callback_data="rs:x"))
+    return text, kb
+
+async def _guest_contact(user_id: int) -> Optional[tuple[str, str]]:
+    profile = await guest_profile(user_id)
+    return (profile.name, profile.phone) if profile.registered else None
+
+async def res_wizard_open(msg: Message, user_id: int):
+    contact = await _guest_contact(user_id)
+    if not contact:
+        await msg.answer("⛔ Сначала зарегистрируйтесь — нажмите /start и отправьте номер телефона.")
+        return
+    st = {"step": "wizard", "name": contact[0][:60], "phone": contact[1],
+          "date": None, "time": None, "covers": None, "note": None}
+    text, kb = _res_view(st)
+    sent = await msg.answer(text, reply_markup=kb.as_markup())
+    st["msg_id"] = sent.message_id
+    RES_TMP[user_id] = st
 
 @dp.callback_query(F.data == "reserve")
 async def reserve_start(cb: CallbackQuery):
-    if is_blocked(cb.from_user.id) or not is_approved(cb.from_user.id):
-        await cb.message.answer(ACCESS_HINT); return await cb.answer()
-    RES_TMP[cb.from_user.id] = {"step":"name","data":{}}
-    await cb.message.answer("📝 Введите имя для брони:")
+    if await is_blocked(cb.from_user.id) or not await is_approved(cb.from_user.id):
+        await cb.message.answer(venue.ACCESS_HINT); return await cb.answer()
+    await res_wizard_open(cb.message, cb.from_user.id)
     await cb.answer()
 
-@dp.message(lambda m: RES_TMP.get(m.from_user.id, {}).get("step") == "name")
-async def res_get_name(msg: Message):
-    RES_TMP[msg.from_user.id]["data"]["name"] = (msg.text or "").strip()[:60]
-    RES_TMP[msg.from_user.id]["step"] = "phone"
-    await msg.answer("📞 Введите телефон (например, +998901234567):")
-
-@dp.message(lambda m: RES_TMP.get(m.from_user.id, {}).get("step") == "phone")
-async def res_get_phone(msg: Message):
-    phone = (msg.text or "").strip()
-    if len(phone) < 7:
-        return await msg.answer("Похоже на некорректный номер. Введите ещё раз:")
-    RES_TMP[msg.from_user.id]["data"]["phone"] = phone
-    RES_TMP[msg.from_user.id]["step"] = "date"
-    today = ymd(now_tz())
-    await msg.answer(f"📆 Дата визита YYYY-MM-DD (например, {today}):")
-
-@dp.message(lambda m: RES_TMP.get(m.from_user.id, {}).get("step") == "date")
-async def res_get_date(msg: Message):
-    d = (msg.text or "").strip()
-    try:
-        _ = datetime.strptime(d, "%Y-%m-%d")
-    except Exception:
-        return await msg.answer("Неверная дата. Введите в формате YYYY-MM-DD:")
-    RES_TMP[msg.from_user.id]["data"]["date"] = d
-    RES_TMP[msg.from_user.id]["step"] = "time"
-    await msg.answer("⏰ Время визита HH:MM (например, 20:00):")
-
-@dp.message(lambda m: RES_TMP.get(m.from_user.id, {}).get("step") == "time")
-async def res_get_time(msg: Message):
-    t = (msg.text or "").strip()
-    try:
-        _ = datetime.strptime(t, "%H:%M")
-    except Exception:
-        return await msg.answer("Неверное время. Введите в формате HH:MM:")
-    RES_TMP[msg.from_user.id]["data"]["time"] = t
-    RES_TMP[msg.from_user.id]["step"] = "covers"
-    await msg.answer("👥 Количество гостей (цифрой):")
-
-@dp.message(lambda m: RES_TMP.get(m.from_user.id, {}).get("step") == "covers")
-async def res_get_covers(msg: Message):
-    try:
-        covers = max(1, int((msg.text or "").strip()))
-    except Exception:
-        return await msg.answer("Введите количество гостей числом, например 4:")
-    RES_TMP[msg.from_user.id]["data"]["covers"] = covers
-    RES_TMP[msg.from_user.id]["step"] = "note"
-    await msg.answer("✍️ Пожелания (опционально). Если нет — отправьте «-»:")
+def _parse_res_callback(data: str, st: dict) -> Optional[tuple[str, object]]:
+    """Разбирает и проверяет callback мастера. None — устаревшая или подделанная кнопка."""
+    parts = data.split(":")
+    action = parts[1] if len(parts) > 1 else ""
+    arg = parts[2] if len(parts) > 2 else ""
+    if action in ("ok", "w", "x") and len(parts) == 2:
+        return action, None
+    if action == "b" and arg in ("d", "t", "c"):
+        return action, arg
+    if action == "d" and len(arg) == 8 and arg.isdigit():
+        try:
+            d = datetime.strptime(arg, "%Y%m%d").date()
+        except ValueError:
+            return None
+        if d in _res_dates() and _res_open_slots(ymd(d)):
+            return action, ymd(d)
+        return None
+    if action == "t" and len(arg) == 4 and arg.isdigit() and st.get("date"):
+        t = f"{arg[:2]}:{arg[2:]}"
+        if t in _res_open_slots(st["date"]):
+            return action, t
+        return None
+    if action == "c" and arg.isdigit() and st.get("time"):
+        n = int(arg)
+        if 1 <= n <= RES_MAX_COVERS and capacity.can_book(st["date"], st["time"], n):
+            return action, n
+    return None
+
+@dp.callback_query(F.data.startswith("rs:"))
+async def cb_res_wizard(cb: CallbackQuery):
+    st = RES_TMP.get(cb.from_user.id)
+    if not st or not cb.message or st.get("msg_id") != cb.message.message_id:
+        return await cb.answer("Эта бронь уже неактуальна. Нажмите «🍽 Забронировать стол» ещё раз.", show_alert=True)
+    parsed = _parse_res_callback(cb.data or "", st)
+    if parsed is None:
+        text, kb = _res_view(st, "😔 Этот вариант уже недоступен, выберите другой.")
+        await cb.message.edit_text(text, reply_markup=kb.as_markup())
+        return await cb.answer()
+    action, arg = parsed
+    notice = ""
+    if action == "x":
+        RES_TMP.pop(cb.from_user.id, None)
+        await cb.message.edit_text("❌ Бронирование отменено.")
+        return await cb.answer()
+    if action == "d":
+        st["date"], st["time"], st["covers"] = arg, None, None
+    elif action == "t":
+        st["time"], st["covers"] = arg, None
+    elif action == "c":
+        st["covers"] = arg
+    elif action == "b":
+        if arg == "d":
+            st["date"] = None
+        if arg in ("d", "t"):
+            st["time"] = None
+        st["covers"] = None
+    elif action == "w":
+        st["step"] = "note"
+        await cb.message.edit_text(_res_summary(st) + "\n\n✍️ Напишите пожелание одним сообщением:")
+        return await cb.answer()
+    elif action == "ok":
+        try:
+            rid = await create_reservation(
+                user_id=cb.from_user.id,
+                name=st["name"], phone=st["phone"], covers=st["covers"],
+                r_date=st["date"], r_time=st["time"], note=st.get("note"),
+                op=f"resv:{cb.message.message_id}",  # одна бронь на одно сообщение мастера
+            )
+        except DuplicateOp as e:
+            RES_TMP.pop(cb.from_user.id, None)
+            return await cb.answer(f"✅ Эта бронь уже оформлена (№{e.result})", show_alert=True)
+        if rid is None:
+            st["time"], st["covers"] = None, None
+            notice = "😔 Пока вы оформляли бронь, места на это время закончились."
+        else:
+            RES_TMP.pop(cb.from_user.id, None)
+            await cb.message.edit_text(
+                "✅ <b>Бронь принята!</b>\n\n"
+                f"Номер: <code>{rid}</code>\n" + _res_summary(st).split("\n", 1)[1] + "\nСтатус: new"
+            )
+            await cb.answer()
+            await _notify_new_reservation(rid, st, cb.from_user)
+            return
+    text, kb = _res_view(st, notice)
+    await cb.message.edit_text(text, reply_markup=kb.as_markup())
+    await cb.answer()
 
 @dp.message(lambda m: RES_TMP.get(m.from_user.id, {}).get("step") == "note")
 async def res_get_note(msg: Message):
-    data = RES_TMP[msg.from_user.id]["data"]
-    note = None if (msg.text or "").strip() == "-" else (msg.text or "").strip()[:200]
-    rid = create_reservation(
-        user_id=msg.from_user.id,
-        name=data["name"], phone=data["phone"], covers=data["covers"],
-        r_date=data["date"], r_time=data["time"], note=note
-    )
-    RES_TMP.pop(msg.from_user.id, None)
-    await msg.answer(
-        "✅ Бронь принята!\n\n"
-        f"Номер: <code>{rid}</code>\n"
-        f"Имя: {data['name']}\n"
-        f"Телефон: {data['phone']}\n"
-        f"Дата/время: {data['date']} {data['time']}\n"
-        f"Гостей: {data['covers']}\n"
-        f"Статус: new\n"
-        f"{('Пожелание: ' + note) if note else ''}"
-    )
+    st = RES_TMP[msg.from_user.id]
+    st["note"] = (msg.text or "").strip()[:200] or None
+    st["step"] = "wizard"
+    text, kb = _res_view(st)
+    sent = await msg.answer(text, reply_markup=kb.as_markup())
+    st["msg_id"] = sent.message_id
+
+async def _notify_new_reservation(rid: int, st: dict, user):
+    note = st.get("note")
     kb = InlineKeyboardBuilder()
     kb.button(text=f"✅ Подтвердить #{rid}", callback_data=f"approve_res:{rid}")
     kb.button(text=f"🛑 Отменить #{rid}", callback_data=f"cancel_res:{rid}")
     kb.adjust(2)
-    ulink = f"@{msg.from_user.username}" if msg.from_user.username else f"id {msg.from_user.id}"
+    ulink = f"@{user.username}" if user.username else f"id {user.id}"
     await notify_admins(
         "🆕 <b>Новая бронь</b>\n"
-        f"#{rid} — {data['date']} {data['time']}\n"
-        f"👤 {data['name']} | 📞 {data['phone']}\n"
-        f"👥 Гостей: {data['covers']}\n"
-        f"✍️ Пожелание: {note or '—'}\n"
+        f"#{rid} — {st['date']} {st['time']}\n"
+        f"👤 {html.escape(st['name'])} | 📞 {html.escape(st['phone'])}\n"
+        f"👥 Гостей: {st['covers']}\n"
+        f"✍️ Пожелание: {html.escape(note or '—')}\n"
         f"Источник: {ulink}",
         kb=kb
     )
@@ -1138,7 +4197,7 @@ async def res_get_note(msg: Message):
 async def cb_res_approve(cb: CallbackQuery):
     if not is_admin(cb.from_user.id): return await cb.answer()
     rid = int(cb.data.split(":", 1)[1])
-    set_res_status(rid, "confirmed")
+    await set_res_status(rid, "confirmed")
     await cb.message.answer(f"✅ Бронь #{rid} подтверждена.")
     await cb.answer()
 
@@ -1146,64 +4205,264 @@ async def cb_res_approve(cb: CallbackQuery):
 async def cb_res_cancel(cb: CallbackQuery):
     if not is_admin(cb.from_user.id): return await cb.answer()
     rid = int(cb.data.split(":", 1)[1])
-    set_res_status(rid, "cancelled")
+    await set_res_status(rid, "cancelled")
     await cb.message.answer(f"🛑 Бронь #{rid} отменена.")
     await cb.answer()
 
 # ===== Admin: commands and panel =====
-@dp.message(Command("admin"))
-async def admin_panel(msg: Message):
-    if not is_admin(msg.from_user.id):
-        return
-    await msg.answer("🛠 Админ-панель", reply_markup=admin_panel_kb().as_markup())
+# Админ-панель — одно сообщение, которое редактируется по нажатиям (как мастер брони):
+# главный экран со сводкой -> разделы -> экраны; на каждом «⬅️ Назад» и «🔄».
+# callback_data: ap:<экран>. Старые кнопки adm_* из прежних панелей в чате ведут туда же.
+# Сводка считается не чаще раза в ADMIN_DASHBOARD_TTL секунд на заведение: сколько бы
+# админов ни жали «🔄», запросы COUNT(*) идут один раз (пока считаем — остальные ждут).
+ADMIN_DASHBOARD_TTL = float(os.getenv("ADMIN_DASHBOARD_TTL", "30"))
 
-@dp.callback_query(F.data == "adm_today")
-async def cb_adm_today(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id): return await cb.answer()
+
+class DashboardCache:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.data: Optional[dict] = None
+        self.at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def get(self, collect) -> dict:
+        if self.data is not None and time.monotonic() - self.at < self.ttl:
+            metrics.inc("admin_dashboard_total", result="hit")
+            return self.data
+        async with self.lock:
+            if self.data is None or time.monotonic() - self.at >= self.ttl:  # пока ждали, мог посчитать другой
+                metrics.inc("admin_dashboard_total", result="miss")
+                self.data, self.at = await collect(), time.monotonic()
+            return self.data
+
+
+dashboard_cache = venue_local("dashboard", lambda v: DashboardCache(ADMIN_DASHBOARD_TTL))
+
+
+@read_only
+async def _collect_dashboard() -> dict:
+    now = now_tz()
+    today = ymd(now)
+    codes_today, _, disc = await stats_for_day(now.date())
+    res_today, res_new = await storage.fetchone("""
+        SELECT COUNT(*), COALESCE(SUM(CASE WHEN status='new' THEN 1 ELSE 0 END), 0)
+        FROM reservations WHERE r_date=? AND status != 'cancelled'
+    """, (today,))
+    rep = supervisor.report()
+    return {
+        "at": now,
+        "res_today": res_today, "res_new": res_new,
+        "seats": (capacity.day_load(today), capacity.seats_per_day),
+        "codes_today": codes_today, "disc": disc,
+        "codes_active": await count_valid_codes(),
+        "codes_used": await storage.fetchval("SELECT COUNT(*) FROM codes WHERE day_key=? AND used_at IS NOT NULL",
+                                             (today,), default=0),
+        "rewards_active": await storage.fetchval(
+            "SELECT COUNT(*) FROM random_rewards WHERE redeemed=0 AND expired=0", default=0),
+        # очереди
+        "prizes_queued": await storage.fetchval("SELECT COUNT(*) FROM prizes WHERE delivered_at IS NULL", default=0),
+        "bulk_pending": int(metrics.get("bulk_pending")),
+        "albums": len(FEEDBACK_ALBUMS),
+        "inflight": lifecycle.inflight,
+        "tasks_running": sum(1 for t in rep["tasks"].values() if t["running"]),
+        "tasks_stale": len(rep["stale"]),
+    }
+
+
+def _panel_kb(*buttons: tuple[str, str], back: Optional[str] = None, refresh: Optional[str] = None,
+              width: int = 2) -> InlineKeyboardBuilder:
+    kb = InlineKeyboardBuilder()
+    for text, data in buttons:
+        kb.button(text=text, callback_data=data)
+    kb.adjust(width)
+    nav = InlineKeyboardBuilder()
+    if back:
+        nav.button(text="⬅️ Назад", callback_data=f"ap:{back}")
+    if refresh:
+        nav.button(text="🔄 Обновить", callback_data=f"ap:{refresh}")
+    kb.attach(nav)
+    return kb
+
+
+async def _scr_home():
+    d = await dashboard_cache.get(_collect_dashboard)
+    load, seats = d["seats"]
+    lines = [
+        "🛠 <b>Админ-панель</b>" + (f" · {venue.name}" if MULTI_VENUE else ""),
+        "",
+        f"📅 Брони сегодня: <b>{d['res_today']}</b> (новых {d['res_new']}), мест {load}/{seats}",
+        f"🎟 Кодов выдано: <b>{d['codes_today']}</b>, на входе {d['codes_used']}, активных {d['codes_active']}"
+        f" · скидка {d['disc']}%",
+        f"🎲 Активных призов «Испытай удачу»: <b>{d['rewards_active']}</b>",
+        "",
+        "📬 <b>Очереди</b>",
+        f"— призов ждут доставки: {d['prizes_queued']}",
+        f"— сообщений рассылки в работе: {d['bulk_pending']}",
+        f"— альбомов отзывов в буфере: {d['albums']}",
+        f"— апдейтов в обработке: {d['inflight']}",
+        f"— фоновых задач: выполняется {d['tasks_running']}, зависших {d['tasks_stale']}",
+        "",
+        f"<i>данные на {d['at']:%H:%M:%S}, обновляются не чаще раза в {ADMIN_DASHBOARD_TTL:.0f} с</i>",
+    ]
+    kb = _panel_kb(("📅 Брони", "ap:res"), ("👥 Гости", "ap:users"), ("🎁 Призы", "ap:prizes"),
+                   ("🛠 Сервис", "ap:tech"), refresh="home")
+    return "\n".join(lines), kb
+
+
+async def _scr_res():
+    return "📅 <b>Брони</b>", _panel_kb(("📅 Брони на сегодня", "ap:today"), ("📊 Статистика за день", "ap:stats"),
+                                       back="home", width=1)
+
+
+async def _scr_today():
     today = ymd(now_tz())
-    rows = get_reservations_by_date(today)
+    rows = await get_reservations_by_date(today)
     if not rows:
-        await cb.message.answer("На сегодня броней нет."); return await cb.answer()
-    lines = ["📆 Брони на сегодня:"]
+        return "На сегодня броней нет.", _panel_kb(back="res", refresh="today")
+    lines = [f"📆 Брони на сегодня (занято {capacity.day_load(today)}/{capacity.seats_per_day} мест):"]
     for (rid, name, phone, covers, r_time, status, note) in rows:
-        line = f"#{rid} {r_time} — {name} ({phone}), гостей: {covers}, статус: {status}"
-        if note: line += f"\n   ✍️ {note}"
+        line = f"#{rid} {r_time} — {html.escape(name)} ({html.escape(phone)}), гостей: {covers}, статус: {status}"
+        if note: line += f"\n   ✍️ {html.escape(note)}"
         lines.append(line)
-    await cb.message.answer("\n".join(lines)); await cb.answer()
+    return _clip("\n".join(lines)), _panel_kb(back="res", refresh="today")
 
-@dp.callback_query(F.data == "adm_purge")
-async def cb_adm_purge(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id): return await cb.answer()
-    before = cur.execute("SELECT COUNT(*) FROM codes WHERE valid=1").fetchone()[0]
-    invalidate_expired()
-    after = cur.execute("SELECT COUNT(*) FROM codes WHERE valid=1").fetchone()[0]
-    await cb.message.answer(f"🧹 Просроченные коды аннулированы.\nАктивных было: {before}, стало: {after}.")
+
+async def _scr_stats():
+    today = now_tz().date()
+    codes, resv, disc = await stats_for_day(today)
+    text = (f"📊 Сегодня ({ymd(today)}):\n"
+            f"🎟 Выдано кодов: <b>{codes}</b>\n"
+            f"🍽 Брони: <b>{resv}</b>\n"
+            f"💰 Скидка дня: <b>{disc}%</b>")
+    return text, _panel_kb(back="res", refresh="stats")
+
+
+async def _scr_users():
+    total = await count_all_users()
+    inactive = await count_users_inactive_since((now_tz() - timedelta(days=30)).isoformat())
+    text = (f"👥 <b>Гости</b>\n\nВсего пользователей: <b>{total}</b>\n"
+            f"🧊 Неактивных более 30 дней: <b>{inactive}</b>")
+    return text, _panel_kb(("💬 Отзывы", "ap:feedbacks"), back="home", refresh="users", width=1)
+
+
+async def _scr_feedbacks():
+    text, kb = await _feedback_page(0)
+    return text, kb
+
+
+async def _scr_prizes():
+    rows = await get_all_prizes()
+    if rows:
+        lines = [f"#{pid} {html.escape(name)} ({html.escape(phone)}) — {html.escape(prize)} · {prize_status(at, tries)}"
+                 for pid, name, phone, prize, at, tries in rows]
+        text = _clip("🎁 <b>Призы:</b>\n" + "\n".join(lines))
+    else:
+        text = "🎁 Список призов пуст."
+    return text, _panel_kb(("➕ Добавить приз", "ap:add_prize"), ("📥 Импорт призов", "ap:import"),
+                           back="home", refresh="prizes")
+
+
+async def _scr_add_prize():
+    text = ("Введите вручную:\n<code>/add_prize Имя +9989XXXXXXX Приз</code>\n"
+            "Пример:\n<code>/add_prize Азиз +998901234567 Кальян</code>")
+    return text, _panel_kb(back="prizes")
+
+
+async def _scr_import(user_id: int):
+    IMPORT_WAIT.add(user_id)
+    return IMPORT_HINT, _panel_kb(back="prizes")
+
+
+async def _scr_tech():
+    return "🛠 <b>Сервис</b>", _panel_kb(("🩺 Состояние задач", "ap:health"), ("🔑 Проверить / Удалить код", "redeem_code"),
+                                        ("🧹 Очистить коды", "ap:purge"), ("♻️ Перезапуск", "ap:restart"),
+                                        back="home", width=1)
+
+
+async def _scr_health():
+    return _clip(await health_text()), _panel_kb(back="tech", refresh="health")
+
+
+async def _scr_purge():
+    return await purge_report(), _panel_kb(back="tech")
+
+
+async def _scr_restart():
+    return ("♻️ Перезапустить бота? Займёт несколько секунд.",
+            _panel_kb(("✅ Да, перезапустить", "ap:restart_yes"), back="tech"))
+
+
+def _clip(text: str, limit: int = 4000) -> str:
+    return text if len(text) <= limit else text[:limit] + "\n…"
+
+
+ADMIN_SCREENS = {
+    "home": _scr_home, "res": _scr_res, "today": _scr_today, "stats": _scr_stats,
+    "users": _scr_users, "feedbacks": _scr_feedbacks, "prizes": _scr_prizes, "add_prize": _scr_add_prize,
+    "tech": _scr_tech, "health": _scr_health, "purge": _scr_purge, "restart": _scr_restart,
+}
+# кнопки прежних панелей, оставшихся в истории чата
+ADMIN_LEGACY = {"adm_today": "today", "adm_stats": "stats", "adm_users": "users", "adm_inactive": "users",
+                "adm_prizes": "prizes", "adm_add_prize": "add_prize", "adm_import_prizes": "import",
+                "adm_feedbacks": "feedbacks", "adm_purge": "purge", "adm_restart": "restart"}
+
+
+async def _edit_panel(cb: CallbackQuery, text: str, kb: InlineKeyboardBuilder):
+    try:
+        await cb.message.edit_text(text, reply_markup=kb.as_markup())
+    except TelegramBadRequest as e:
+        if "not modified" in str(e):
+            return await cb.answer("Без изменений")
+        # сообщение не текстовое или слишком старое для правки — показываем новой панелью
+        await cb.message.answer(text, reply_markup=kb.as_markup())
     await cb.answer()
 
-def stats_for_day(day: date) -> tuple[int,int,int]:
+
+@dp.message(Command("admin"))
+async def admin_panel(msg: Message):
+    if not is_admin(msg.from_user.id):
+        return
+    text, kb = await _scr_home()
+    await msg.answer(text, reply_markup=kb.as_markup())
+
+
+@dp.callback_query(F.data.startswith("ap:") | F.data.in_(set(ADMIN_LEGACY)))
+async def cb_admin_panel(cb: CallbackQuery):
+    if not is_admin(cb.from_user.id): return await cb.answer()
+    screen = ADMIN_LEGACY.get(cb.data) or cb.data[3:]
+    if screen == "restart_yes":
+        await _edit_panel(cb, "♻️ Перезапуск бота...\n(занимает несколько секунд)", _panel_kb())
+        logger.warning("[SYSTEM] Бот перезапускается из админ-панели (%s)", cb.from_user.id)
+        lifecycle.request_stop(restart=True)
+        return
+    if screen == "import":
+        text, kb = await _scr_import(cb.from_user.id)
+    elif screen in ADMIN_SCREENS:
+        text, kb = await ADMIN_SCREENS[screen]()
+    else:
+        return await cb.answer()
+    await _edit_panel(cb, text, kb)
+
+
+async def purge_report() -> str:
+    """/purge: коды истекают сами (по expires_at), поэтому вместо UPDATE — перенос старого в архив."""
+    moved = await archive_old_rows()
+    active = await count_valid_codes()
+    lines = [f"🧹 Активных кодов: <b>{active}</b> (просроченные исключаются автоматически).",
+             "📦 Перенесено в архив:"]
+    lines += [f"— {table}: {n}" for table, n in moved.items()] or ["— ничего (архив выключен)"]
+    return "\n".join(lines)
+
+@read_only
+async def stats_for_day(day: date) -> tuple[int,int,int]:
     dkey = ymd(day)
-    cur.execute("SELECT COUNT(*) FROM codes WHERE day_key=?", (dkey,))
-    codes_count = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM reservations WHERE r_date=?", (dkey,))
-    res_count = cur.fetchone()[0]
-    disc = DISCOUNTS.get(day.weekday(), 0)
+    codes_count = await storage.fetchval("SELECT COUNT(*) FROM codes WHERE day_key=?", (dkey,), default=0)
+    codes_count += await rollup_value("codes", dkey)
+    res_count = await storage.fetchval("SELECT COUNT(*) FROM reservations WHERE r_date=?", (dkey,), default=0)
+    res_count += await rollup_value("res_date", dkey)
+    disc = discount_for_date(day)
     return codes_count, res_count, disc
 
-@dp.callback_query(F.data == "adm_stats")
-async def cb_adm_stats(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id): 
-        return await cb.answer()
-    today = now_tz().date()
-    codes, resv, disc = stats_for_day(today)
-    await cb.message.answer(
-        f"📊 Сегодня ({ymd(today)}):\n"
-        f"🎟 Выдано кодов: <b>{codes}</b>\n"
-        f"🍽 Брони: <b>{resv}</b>\n"
-        f"💰 Скидка дня: <b>{disc}%</b>"
-    )
-    await cb.answer()
-
-
 @dp.callback_query(F.data == "adm_broadcast")
 async def cb_adm_broadcast(cb: CallbackQuery):
     if not is_admin(cb.from_user.id): return await cb.answer()
@@ -1225,50 +4484,73 @@ async def cb_adm_test_prizes(cb: CallbackQuery):
 async def stats_cmd(msg: Message):
     if not is_admin(msg.from_user.id): return
     today = now_tz().date()
-    codes, resv, disc = stats_for_day(today)
+    codes, resv, disc = await stats_for_day(today)
     await msg.answer(f"📊 Сегодня ({ymd(today)}):\n— Выдано кодов: {codes}\n— Брони: {resv}\n— Скидка дня: {disc}%")
+@dp.message(Command("metrics"))
+async def metrics_cmd(msg: Message):
+    if not is_admin(msg.from_user.id): return
+    text = metrics.render() or "—"
+    await msg.answer(f"<pre>{text[:3900]}</pre>")
 import os
 import sys
 
 @dp.message(Command("restart"))
 async def restart_bot(msg: Message):
     """Перезапуск бота вручную (только для админов)"""
-    if msg.from_user.id not in ADMIN_IDS:
+    if msg.from_user.id not in venue.ADMIN_IDS:
         await msg.answer("⛔ У вас нет прав для перезапуска бота.")
         return
 
     await msg.answer("♻️ Перезапуск бота...")
 
     # Отправляем уведомление в консоль
-    print(f"[SYSTEM] Бот перезапускается по команде от @{msg.from_user.username} ({msg.from_user.id})")
+    logger.warning("[SYSTEM] Бот перезапускается по команде от @%s (%s)", msg.from_user.username, msg.from_user.id)
 
-    # Закрываем соединения с БД, если нужно
-    try:
-        conn.commit()
-        conn.close()
-    except Exception:
-        pass
+    # остановка приёма апдейтов, дожидаемся текущих хендлеров, закрываем БД, затем execv
+    lifecycle.request_stop(restart=True)
+
+@dp.message(Command("db_maint"))
+async def db_maint_cmd(msg: Message):
+    if not is_admin(msg.from_user.id): return
+    await msg.answer("🛠 Запускаю обслуживание БД...")
+    await msg.answer(await run_db_maintenance())
 
-    # Перезапуск процесса
-    os.execv(sys.executable, ['python'] + sys.argv)
+@dp.message(Command("settings"))
+async def settings_cmd(msg: Message):
+    if not is_admin(msg.from_user.id): return
+    await msg.answer(settings_text())
+
+@dp.message(Command("set"))
+async def set_cmd(msg: Message):
+    if not is_admin(msg.from_user.id): return
+    parts = (msg.text or "").split(maxsplit=2)
+    if len(parts) < 3:
+        return await msg.answer("Формат: <code>/set ключ значение</code> (или <code>/set ключ -</code>)\nСписок: /settings")
+    key, raw = parts[1].strip().lower(), parts[2].strip()
+    try:
+        value = await set_setting(key, None if raw == "-" else raw, msg.from_user.id)
+    except ValueError as e:
+        return await msg.answer(f"⚠️ {key}: {html.escape(str(e))}")
+    logger.warning("[SETTINGS] %s=%r (admin %s)", key, raw, msg.from_user.id)
+    shown = SETTING_TYPES[key][2](value)
+    await msg.answer(f"✅ <code>{key}</code> = <b>{html.escape(shown)}</b> (версия {SETTINGS.version})"
+                     + (" — сброшено к .env" if raw == "-" else ""))
 
 @dp.message(Command("purge"))
 async def purge_cmd(msg: Message):
     if not is_admin(msg.from_user.id): return
-    before = cur.execute("SELECT COUNT(*) FROM codes WHERE valid=1").fetchone()[0]
-    invalidate_expired()
-    after = cur.execute("SELECT COUNT(*) FROM codes WHERE valid=1").fetchone()[0]
-    await msg.answer(f"🧹 Просроченные коды аннулированы.\nАктивных было: {before}, стало: {after}.")
+    await msg.answer(await purge_report())
 
 @dp.message(Command("r_today"))
 async def r_today(msg: Message):
     if not is_admin(msg.from_user.id): return
-    rows = get_reservations_by_date(ymd(now_tz()))
+    today = ymd(now_tz())
+    rows = await get_reservations_by_date(today)
     if not rows: return await msg.answer("На сегодня броней нет.")
-    lines = ["📆 Брони на сегодня:"]
+    lines = [f"📆 Брони на сегодня (занято {capacity.day_load(today)}/{capacity.seats_per_day} мест):"]
     for (rid, name, phone, covers, r_time, status, note) in rows:
-        line = f"#{rid} {r_time} — {name} ({phone}), гостей: {covers}, статус: {status}"
-        if note: line += f"\n   ✍️ {note}"
+        line = f"#{rid} {r_time} — {html.escape(name)} ({html.escape(phone)}), гостей: {covers}, статус: {status}"
+        if note: line += f"\n   ✍️ {html.escape(note)}"
         lines.append(line)
     await msg.answer("\n".join(lines))
 
@@ -1277,11 +4559,11 @@ async def r_find(msg: Message):
     if not is_admin(msg.from_user.id): return
     parts = msg.text.split(maxsplit=1)
     if len(parts) < 2: return await msg.answer("Использование: <code>/r_find 90</code>")
-    rows = find_reservations_by_phone(parts[1].strip())
+    rows = await find_reservations_by_phone(parts[1].strip())
     if not rows: return await msg.answer("Ничего не найдено.")
     lines = ["🔎 Найденные брони:"]
     for (rid, name, phone, covers, r_date, r_time, status) in rows[:30]:
-        lines.append(f"#{rid} {r_date} {r_time} — {name} ({phone}), гостей: {covers}, статус: {status}")
+        lines.append(f"#{rid} {r_date} {r_time} — {html.escape(name)} ({html.escape(phone)}), гостей: {covers}, статус: {status}")
     await msg.answer("\n".join(lines))
 
 @dp.message(Command("r_confirm"))
@@ -1290,7 +4572,7 @@ async def r_confirm(msg: Message):
     parts = msg.text.split()
     if len(parts) != 2 or not parts[1].isdigit():
         return await msg.answer("Использование: <code>/r_confirm 123</code>")
-    set_res_status(int(parts[1]), "confirmed")
+    await set_res_status(int(parts[1]), "confirmed")
     await msg.answer(f"✅ Бронь #{parts[1]} подтверждена.")
 
 @dp.message(Command("r_cancel"))
@@ -1299,7 +4581,7 @@ async def r_cancel(msg: Message):
     parts = msg.text.split()
     if len(parts) != 2 or not parts[1].isdigit():
         return await msg.answer("Использование: <code>/r_cancel 123</code>")
-    set_res_status(int(parts[1]), "cancelled")
+    await set_res_status(int(parts[1]), "cancelled")
     await msg.answer(f"🛑 Бронь #{parts[1]} отменена.")
 
 @dp.message(Command("notify_test"))
@@ -1309,25 +4591,85 @@ async def notify_test(msg: Message):
     await notify_admins(text)
     await msg.answer("✅ Разослано.")
     # ===== PRIZES MODULE =====
-def create_prize(name: str, phone: str, prize: str, user_id: int | None = None):
-    cur.execute("""
-        INSERT INTO prizes (guest_name, guest_phone, prize, user_id, created_at)
-        VALUES (?, ?, ?, ?, ?)
-    """, (name, phone, prize, user_id, now_tz().isoformat()))
-    conn.commit()
-
-def get_all_prizes():
-    cur.execute("SELECT id, guest_name, guest_phone, prize FROM prizes ORDER BY id ASC")
-    return cur.fetchall()
-
-def del_prize(pid: int):
-    cur.execute("DELETE FROM prizes WHERE id=?", (pid,))
-    conn.commit()
-
-def clear_prizes():
-    cur.execute("DELETE FROM prizes")
-    conn.commit()
+async def create_prize(name: str, phone: str, prize: str, user_id: int | None = None):
+    return await storage.insert("""
+        INSERT INTO prizes (guest_name, guest_phone, prize, user_id, created_at, phone_norm)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (name, phone, prize, user_id, now_tz().isoformat(), normalize_phone(phone)))
+
+async def guest_user_id_by_phone(phone: str) -> Optional[int]:
+    return await storage.fetchval(
+        "SELECT user_id FROM guests WHERE phone_norm = ? AND user_id IS NOT NULL ORDER BY id DESC LIMIT 1",
+        (normalize_phone(phone),))
+
+def prize_gift_message(prize: str) -> tuple[str, InlineKeyboardBuilder]:
+    kb = InlineKeyboardBuilder()
+    kb.button(text="🍽 Забронировать стол", callback_data="reserve")
+    kb.adjust(1)
+    text = (
+        "🎉 <b>Shishka Restobar</b>\n"
+        "Вы получили подарок!\n\n"
+        f"🎁 <b>{prize}</b>\n\n"
+        "👉 Забронируйте стол и используйте свой подарок уже сегодня!"
+    )
+    return text, kb
+
+async def deliver_prize(pid: int, user_id: int, prize: str, trigger: str) -> bool:
+    """Доставка одного приза. Строка сначала помечается доставленной (delivered_at IS NULL → now),
+    поэтому регистрация гостя и еженедельная рассылка не отправят один приз дважды;
+    при ошибке отправки отметка снимается, попытка и ошибка записываются."""
+    claimed = await storage.execute(
+        "UPDATE prizes SET delivered_at = ?, user_id = ? WHERE id = ? AND delivered_at IS NULL",
+        (now_tz().isoformat(), user_id, pid))
+    if not claimed:
+        return False
+    text, kb = prize_gift_message(prize)
+    try:
+        await bot.send_message(user_id, text, reply_markup=kb.as_markup())
+    except Exception as e:
+        await storage.execute("""
+            UPDATE prizes SET delivered_at = NULL, delivery_attempts = COALESCE(delivery_attempts, 0) + 1,
+                              last_error = ?
+            WHERE id = ?
+        """, (str(e)[:200], pid))
+        metrics.inc("prizes_delivery_failed_total", trigger=trigger)
+        broadcast_log.warning("[PRIZE] #%s → %s: %s", pid, user_id, e)
+        return False
+    metrics.inc("prizes_delivered_total", trigger=trigger)
+    broadcast_log.info("[PRIZE] #%s доставлен %s (%s) — %s", pid, user_id, trigger, prize)
+    return True
+
+
+async def deliver_pending_prizes(user_id: int, phone_norm: str) -> int:
+    """Недоставленные призы по телефону (idx_prizes_pending) — сразу гостю. Возвращает число доставленных."""
+    if not phone_norm:
+        return 0
+    rows = await storage.fetchall(
+        "SELECT id, prize FROM prizes WHERE phone_norm = ? AND delivered_at IS NULL ORDER BY id", (phone_norm,))
+    sent = 0
+    for pid, prize in rows:
+        sent += await deliver_prize(pid, user_id, prize, "registration")
+    return sent
+
+
+def prize_status(delivered_at: Optional[str], attempts: Optional[int]) -> str:
+    if delivered_at:
+        return f"✅ {datetime.fromisoformat(delivered_at):%d.%m %H:%M}"
+    return f"⏳ ждёт (попыток {attempts})" if attempts else "⏳ ждёт"
+
+
+@read_only
+async def get_all_prizes():
+    return await storage.fetchall(
+        "SELECT id, guest_name, guest_phone, prize, delivered_at, delivery_attempts FROM prizes ORDER BY id ASC")
+
+async def del_prize(pid: int):
+    await storage.execute("DELETE FROM prizes WHERE id=?", (pid,))
+
+async def clear_prizes():
+    await storage.execute("DELETE FROM prizes")
 @dp.message(Command("test_prizes"))
+@read_only
 async def test_prizes(msg: Message):
     """Тестовая рассылка призов"""
     if not is_admin(msg.from_user.id):
@@ -1340,7 +4682,7 @@ async def test_prizes(msg: Message):
     sent_fail = 0
 
     # Берём все призы и связываем с user_id из таблицы guests
-    cur.execute("""
+    prizes = await storage.fetchall("""
         SELECT 
             p.guest_name, 
             p.guest_phone, 
@@ -1348,9 +4690,8 @@ async def test_prizes(msg: Message):
             g.user_id
         FROM prizes p
         LEFT JOIN guests g 
-        ON REPLACE(g.phone, '+', '') LIKE '%' || REPLACE(p.guest_phone, '+', '') || '%'
+        ON g.phone_norm = p.phone_norm
     """)
-    prizes = cur.fetchall()
 
     for prize in prizes:
         name, phone, prize_name, user_id = prize
@@ -1369,15 +4710,15 @@ async def test_prizes(msg: Message):
             if user_id:
                 await bot.send_message(user_id, text, reply_markup=kb.as_markup(), parse_mode="HTML")
                 sent_ok += 1
-                print(f"[OK] Приз отправлен {name} ({phone}) — {prize_name}")
+                broadcast_log.info("[PRIZE] Приз отправлен %s (%s) — %s", name, phone, prize_name)
             else:
                 await notify_admins(
                     f"⚠️ Не удалось отправить сообщение призёру\n"
-                    f"{name} ({phone}) — {prize_name}\n"
+                    f"{html.escape(name)} ({html.escape(phone)}) — {html.escape(prize_name)}\n"
                     f"(гость не активировал бота)\n"
                     f"📩 Приз будет автоматически отправлен после регистрации."
                 )
-                print(f"[WAITING] {name} ({phone}) ожидает активации для приза: {prize_name}")
+                broadcast_log.info("[PRIZE] %s (%s) ожидает активации для приза: %s", name, phone, prize_name)
                 sent_fail += 1
 
         except Exception as e:
@@ -1410,54 +4751,269 @@ async def add_prize(msg: Message):
         )
 
     name, phone, prize = parts[1], parts[2], parts[3]
-    create_prize(name, phone, prize)
+    pid = await create_prize(name, phone, prize)
 
     # ищем активного пользователя по номеру
-    cur.execute("""
-        SELECT user_id FROM guests
-        WHERE REPLACE(phone, '+', '') LIKE '%' || REPLACE(?, '+', '') || '%'
-    """, (phone,))
-    row = cur.fetchone()
+    user_id = await guest_user_id_by_phone(phone)
 
-    if row:
-        user_id = row[0]
-        kb = InlineKeyboardBuilder()
-        kb.button(text="🍽 Забронировать стол", callback_data="reserve")
-        kb.adjust(1)
-        text = (
-            "🎉 <b>Shishka Restobar</b>\n"
-            "Вы получили подарок!\n\n"
-            f"🎁 <b>{prize}</b>\n\n"
-            "👉 Забронируйте стол и используйте свой подарок уже сегодня!"
-        )
-        try:
-            await bot.send_message(user_id, text, reply_markup=kb.as_markup())
+    if user_id:
+        if await deliver_prize(pid, user_id, prize, "admin"):
             await msg.answer(f"✅ Приз добавлен и отправлен пользователю!\n👤 {name}\n📞 {phone}\n🎁 {prize}")
             await notify_admins(f"📤 Приз отправлен гостю @{user_id}: {prize}")
-        except Exception as e:
-            await msg.answer(f"⚠️ Добавлен, но не удалось отправить сообщение ({e})")
+        else:
+            err = await storage.fetchval("SELECT last_error FROM prizes WHERE id = ?", (pid,))
+            await msg.answer(f"⚠️ Добавлен, но не удалось отправить сообщение ({err}). "
+                             f"Повторим {prize_when_text()}.")
     else:
         await msg.answer(f"✅ Добавлен приз (гость не активировал бота):\n👤 {name}\n📞 {phone}\n🎁 {prize}")
         await notify_admins(
             f"🆕 Добавлен приз (гость не найден в боте):\n👤 {name}\n📞 {phone}\n🎁 {prize}\n"
-            f"Он получит напоминание в пятницу {PRIZE_HOUR:02d}:{PRIZE_MINUTE:02d}."
+            "Он получит приз сразу после регистрации в боте."
         )
 
 
 
+# ===== Bulk sender =====
+SEND_RATE = float(os.getenv("SEND_RATE", "20"))              # сообщений в секунду (Telegram: ~30/с на бота)
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "5"))
+
+
+class RateLimiter:
+    """Не чаще rate вызовов в секунду: каждый acquire() получает свой слот времени."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            now = time.monotonic()
+            wait = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+async def send_many(jobs: list[tuple[int, str, Optional[InlineKeyboardBuilder]]]) -> tuple[int, list[tuple[int, str]]]:
+    """Рассылка (chat_id, text, kb) с ограничением скорости и параллельности.
+    Возвращает (доставлено, [(chat_id, ошибка)])."""
+    limiter = RateLimiter(SEND_RATE)
+    sem = asyncio.Semaphore(SEND_CONCURRENCY)
+    failed: list[tuple[int, str]] = []
+
+    async def one(chat_id: int, text: str, kb: Optional[InlineKeyboardBuilder]) -> bool:
+        markup = kb.as_markup() if kb else None
+        async with sem:
+            for attempt in range(2):
+                await limiter.acquire()
+                try:
+                    await bot.send_message(chat_id, text, reply_markup=markup)
+                    return True
+                except TelegramRetryAfter as e:
+                    if attempt:
+                        failed.append((chat_id, str(e)))
+                        return False
+                    await asyncio.sleep(e.retry_after)
+                except Exception as e:
+                    broadcast_log.warning("[SEND] %s: %s", chat_id, e)
+                    failed.append((chat_id, str(e)))
+                    return False
+        return False
+
+    async def counted(job) -> bool:
+        try:
+            return await one(*job)
+        finally:  # глубина очереди рассылки — видна в админ-панели
+            metrics.set("bulk_pending", metrics.get("bulk_pending") - 1)
+
+    metrics.set("bulk_pending", metrics.get("bulk_pending") + len(jobs))
+    results = await asyncio.gather(*(counted(job) for job in jobs))
+    sent = sum(results)
+    metrics.inc("bulk_sent_total", sent)
+    metrics.inc("bulk_failed_total", len(failed))
+    return sent, failed
+
+
+# ===== Bulk prize import =====
+PRIZE_IMPORT_MAX_BYTES = int(os.getenv("PRIZE_IMPORT_MAX_BYTES", str(2 * 1024 * 1024)))
+IMPORT_WAIT = venue_local("import_wait", lambda v: set())   # админы, от которых ждём файл
+
+
+def _read_table(filename: str, data: bytes) -> list[list]:
+    """Строки CSV (разделитель , ; или таб) или первого листа XLSX."""
+    if filename.lower().endswith(".xlsx"):
+        try:
+            import openpyxl
+        except ImportError as e:
+            raise ValueError("для XLSX нужен пакет openpyxl (pip install openpyxl) — или пришлите CSV") from e
+        wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            return [list(r) for r in wb.worksheets[0].iter_rows(values_only=True)]
+        finally:
+            wb.close()
+    for enc in ("utf-8-sig", "cp1251"):
+        try:
+            text = data.decode(enc)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        raise ValueError("не удалось определить кодировку файла")
+    first = text.split("\n", 1)[0]
+    delimiter = max(";,\t", key=first.count)  # Excel в ru-локали сохраняет CSV через ";"
+    return list(csv.reader(io.StringIO(text), delimiter=delimiter))
+
+
+def _cell(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)  # телефон из Excel приходит числом 998901234567.0
+    return "" if value is None else str(value).strip()
+
+
+def parse_prize_rows(filename: str, data: bytes) -> tuple[list[tuple[str, str, str, str]], list[tuple[int, str]]]:
+    """Один проход: ([(имя, телефон, приз, phone_norm)], [(номер строки, причина)]).
+    Колонки: Имя, Телефон, Приз; строка заголовка пропускается."""
+    valid: list[tuple[str, str, str, str]] = []
+    invalid: list[tuple[int, str]] = []
+    seen: dict[tuple[str, str], int] = {}
+    for line_no, raw in enumerate(_read_table(filename, data), start=1):
+        cells = [_cell(c) for c in raw]
+        if not any(cells):
+            continue
+        if len(cells) < 3 or not all(cells[:3]):
+            if line_no == 1:
+                continue
+            invalid.append((line_no, "нужны 3 колонки: имя, телефон, приз"))
+            continue
+        name, phone, prize = cells[0][:100], cells[1], cells[2][:200]
+        norm = normalize_phone(phone)
+        if not 10 <= len(norm) <= 15:
+            if line_no == 1:
+                continue  # заголовок «Имя;Телефон;Приз»
+            invalid.append((line_no, f"телефон «{phone}»"))
+            continue
+        key = (norm, prize.lower())
+        if key in seen:
+            invalid.append((line_no, f"повтор строки {seen[key]}"))
+            continue
+        seen[key] = line_no
+        valid.append((name, phone, prize, norm))
+    return valid, invalid
+
+
+async def import_prizes(rows: list[tuple[str, str, str, str]], batch: str) -> list:
+    """Вставка всех призов одной транзакцией + привязка к гостям одним запросом по phone_norm.
+    Возвращает [(id, имя, телефон, приз, user_id|None)]."""
+    created = now_tz().isoformat()
+    async with storage.transaction():
+        await storage.executemany("""
+            INSERT INTO prizes (guest_name, guest_phone, prize, user_id, created_at, phone_norm, import_batch)
+            VALUES (?, ?, ?, NULL, ?, ?, ?)
+        """, [(name, phone, prize, created, norm, batch) for name, phone, prize, norm in rows])
+        await storage.execute("""
+            UPDATE prizes
+            SET user_id = (SELECT MAX(g.user_id) FROM guests g WHERE g.phone_norm = prizes.phone_norm)
+            WHERE import_batch = ?
+        """, (batch,))
+    return await storage.fetchall(
+        "SELECT id, guest_name, guest_phone, prize, user_id FROM prizes WHERE import_batch = ? ORDER BY id", (batch,))
+
+
+async def handle_prize_import(msg: Message):
+    doc = msg.document
+    IMPORT_WAIT.discard(msg.from_user.id)
+    name = doc.file_name or ""
+    if not name.lower().endswith((".csv", ".xlsx")):
+        return await msg.answer("⚠️ Нужен файл .csv или .xlsx (колонки: Имя, Телефон, Приз).")
+    if doc.file_size and doc.file_size > PRIZE_IMPORT_MAX_BYTES:
+        return await msg.answer(f"⚠️ Файл больше {PRIZE_IMPORT_MAX_BYTES // 1024} КБ.")
+    buf = await bot.download(doc, destination=io.BytesIO())
+    try:
+        rows, invalid = parse_prize_rows(name, buf.getvalue())
+    except Exception as e:
+        return await msg.answer(f"⚠️ Не удалось прочитать файл: {html.escape(str(e))}")
+    if not rows:
+        return await msg.answer(f"⚠️ В файле нет корректных строк (ошибок: {len(invalid)}).")
+
+    batch = f"{now_tz():%Y%m%d%H%M%S}-{msg.from_user.id}"
+    saved = await import_prizes(rows, batch)
+    matched = [r for r in saved if r[4]]
+    unmatched = [r for r in saved if not r[4]]
+    await msg.answer(f"⏳ Добавлено {len(saved)} призов, отправляю уведомления {len(matched)} гостям...")
+
+    # помечаем партию доставленной до отправки (как deliver_prize), неудачные потом возвращаем в очередь
+    await storage.execute(
+        "UPDATE prizes SET delivered_at = ? WHERE import_batch = ? AND user_id IS NOT NULL AND delivered_at IS NULL",
+        (now_tz().isoformat(), batch))
+    jobs = []
+    for _pid, _name, _phone, prize, user_id in matched:
+        text, kb = prize_gift_message(prize)
+        jobs.append((user_id, text, kb))
+    sent, failed = await send_many(jobs)
+    if failed:
+        await storage.executemany("""
+            UPDATE prizes SET delivered_at = NULL, delivery_attempts = COALESCE(delivery_attempts, 0) + 1,
+                              last_error = ?
+            WHERE import_batch = ? AND user_id = ?
+        """, [(err[:200], batch, chat_id) for chat_id, err in failed])
+    metrics.inc("prizes_delivered_total", sent, trigger="import")
+    metrics.inc("prizes_delivery_failed_total", len(failed), trigger="import")
+
+    lines = [
+        f"📥 <b>Импорт призов</b> ({html.escape(name)})",
+        f"✅ Добавлено: <b>{len(saved)}</b>",
+        f"👤 Найдены в боте: <b>{len(matched)}</b> (доставлено {sent}, ошибок {len(failed)})",
+        f"🕳 Не найдены: <b>{len(unmatched)}</b> — получат приз сразу после регистрации в боте",
+        f"❌ Ошибки в строках: <b>{len(invalid)}</b>",
+    ]
+    if unmatched:
+        lines.append("\n<b>Не найдены:</b>")
+        lines += [f"— {html.escape(n)} ({html.escape(p)}) — {html.escape(pr)}" for _, n, p, pr, _ in unmatched[:20]]
+        if len(unmatched) > 20:
+            lines.append(f"… и ещё {len(unmatched) - 20}")
+    if invalid:
+        lines.append("\n<b>Пропущены строки:</b>")
+        lines += [f"— строка {n}: {html.escape(reason)}" for n, reason in invalid[:20]]
+        if len(invalid) > 20:
+            lines.append(f"… и ещё {len(invalid) - 20}")
+    await msg.answer("\n".join(lines))
+    logger.info("[IMPORT] batch=%s rows=%d matched=%d sent=%d invalid=%d",
+                batch, len(saved), len(matched), sent, len(invalid))
+
+
+IMPORT_HINT = ("📥 Пришлите файл <b>.csv</b> или <b>.xlsx</b> с колонками:\n"
+               "<code>Имя;Телефон;Приз</code>\n"
+               "Гости, уже зарегистрированные в боте, получат уведомление сразу.")
+
+@dp.message(Command("import_prizes"))
+async def import_prizes_cmd(msg: Message):
+    if not is_admin(msg.from_user.id): return
+    if msg.document:  # файл с подписью /import_prizes
+        return await handle_prize_import(msg)
+    IMPORT_WAIT.add(msg.from_user.id)
+    await msg.answer(IMPORT_HINT)
+
+@dp.message(F.document, lambda m: m.from_user and m.from_user.id in IMPORT_WAIT)
+async def import_prizes_file(msg: Message):
+    if not is_admin(msg.from_user.id): return
+    await handle_prize_import(msg)
+
+
 @dp.message(Command("prizes"))
 async def prizes_list(msg: Message):
     """Вывод списка призов"""
     if not is_admin(msg.from_user.id):
         return
-    rows = get_all_prizes()
+    rows = await get_all_prizes()
     kb = InlineKeyboardBuilder()
     kb.button(text="➕ Добавить приз", callback_data="add_prize_hint")
     kb.adjust(1)
     if not rows:
         return await msg.answer("🎁 Список призов пуст.", reply_markup=kb.as_markup())
-    lines = [f"#{pid} {name} ({phone}) — {prize}" for pid, name, phone, prize in rows]
-    await msg.answer("🎁 <b>Текущие призы:</b>\n" + "\n".join(lines), reply_markup=kb.as_markup())
+    lines = [f"#{pid} {html.escape(name)} ({html.escape(phone)}) — {html.escape(prize)} · {prize_status(at, tries)}"
+             for pid, name, phone, prize, at, tries in rows]
+    await msg.answer(_clip("🎁 <b>Текущие призы:</b>\n" + "\n".join(lines)), reply_markup=kb.as_markup())
     
 @dp.callback_query(F.data == "add_prize_hint")
 async def cb_add_prize_hint(cb: CallbackQuery):
@@ -1476,14 +5032,14 @@ async def prize_delete(msg: Message):
     if len(parts) < 2 or not parts[1].isdigit():
         return await msg.answer("Использование: /del_prize ID")
     pid = int(parts[1])
-    del_prize(pid)
+    await del_prize(pid)
     await msg.answer(f"🗑 Приз #{pid} удалён.")
 
 @dp.message(Command("clear_prizes"))
 async def prizes_clear(msg: Message):
     if not is_admin(msg.from_user.id):
         return
-    clear_prizes()
+    await clear_prizes()
     await msg.answer("🧹 Все призы удалены.")
 
 
@@ -1492,13 +5048,13 @@ async def whereami(msg: Message):
     if not is_admin(msg.from_user.id): return
     await msg.answer(f"chat.id = <code>{msg.chat.id}</code>\nchat.type = {msg.chat.type}\nchat.title = {msg.chat.title}")
 @dp.message(Command("rewards"))
+@read_only
 async def list_rewards(msg: Message):
     """Показать, кто что выиграл"""
     if not is_admin(msg.from_user.id):
         return
 
-    cur.execute("SELECT user_id, prize, date_issued FROM random_rewards ORDER BY date_issued DESC")
-    rows = cur.fetchall()
+    rows = await storage.fetchall("SELECT user_id, prize, date_issued FROM random_rewards ORDER BY date_issued DESC")
 
     if not rows:
         return await msg.answer("🎲 История розыгрышей пуста.")
@@ -1522,29 +5078,30 @@ async def redeem_code(msg: Message):
     if len(parts) < 2:
         return await msg.answer("Использование: <code>/redeem CODE</code>\nПример: <code>/redeem ABC123</code>")
 
-    code = parts[1].strip().upper()
+    code = normalize_code(parts[1])
+    rejected = offline_reject(code, CODE_KIND_REWARD, 7)
+    if rejected:
+        return await msg.answer(f"❌ Код <code>{fmt_code(code)}</code>: {rejected[1]}.")
 
     # Ищем код
-    cur.execute("""
+    row = await storage.fetchone("""
         SELECT id, user_id, prize, date_issued, redeemed
         FROM random_rewards
         WHERE reward_code = ?
         LIMIT 1
     """, (code,))
-    row = cur.fetchone()
 
     if not row:
-        return await msg.answer(f"❌ Код <code>{code}</code> не найден.")
+        return await msg.answer(f"❌ Код <code>{fmt_code(code)}</code> не найден.")
     
     rid, user_id, prize, date_issued, redeemed = row
 
     if redeemed:
-        cur.execute("""
+        used = await storage.fetchone("""
             SELECT redeemed_by_fullname, redeemed_by_username, redeemed_at
             FROM random_rewards
             WHERE id = ?
         """, (rid,))
-        used = cur.fetchone()
         if used:
             name, username, used_at = used
             await msg.answer(
@@ -1565,7 +5122,7 @@ async def redeem_code(msg: Message):
     redeemed_at = datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
 
 
-    cur.execute("""
+    await storage.execute("""
         UPDATE random_rewards
         SET redeemed = 1,
             redeemed_by_user_id = ?,
@@ -1574,16 +5131,15 @@ async def redeem_code(msg: Message):
             redeemed_at = ?
         WHERE id = ?
     """, (redeemer_id, redeemer_username, redeemer_fullname, redeemed_at, rid))
-    conn.commit()
+    await track(user_id, "redeem")
 
             # Уведомляем всех админов
     # Получаем данные о настоящем победителе (из winner_*)
-    cur.execute("""
+    winner_data = await storage.fetchone("""
         SELECT winner_username, winner_fullname 
         FROM random_rewards 
         WHERE id = ?
     """, (rid,))
-    winner_data = cur.fetchone()
 
     if winner_data:
         winner_username, winner_fullname = winner_data
@@ -1591,13 +5147,12 @@ async def redeem_code(msg: Message):
         winner_username, winner_fullname = None, None
 
     # Пробуем получить номер телефона победителя из таблицы guests
-    cur.execute("SELECT phone FROM guests WHERE user_id = ?", (user_id,))
-    phone_row = cur.fetchone()
+    phone_row = await storage.fetchone("SELECT phone FROM guests WHERE user_id = ?", (user_id,))
     winner_phone = phone_row[0] if phone_row and phone_row[0] else '—'
 
     text_admin = (
         f"🎟 <b>Код погашен!</b>\n"
-        f"🎫 Код: <code>{code}</code>\n"
+        f"🎫 Код: <code>{fmt_code(code)}</code>\n"
         f"🏆 Приз: {prize}\n"
         f"👤 Погасил: @{redeemer_username or '—'}\n"
         f"🕒 Время: {redeemed_at}\n"
@@ -1605,17 +5160,17 @@ async def redeem_code(msg: Message):
     )
 
 
-    for aid in ADMIN_IDS:
+    for aid in venue.ADMIN_IDS:
         try:
             await bot.send_message(aid, text_admin)
         except Exception as e:
-            print(f"[NOTIFY][ERROR] не удалось отправить админу {aid}: {e}")
+            logger.error("[NOTIFY] не удалось отправить админу %s: %s", aid, e)
             pass
 
-    await msg.answer(f"✅ Код <code>{code}</code> подтверждён.\n🎁 Приз: <b>{prize}</b>")
+    await msg.answer(f"✅ Код <code>{fmt_code(code)}</code> подтверждён.\n🎁 Приз: <b>{prize}</b>")
 
     try:
-        await bot.send_message(user_id, f"🔔 Ваш код <code>{code}</code> был успешно использован. Спасибо! 🎉")
+        await bot.send_message(user_id, f"🔔 Ваш код <code>{fmt_code(code)}</code> был успешно использован. Спасибо! 🎉")
     except Exception:
         pass
 
@@ -1624,24 +5179,24 @@ async def inactive_report(msg: Message):
     if not is_admin(msg.from_user.id):
         return
     limit_date = (now_tz() - timedelta(days=30)).isoformat()
-    cur.execute("SELECT COUNT(*) FROM users WHERE last_seen < ?", (limit_date,))
-    inactive = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM users")
-    total = cur.fetchone()[0]
+    inactive = await count_users_inactive_since(limit_date)
+    total = await count_all_users()
     await msg.answer(f"🧊 Неактивных более 30 дней: <b>{inactive}</b> из {total}")
 
+SHOW_PRIZES_QR = int(os.getenv("SHOW_PRIZES_QR", "3"))  # сколько QR активных призов показывать
+
+
 @dp.message(F.text == "🎁 Узнать свой приз")
 async def show_all_prizes(msg: Message):
     """Показать все призы пользователя"""
     user_id = msg.from_user.id
 
-    cur.execute("""
+    results = await storage.fetchall("""
         SELECT prize, reward_code, date_issued, redeemed, redeemed_at
         FROM random_rewards
         WHERE user_id = ?
         ORDER BY id DESC
     """, (user_id,))
-    results = cur.fetchall()
 
     if not results:
         await msg.answer("😔 У вас пока нет выигрышей.\nНажмите 🎲 <b>Испытай удачу</b>, чтобы сыграть!")
@@ -1660,7 +5215,7 @@ async def show_all_prizes(msg: Message):
             status = "🟢 <b>Активен</b>"
         message_lines.append(
             f"{idx}. <b>{prize}</b>\n"
-            f"🔢 Код: <code>{code}</code>\n"
+            f"🔢 Код: <code>{fmt_code(code)}</code>\n"
             f"📅 Выдан: {date_str}\n"
             f"{status}\n"
         )
@@ -1668,6 +5223,12 @@ async def show_all_prizes(msg: Message):
     text = "\n".join(message_lines)
     await msg.answer(text, reply_markup=main_reply_kb())
 
+    # QR активных призов: file_id уже в кэше с момента выигрыша, повторно ничего не загружаем
+    active = [(prize, code) for prize, code, _, used, _ in results if not used][:SHOW_PRIZES_QR]
+    for prize, code in active:
+        if not await send_code_qr(msg.chat.id, code, f"🎁 <b>{prize}</b>\n🔢 <code>{fmt_code(code)}</code>"):
+            break
+
 
 
 # Access callbacks
@@ -1675,7 +5236,7 @@ async def show_all_prizes(msg: Message):
 async def cb_approve(cb: CallbackQuery):
     if not is_admin(cb.from_user.id): return await cb.answer()
     uid = int(cb.data.split(":", 1)[1])
-    approve_user(uid)
+    await approve_user(uid)
     try:
         await bot.send_message(uid, "✅ Доступ одобрен. Нажмите /start")
     except Exception:
@@ -1687,7 +5248,7 @@ async def cb_approve(cb: CallbackQuery):
 async def cb_block(cb: CallbackQuery):
     if not is_admin(cb.from_user.id): return await cb.answer()
     uid = int(cb.data.split(":", 1)[1])
-    block_user(uid)
+    await block_user(uid)
     try:
         await bot.send_message(uid, "⛔ Доступ закрыт.")
     except Exception:
@@ -1715,240 +5276,1097 @@ async def cb_redeem_prompt(cb: CallbackQuery):
    
 
 # ===== Background jobs =====
-def stats_for_day_ymd_str(ymd_str: str) -> tuple[int,int,int]:
-    cur.execute("SELECT COUNT(*) FROM codes WHERE day_key=?", (ymd_str,))
-    codes_count = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM reservations WHERE r_date=?", (ymd_str,))
-    res_count = cur.fetchone()[0]
+@read_only
+async def stats_for_day_ymd_str(ymd_str: str) -> tuple[int,int,int]:
+    codes_count = await storage.fetchval("SELECT COUNT(*) FROM codes WHERE day_key=?", (ymd_str,), default=0)
+    codes_count += await rollup_value("codes", ymd_str)
+    res_count = await storage.fetchval("SELECT COUNT(*) FROM reservations WHERE r_date=?", (ymd_str,), default=0)
+    res_count += await rollup_value("res_date", ymd_str)
     dt = datetime.strptime(ymd_str, "%Y-%m-%d").date()
-    disc = DISCOUNTS.get(dt.weekday(), 0)
+    disc = discount_for_date(dt)
     return codes_count, res_count, disc
-async def rewards_expiry_task():
-    """Следит за сроком действия призов"""
-    while True:
+def _fmt_bytes(n: int) -> str:
+    for unit in ("Б", "КБ", "МБ"):
+        if n < 1024:
+            return f"{n:.0f} {unit}"
+        n /= 1024
+    return f"{n:.1f} ГБ"
+
+async def run_db_maintenance(archived: Optional[dict[str, int]] = None) -> str:
+    """Обслуживание БД + текст отчёта для админов."""
+    st = await storage.maintenance()
+    for table, n in st["tables"].items():
+        metrics.set("db_rows", n, table=table)
+    lines = ["🛠 <b>Обслуживание БД</b>"]
+    if "page_count" in st:
+        metrics.set("db_wal_bytes", st["wal_after"])
+        metrics.set("db_pages", st["page_count"])
+        metrics.set("db_freelist_pages", st["freelist"])
+        lines += [
+            f"WAL: {_fmt_bytes(st['wal_before'])} → {_fmt_bytes(st['wal_after'])}"
+            + (" (checkpoint занят, не до конца)" if st["checkpoint_busy"] else ""),
+            f"Страниц: {st['page_count']} × {st['page_size']} = {_fmt_bytes(st['page_count'] * st['page_size'])}",
+            f"Свободных страниц: {st['freelist_before']} → {st['freelist']}"
+            + (" (полный VACUUM)" if st.get("full_vacuum") else ""),
+            f"Время: {st['seconds']} с",
+        ]
+    if archived:
+        lines.append("В архив: " + ", ".join(f"{t} {n}" for t, n in archived.items()))
+    lines.append("")
+    lines += [f"{table}: <b>{n}</b>" for table, n in st["tables"].items()]
+    return "\n".join(lines)
+
+async def check_rewards_expiry():
+    """Следит за сроком действия призов (раз в 30 минут, под супервизором)"""
+    now = datetime.now(timezone.utc)
+
+    rows = await storage.fetchall("""
+        SELECT id, user_id, prize, reward_code, expiry_date, notified_24h, expired
+        FROM random_rewards
+        WHERE redeemed = 0
+    """)
+    for rid, uid, prize, code, expiry_date, notified, expired in rows:
+        if not expiry_date:
+            continue
         try:
-            from datetime import datetime, timezone
-            now = datetime.now(timezone.utc)
+            expiry = datetime.fromisoformat(expiry_date)
+        except Exception:
+            continue
 
-            cur.execute("""
-                SELECT id, user_id, prize, reward_code, expiry_date, notified_24h, expired
-                FROM random_rewards
-                WHERE redeemed = 0
-            """)
-            for rid, uid, prize, code, expiry_date, notified, expired in cur.fetchall():
-                if not expiry_date:
-                    continue
+        delta = (expiry - now).total_seconds()
+
+        # 🔔 за 24 часа до истечения
+        if 0 < delta <= 24*3600 and not notified:
+            await bot.send_message(
+                uid,
+                f"⏳ Ваш приз <b>{prize}</b> (код <code>{fmt_code(code)}</code>) "
+                "истекает через 24 часа! Заберите подарок у администратора 🎁"
+            )
+            await storage.execute("UPDATE random_rewards SET notified_24h = 1 WHERE id = ?", (rid,))
+
+        # ❌ истёк
+        if delta <= 0 and not expired:
+            await storage.execute("UPDATE random_rewards SET expired = 1 WHERE id = ?", (rid,))
+            await bot.send_message(
+                uid,
+                f"❌ Ваш приз <b>{prize}</b> (код <code>{fmt_code(code)}</code>) истёк и больше недоступен."
+            )
+            for aid in venue.ADMIN_IDS:
                 try:
-                    expiry = datetime.fromisoformat(expiry_date)
+                    await bot.send_message(
+                        aid,
+                        f"⚠️ Приз истёк\nКод: <code>{fmt_code(code)}</code>\nПриз: {prize}\nПользователь ID: {uid}"
+                    )
                 except Exception:
-                    continue
+                    pass
+
+# ===== Scheduler =====
+# Ежедневные/еженедельные задачи спят ровно до своего времени (TaskSupervisor.scheduled).
+# Время берётся из настроек (cfg): если админ поменял его через /set, задача
+# просыпается по settings_changed и пересчитывает следующий запуск.
+def next_run_at(now: datetime, hhmm: tuple[int, int], weekday: Optional[int] = None) -> datetime:
+    due = now.replace(hour=hhmm[0], minute=hhmm[1], second=0, microsecond=0)
+    if weekday is not None:
+        due += timedelta(days=(weekday - now.weekday()) % 7)
+    if due <= now:
+        due += timedelta(days=7 if weekday is not None else 1)
+    return due
+
+
+async def reminder_job():
+    """Напоминание за несколько минут до окна выдачи кодов."""
+    now = now_tz()
+    disc = today_discount()
+    s_h,s_m=cfg("codes_window_start"); e_h,e_m=cfg("codes_window_end")
+    mins = max(1, round((now.replace(hour=s_h, minute=s_m, second=0, microsecond=0) - now).total_seconds() / 60))
+    text = (f"⏳ Через {mins} мин (в {s_h:02d}:{s_m:02d}) стартует окно получения кода!\n"
+            f"Сегодня скидка по браслету: <b>{disc}%</b>.\n"
+            f"Окно: <b>{s_h:02d}:{s_m:02d}–{e_h:02d}:{e_m:02d}</b>.\n"
+            "Жмите «🎟 Получить код» в боте.")
+    # 🔔 Отправляем уведомление всем подписанным пользователям
+    try:
+        limit_date = (now - timedelta(days=30)).isoformat()
+        all_users = await active_subscriber_ids(limit_date)
+        for uid in all_users:
+            try:
+                await bot.send_message(uid, text)
+            except Exception as e:
+                broadcast_log.warning("[REMINDER] Не удалось отправить уведомление пользователю %s: %s", uid, e)
+    except Exception as e:
+        logger.error("[DB] Ошибка при рассылке подписчикам: %s", e)
 
-                delta = (expiry - now).total_seconds()
+    # 📢 Отправляем уведомление также администраторам
+    await notify_admins(text)
 
-                # 🔔 за 24 часа до истечения
-                if 0 < delta <= 24*3600 and not notified:
-                    await bot.send_message(
-                        uid,
-                        f"⏳ Ваш приз <b>{prize}</b> (код <code>{code}</code>) "
-                        "истекает через 24 часа! Заберите подарок у администратора 🎁"
-                    )
-                    cur.execute("UPDATE random_rewards SET notified_24h = 1 WHERE id = ?", (rid,))
-                    conn.commit()
 
-                # ❌ истёк
-                if delta <= 0 and not expired:
-                    cur.execute("UPDATE random_rewards SET expired = 1 WHERE id = ?", (rid,))
-                    conn.commit()
-                    await bot.send_message(
-                        uid,
-                        f"❌ Ваш приз <b>{prize}</b> (код <code>{code}</code>) истёк и больше недоступен."
-                    )
-                    for aid in ADMIN_IDS:
-                        try:
-                            await bot.send_message(
-                                aid,
-                                f"⚠️ Приз истёк\nКод: <code>{code}</code>\nПриз: {prize}\nПользователь ID: {uid}"
-                            )
-                        except Exception:
-                            pass
+async def daily_report_job():
+    """Отчёт за вчера, затем архив и обслуживание БД (ночью нагрузки нет)."""
+    yesterday = (now_tz() - timedelta(days=1)).date()
+    ykey = ymd(yesterday)
+    codes, resv, disc = await stats_for_day_ymd_str(ykey)
+    text = (f"📊 Отчёт за вчера ({ykey}):\n"
+            f"— Выдано кодов: <b>{codes}</b>\n"
+            f"— Создано броней: <b>{resv}</b>\n"
+            f"— Скидка дня была: <b>{disc}%</b>")
+    await notify_admins(text)
+
+    if DB_MAINTENANCE:
+        try:
+            await notify_admins(await run_db_maintenance(await archive_old_rows()))
         except Exception as e:
-            print(f"[rewards_expiry_task] ошибка: {e}")
+            logger.exception("[DB-MAINT] %s", e)
 
-        await asyncio.sleep(1800)
 
-async def notifier_task():
-    sent_reminder_day = None
-    sent_report_day = None
-    while True:
+async def prize_broadcast_job():
+    """Повторная доставка недоставленных призов (день и время — prize_day/prize_time).
+    Доставленные строки не трогаем; гостей, ещё не открывших бота, перечисляем админам одним сообщением."""
+    await storage.execute("""
+        UPDATE prizes
+        SET user_id = (SELECT MAX(g.user_id) FROM guests g WHERE g.phone_norm = prizes.phone_norm)
+        WHERE delivered_at IS NULL AND user_id IS NULL
+    """)
+    prizes = await storage.fetchall("""
+        SELECT id, guest_name, guest_phone, prize, user_id FROM prizes
+        WHERE delivered_at IS NULL ORDER BY id ASC
+    """)
+    if not prizes:
+        return
+    sent_ok = 0
+    sent_fail = 0
+    waiting = []
+    for pid, name, phone, prize, user_id in prizes:
+        if not user_id:
+            waiting.append(f"— {html.escape(name)} ({html.escape(phone)}) — {html.escape(prize)}")
+        elif await deliver_prize(pid, user_id, prize, "weekly"):
+            sent_ok += 1
+        else:
+            sent_fail += 1
+    lines = [f"📤 Рассылка призов завершена.\n✅ Отправлено: {sent_ok}\n"
+             f"⚠️ Ошибка отправки: {sent_fail}\n🕳 Гость не активировал бота: {len(waiting)}"]
+    if waiting:
+        lines.append("\n<b>Ждут регистрации</b> (приз уйдёт сразу после неё):")
+        lines += waiting[:20]
+        if len(waiting) > 20:
+            lines.append(f"… и ещё {len(waiting) - 20}")
+    await notify_admins("\n".join(lines))
+
+@read_only
+async def weekly_report_job():
+    """Еженедельный отчёт администраторам (по понедельникам в 10:00)"""
+    now = now_tz()
+    # вычисляем диапазон прошлой недели
+    week_start = now - timedelta(days=7)
+    week_end = now - timedelta(days=1)
+    start_key = ymd(week_start)
+    end_key = ymd(week_end)
+
+    # подсчёт пользователей (substr вместо DATE() — работает и на SQLite, и на Postgres)
+    new_users = await storage.fetchval("""
+        SELECT COUNT(*) FROM users
+        WHERE substr(joined_at, 1, 10) BETWEEN ? AND ?
+    """, (start_key, end_key), default=0)
+
+    # коды
+    codes = await storage.fetchval("""
+        SELECT COUNT(*) FROM codes
+        WHERE substr(issued_at, 1, 10) BETWEEN ? AND ?
+    """, (start_key, end_key), default=0)
+    codes += await rollup_value("codes", start_key, end_key)
+
+    # брони
+    resv = await storage.fetchval("""
+        SELECT COUNT(*) FROM reservations
+        WHERE substr(created_at, 1, 10) BETWEEN ? AND ?
+    """, (start_key, end_key), default=0)
+    resv += await rollup_value("res_created", start_key, end_key)
+
+    # призы (автоматические)
+    rewards = await storage.fetchval("""
+        SELECT COUNT(*) FROM random_rewards
+        WHERE substr(date_issued, 1, 10) BETWEEN ? AND ?
+    """, (start_key, end_key), default=0)
+    rewards += await rollup_value("rewards", start_key, end_key)
+
+    text = (
+        f"📊 <b>Отчёт за неделю</b>\n"
+        f"📅 {week_start.strftime('%d.%m')}–{week_end.strftime('%d.%m')}\n\n"
+        f"👥 Новых пользователей: <b>{new_users}</b>\n"
+        f"🎟 Выдано кодов: <b>{codes}</b>\n"
+        f"🍽 Создано броней: <b>{resv}</b>\n"
+        f"🎲 Разыграно призов: <b>{rewards}</b>"
+    )
+
+    await notify_admins(text)
+
+# ===== Lifecycle =====
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "20"))   # сек на завершение текущих хендлеров
+
+
+class Lifecycle:
+    """Фоновые задачи, учёт хендлеров «в полёте» и мягкая остановка/перезапуск.
+
+    request_stop(): прекращаем забирать апдейты (stop_polling), main() после выхода
+    из start_polling вызывает drain(): ждём текущие хендлеры до DRAIN_TIMEOUT,
+    отправляем буферы (альбомы отзывов), отменяем фоновые задачи, закрываем
+    сессию бота и БД. Для перезапуска затем делается execv."""
+
+    def __init__(self):
+        self.inflight = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.tasks: list[asyncio.Task] = []
+        self.stopping = False
+        self.restart = False
+
+    def spawn(self, coro, name: str) -> asyncio.Task:
+        task = asyncio.create_task(coro, name=name)
+        self.tasks.append(task)
+        return task
+
+    def enter(self):
+        self.inflight += 1
+        self.idle.clear()
+
+    def leave(self):
+        self.inflight -= 1
+        if self.inflight <= 0:
+            self.inflight = 0
+            self.idle.set()
+
+    def request_stop(self, restart: bool = False):
+        self.restart = self.restart or restart
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.warning("[LIFECYCLE] остановка (%s), хендлеров в работе: %d",
+                       "перезапуск" if self.restart else "выход", self.inflight)
+        asyncio.get_running_loop().create_task(self._stop_polling())
+
+    async def _stop_polling(self):
+        try:
+            await dp.stop_polling()
+        except RuntimeError:
+            pass  # поллинг ещё не запущен / уже остановлен
+
+    async def drain(self):
         try:
-            now = now_tz()
-            day = ymd(now)
-
-            # 11:55 reminder
-            target_rem = now.replace(hour=11, minute=55, second=0, microsecond=0)
-            if sent_reminder_day != day and abs((now - target_rem).total_seconds()) <= 90:
-                disc = today_discount()
-                s_h,s_m=CODES_WINDOW_START; e_h,e_m=CODES_WINDOW_END
-                text = (f"⏳ Через 5 минут (в {s_h:02d}:{s_m:02d}) стартует окно получения кода!\n"
-                        f"Сегодня скидка по браслету: <b>{disc}%</b>.\n"
-                        f"Окно: <b>{s_h:02d}:{s_m:02d}–{e_h:02d}:{e_m:02d}</b>.\n"
-                        "Жмите «🎟 Получить код» в боте.")
-                # 🔔 Отправляем уведомление всем подписанным пользователям
+            await asyncio.wait_for(self.idle.wait(), timeout=DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("[LIFECYCLE] не дождались %d хендлеров за %.0f с", self.inflight, DRAIN_TIMEOUT)
+        for v in VENUES:
+            with use_venue(v):
                 try:
-                    limit_date = (now - timedelta(days=30)).isoformat()
-                    cur.execute("""
-                    SELECT user_id FROM users
-                    WHERE approved = 1 AND blocked = 0 AND last_seen >= ?
-                    """, (limit_date,))
-                    all_users = [r[0] for r in cur.fetchall()]
-                    for uid in all_users:
-                        try:
-                            await bot.send_message(uid, text)
-                        except Exception as e:
-                            print(f"[WARN] Не удалось отправить уведомление пользователю {uid}: {e}")
+                    await flush_feedback_albums()
                 except Exception as e:
-                    print(f"[DB][ERROR] Ошибка при рассылке подписчикам: {e}")
-
-                # 📢 Отправляем уведомление также администраторам
-                await notify_admins(text)
-                sent_reminder_day = day
-
-            # 03:00 report for yesterday
-            target_rep = now.replace(hour=1, minute=0, second=0, microsecond=0)
-            if sent_report_day != day and abs((now - target_rep).total_seconds()) <= 59:
-                yesterday = (now - timedelta(days=1)).date()
-                ykey = ymd(yesterday)
-                codes, resv, disc = stats_for_day_ymd_str(ykey)
-                text = (f"📊 Отчёт за вчера ({ykey}):\n"
-                        f"— Выдано кодов: <b>{codes}</b>\n"
-                        f"— Создано броней: <b>{resv}</b>\n"
-                        f"— Скидка дня была: <b>{disc}%</b>")
-                await notify_admins(text)
-                sent_report_day = day
-
-            # Friday 13:00 prizes broadcast (НЕ в except!)
-            target_prize = now.replace(hour=PRIZE_HOUR, minute=PRIZE_MINUTE, second=0, microsecond=0)
-            if now.weekday() == PRIZE_DAY and abs((now - target_prize).total_seconds()) <= 59:
-
-                cur.execute("SELECT id, guest_name, guest_phone, prize, user_id FROM prizes ORDER BY id ASC")
-                prizes = cur.fetchall()
-                if prizes:
-                    sent_ok = 0
-                    sent_fail = 0
-                    for pid, name, phone, prize, user_id in prizes:
-                        text = (
-                            "🎉 <b>Shishka Restobar</b> — там, где браслет решает!\n"
-                            "Мы помним о вашем призе 🎁\n"
-                            f"Ваш приз: <b>{prize}</b>\n\n"
-                            "👉 Забронируйте стол и используйте свой приз уже сегодня!"
-                        )
-                        kb = InlineKeyboardBuilder()
-                        kb.button(text="🍽 Забронировать стол", callback_data="reserve")
-                        kb.adjust(1)
-                        try:
-                            if user_id:
-                                await bot.send_message(user_id, text, reply_markup=kb.as_markup())
-                                sent_ok += 1
-                            else:
-                                await notify_admins(
-                                    f"⚠️ Не удалось отправить сообщение призёру\n"
-                                    f"{name} ({phone}) — {prize}\n(гость не активировал бота)"
-                                )
-                                sent_fail += 1
-                        except Exception as e:
-                            print("[PRIZE][ERROR]", e)
-                            sent_fail += 1
-                    clear_prizes()
-                    await notify_admins(
-                        f"📤 Рассылка призов завершена.\n✅ Отправлено: {sent_ok}\n🕳 Не доставлено: {sent_fail}"
-                    )
+                    logger.exception("[LIFECYCLE] flush: %s", e)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for v in VENUES:
+            await v.bot.session.close()  # общая HTTP_SESSION закроется на первом, дальше — no-op
+            if "storage" in vars(v):
+                await v.storage.close()
+        logger.info("[LIFECYCLE] остановлено")
 
-        except Exception as e:
-            logger.exception("[NOTIFIER] %s", e)
+    def exec_restart(self):
+        LOG_LISTENER.stop()  # execv не вызывает atexit — дописываем логи сами
+        os.execv(sys.executable, [sys.executable] + sys.argv)
 
-        await asyncio.sleep(30)
 
-async def weekly_report_task():
-    """Еженедельный отчёт администраторам (по понедельникам в 10:00)"""
-    last_report_week = None
-    while True:
+lifecycle = Lifecycle()
+
+
+class InflightMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        lifecycle.enter()
         try:
-            now = now_tz()
-            iso_year, iso_week, _ = now.isocalendar()
-
-            # проверяем понедельник, 10:00
-            target_time = now.replace(hour=10, minute=0, second=0, microsecond=0)
-            if now.weekday() == 0 and (last_report_week != (iso_year, iso_week)) and abs((now - target_time).total_seconds()) <= 59:
-                # вычисляем диапазон прошлой недели
-                week_start = now - timedelta(days=7)
-                week_end = now - timedelta(days=1)
-                start_key = ymd(week_start)
-                end_key = ymd(week_end)
-
-                # подсчёт пользователей
-                cur.execute("""
-                    SELECT COUNT(*) FROM users
-                    WHERE DATE(joined_at) BETWEEN ? AND ?
-                """, (start_key, end_key))
-                new_users = cur.fetchone()[0]
-
-                # коды
-                cur.execute("""
-                    SELECT COUNT(*) FROM codes
-                    WHERE DATE(issued_at) BETWEEN ? AND ?
-                """, (start_key, end_key))
-                codes = cur.fetchone()[0]
-
-                # брони
-                cur.execute("""
-                    SELECT COUNT(*) FROM reservations
-                    WHERE DATE(created_at) BETWEEN ? AND ?
-                """, (start_key, end_key))
-                resv = cur.fetchone()[0]
-
-                # призы (автоматические)
-                cur.execute("""
-                    SELECT COUNT(*) FROM random_rewards
-                    WHERE DATE(date_issued) BETWEEN ? AND ?
-                """, (start_key, end_key))
-                rewards = cur.fetchone()[0]
-
-                text = (
-                    f"📊 <b>Отчёт за неделю</b>\n"
-                    f"📅 {week_start.strftime('%d.%m')}–{week_end.strftime('%d.%m')}\n\n"
-                    f"👥 Новых пользователей: <b>{new_users}</b>\n"
-                    f"🎟 Выдано кодов: <b>{codes}</b>\n"
-                    f"🍽 Создано броней: <b>{resv}</b>\n"
-                    f"🎲 Разыграно призов: <b>{rewards}</b>"
-                )
+            return await handler(event, data)
+        finally:
+            lifecycle.leave()
+
+
+dp.update.outer_middleware(InflightMiddleware())
+
+
+async def apply_reload() -> dict[str, tuple]:
+    """Перечитывает .env (и venues/*.env) и применяет без перезапуска. Возвращает {имя: (было, стало)}."""
+    load_dotenv(dotenv_path, override=True)
+    changed_all = {}
+    for v in VENUES:
+        with use_venue(v):
+            changed = v.reload()
+            if not changed:
+                continue
+            logger.warning("[RELOAD] изменено: %s", ", ".join(changed))
+            await load_settings(force=True)  # значения по умолчанию для /set-ключей пришли из .env
+            if "ADMIN_IDS" in changed:
+                await set_commands()  # отпечаток команд изменился — обновятся только новые админы
+        changed_all.update({(f"{v.name}: {k}" if MULTI_VENUE else k): val for k, val in changed.items()})
+    return changed_all
+
+
+@dp.message(Command("reload"))
+async def reload_cmd(msg: Message):
+    if not is_admin(msg.from_user.id): return
+    changed = await apply_reload()
+    if not changed:
+        return await msg.answer("🔄 .env перечитан — изменений нет.")
+    lines = ["🔄 <b>Настройки обновлены без перезапуска:</b>"]
+    lines += [f"— {name}: {html.escape(str(old))} → {html.escape(str(val))}" for name, (old, val) in changed.items()]
+    await msg.answer("\n".join(lines))
+
+
+# ===== Update ledger =====
+# Если процесс упал (или ушёл в execv) после обработки апдейта, но до того, как
+# Telegram узнал новый offset, апдейт придёт ещё раз. Журнал processed_updates
+# помнит недавние update_id: повтор отбрасывается до хендлеров. Отметка пишется
+# в той же транзакции, что и изменения хендлера (Storage._flush_ledger перед COMMIT),
+# а если хендлер транзакций не открывал — сразу после него.
+# Для действий с побочными эффектами (бронь, розыгрыш) дополнительно есть ключи
+# операций op_keys: они ловят и двойное нажатие, пришедшее разными апдейтами.
+LEDGER_KEEP_HOURS = int(os.getenv("LEDGER_KEEP_HOURS", "48"))      # Telegram хранит апдейты до 24 ч
+LEDGER_OPS_KEEP_DAYS = int(os.getenv("LEDGER_OPS_KEEP_DAYS", "14"))
+
+
+class DuplicateOp(Exception):
+    """Операция пользователя уже выполнялась; result — что она вернула тогда."""
+    def __init__(self, op_key: str, result: Optional[str]):
+        super().__init__(op_key)
+        self.result = result
+
+
+class _LedgerEntry:
+    __slots__ = ("update_id", "user_id", "recorded")
+
+    def __init__(self, update_id: int, user_id: Optional[int]):
+        self.update_id, self.user_id, self.recorded = update_id, user_id, False
+
+
+async def claim_op(user_id: int, op: str, result="") -> None:
+    """Вызывать внутри транзакции, до изменений. DuplicateOp — операция уже была."""
+    key = f"{user_id}:{op}"
+    row = await storage.fetchone("SELECT result FROM op_keys WHERE op_key=?", (key,))
+    if row:
+        raise DuplicateOp(key, row[0])
+    # без ON CONFLICT: параллельный дубль (Postgres) упадёт на ключе и откатит свою транзакцию
+    await storage.execute("INSERT INTO op_keys (op_key, user_id, result, created_at) VALUES (?,?,?,?)",
+                          (key, user_id, str(result), now_tz().isoformat()))
+
+
+async def set_op_result(user_id: int, op: str, result) -> None:
+    await storage.execute("UPDATE op_keys SET result=? WHERE op_key=?", (str(result), f"{user_id}:{op}"))
+
+
+class LedgerMiddleware(BaseMiddleware):
+    def __init__(self):
+        self.inflight: set[int] = set()  # тот же апдейт, пришедший параллельно
+
+    async def __call__(self, handler, event: Update, data: dict):
+        update_id = event.update_id
+        if update_id in self.inflight or await storage.fetchval(
+                "SELECT 1 FROM processed_updates WHERE update_id=?", (update_id,)):
+            metrics.inc("updates_duplicate_total")
+            logger.warning("[LEDGER] update %s уже обработан — пропускаю", update_id)
+            return None
+        user = data.get("event_from_user")
+        entry = _LedgerEntry(update_id, user.id if user else None)
+        self.inflight.add(update_id)
+        token = _LEDGER_ENTRY.set(entry)
+        try:
+            result = await handler(event, data)
+            if not entry.recorded:
+                await storage.execute(LEDGER_INSERT, (update_id, entry.user_id, now_tz().isoformat()))
+            return result
+        finally:
+            _LEDGER_ENTRY.reset(token)
+            self.inflight.discard(update_id)
+
+
+# после InflightMiddleware: запись в журнал входит в «незавершённую работу», которую ждёт drain
+dp.update.outer_middleware(LedgerMiddleware())
+
+
+async def prune_ledger() -> tuple[int, int]:
+    now = now_tz()
+    updates = await storage.execute("DELETE FROM processed_updates WHERE processed_at < ?",
+                                    ((now - timedelta(hours=LEDGER_KEEP_HOURS)).isoformat(),))
+    ops = await storage.execute("DELETE FROM op_keys WHERE created_at < ?",
+                                ((now - timedelta(days=LEDGER_OPS_KEEP_DAYS)).isoformat(),))
+    if updates or ops:
+        logger.info("[LEDGER] очищено: апдейтов %s, ключей операций %s", updates, ops)
+    return updates, ops
+
+
+# ===== Backups =====
+# каталог — BACKUP_DIR (при нескольких заведениях — подкаталог на заведение, см. Venue)
+BACKUP_TIME = _parse_hhmm(os.getenv("BACKUP_TIME", "03:30"))
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", "0.01"))
+BACKUP_KEEP_DAILY = int(os.getenv("BACKUP_KEEP_DAILY", "7"))     # по одному на день
+BACKUP_KEEP_WEEKLY = int(os.getenv("BACKUP_KEEP_WEEKLY", "4"))   # по одному на неделю сверх дневных
+
+BACKUP_STATUS = venue_local("backup_status", lambda v: {})   # последний бэкап: at, file, size, seconds, ok, error
+venue_local("backup_lock", lambda v: asyncio.Lock())   # async with venue.backup_lock
+
+
+def _integrity_check(path: str) -> str:
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return conn.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _archive_companion(path: str) -> str:
+    """codes-YYYYMMDD-HHMMSS.db -> codes-YYYYMMDD-HHMMSS.archive.db (копия базы архива того же бэкапа)."""
+    return path[:-len(".db")] + ".archive.db"
 
-                await notify_admins(text)
-                last_report_week = (iso_year, iso_week)
 
-            await asyncio.sleep(60)
+def _rotate_backups(directory: str, keep_daily: int, keep_weekly: int) -> list[str]:
+    """Оставляет самый свежий файл за каждый из последних keep_daily дней
+    и за каждую из keep_weekly недель до них (вместе с его .archive.db). Возвращает удалённые файлы."""
+    files = sorted((f for f in os.listdir(directory)
+                    if f.startswith("codes-") and f.endswith(".db") and not f.endswith(".archive.db")), reverse=True)
+    days, weeks, removed = set(), set(), []
+    for name in files:
+        try:
+            dt = datetime.strptime(name[6:21], "%Y%m%d-%H%M%S")
+        except ValueError:
+            continue
+        day, week = dt.date(), dt.isocalendar()[:2]
+        keep = False
+        if day not in days and len(days) < keep_daily:
+            days.add(day)
+            keep = True
+        elif day not in days and week not in weeks and len(weeks) < keep_weekly:
+            weeks.add(week)
+            keep = True
+        if not keep:
+            os.remove(os.path.join(directory, name))
+            removed.append(name)
+            companion = _archive_companion(name)
+            if os.path.exists(os.path.join(directory, companion)):
+                os.remove(os.path.join(directory, companion))
+                removed.append(companion)
+    return removed
+
+
+async def make_backup() -> dict:
+    """Горячий бэкап codes.db и базы архива (codes-*.archive.db) + integrity_check обоих + ротация."""
+    async with venue.backup_lock:
+        os.makedirs(venue.backup_dir, exist_ok=True)
+        path = os.path.join(venue.backup_dir, f"codes-{now_tz():%Y%m%d-%H%M%S}.db")
+        archive_path = _archive_companion(path)
+        started = time.monotonic()
+        status = {"at": now_tz().strftime("%Y-%m-%d %H:%M:%S"), "file": path, "ok": False}
+        try:
+            # сначала основная, потом архив: строка, переехавшая в архив между копиями, окажется
+            # в обеих (повторный перенос её пропустит), а не потеряется
+            await storage.backup_to(path + ".part", BACKUP_PAGES_PER_STEP, BACKUP_STEP_SLEEP)
+            await storage.backup_to(archive_path + ".part", BACKUP_PAGES_PER_STEP, BACKUP_STEP_SLEEP, name="archive")
+            for part in (path + ".part", archive_path + ".part"):
+                check = await asyncio.to_thread(_integrity_check, part)
+                if check != "ok":
+                    raise RuntimeError(f"integrity_check {os.path.basename(part)}: {check}")
+            os.replace(archive_path + ".part", archive_path)
+            os.replace(path + ".part", path)
+            status.update(ok=True, size=os.path.getsize(path), archive_size=os.path.getsize(archive_path),
+                          removed=await asyncio.to_thread(_rotate_backups, venue.backup_dir, BACKUP_KEEP_DAILY, BACKUP_KEEP_WEEKLY))
+            metrics.set("backup_last_success_timestamp", time.time())
+        except Exception as e:
+            status["error"] = str(e)
+            for part in (path + ".part", archive_path + ".part"):
+                if os.path.exists(part):
+                    os.remove(part)
+            metrics.inc("backup_failures_total")
+            logger.exception("[BACKUP] %s", e)
+        status["seconds"] = round(time.monotonic() - started, 2)
+        metrics.set("backup_seconds", status["seconds"])
+        BACKUP_STATUS.clear()
+        BACKUP_STATUS.update(status)
+        return status
+
+
+def backup_status_text(st: dict) -> str:
+    if not st:
+        return "💾 Бэкапов в этом запуске ещё не было."
+    if not st["ok"]:
+        return f"❌ <b>Бэкап не удался</b> ({st['at']})\n{html.escape(st.get('error', ''))}"
+    text = (f"💾 <b>Бэкап</b> {st['at']}\n"
+            f"Файл: <code>{os.path.basename(st['file'])}</code>\n"
+            f"Размер: {_fmt_bytes(st['size'])} + архив {_fmt_bytes(st['archive_size'])}, {st['seconds']} с, "
+            f"integrity_check: ok")
+    if st.get("removed"):
+        text += f"\nУдалено по ротации: {len(st['removed'])}"
+    return text
+
+
+async def backup_job():
+    """Ежедневный бэкап в BACKUP_TIME (по Ташкенту)."""
+    st = await make_backup()
+    if not st["ok"]:
+        await notify_admins(backup_status_text(st))
+
+
+@dp.message(Command("backup_now"))
+async def backup_now_cmd(msg: Message):
+    if not is_admin(msg.from_user.id): return
+    if storage.dialect != "sqlite":
+        return await msg.answer("💾 Онлайн-бэкап есть только для SQLite; для Postgres используйте pg_dump.")
+    await msg.answer("💾 Делаю бэкап...")
+    await msg.answer(backup_status_text(await make_backup()))
+
+
+@dp.message(Command("backup_status"))
+async def backup_status_cmd(msg: Message):
+    if not is_admin(msg.from_user.id): return
+    await msg.answer(backup_status_text(BACKUP_STATUS))
+
+
+def _restore_file(src_path: str, dst_path: str, label: str):
+    """Копирует src_path в dst_path через backup API; текущий файл сначала — в backups/pre-restore-*."""
+    dst = sqlite3.connect(dst_path)
+    try:
+        if os.path.exists(dst_path):
+            keep = os.path.join(venue.backup_dir, f"pre-restore-{now_tz():%Y%m%d-%H%M%S}{label}.db")
+            with sqlite3.connect(keep) as copy:
+                dst.backup(copy)
+            logger.info("[RESTORE] текущая база сохранена в %s", keep)
+        src = sqlite3.connect(f"file:{src_path}?mode=ro", uri=True)
+        try:
+            src.backup(dst)
+        finally:
+            src.close()
+        dst.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        dst.close()
+    logger.info("[RESTORE] %s -> %s", src_path, dst_path)
+
+
+def restore_backup(src_path: str):
+    """Восстановление: `python bot.py --restore backups/codes-YYYYMMDD-HHMMSS.db` (бот должен быть остановлен).
+    Рядом лежащий codes-YYYYMMDD-HHMMSS.archive.db восстанавливается в базу архива вместе с основной.
+    Текущие базы сначала сохраняются в backups/pre-restore-*.db."""
+    archive_src = _archive_companion(src_path)
+    pairs = [(src_path, venue.db_path, "")]
+    if os.path.exists(archive_src):
+        pairs.append((archive_src, venue.archive_db_path, ".archive"))
+    else:
+        logger.warning("[RESTORE] %s не найден (бэкап старого формата) — база архива останется как есть", archive_src)
+    # оба файла проверяем до того, как трогать текущие базы
+    for src, _, _ in pairs:
+        check = _integrity_check(src)
+        if check != "ok":
+            raise SystemExit(f"{src}: integrity_check = {check}")
+    os.makedirs(venue.backup_dir, exist_ok=True)
+    for src, dst, label in pairs:
+        _restore_file(src, dst, label)
+
+
+# ===== Task supervisor =====
+# Все фоновые задачи запускаются через supervisor: каждый проход ограничен
+# таймаутом (зависший send_message не подвесит задачу навсегда), ошибки
+# повторяются с экспоненциальной паузой, упавший цикл перезапускается.
+# По каждой задаче помним последний «пульс», успех и ошибку — это видно в
+# /health и в HTTP /readyz (HEALTH_PORT), задача с просроченным пульсом — «зависла».
+from aiohttp import web
+
+SUP_BACKOFF_BASE = float(os.getenv("SUP_BACKOFF_BASE", "5"))      # пауза после первой ошибки, с
+SUP_BACKOFF_MAX = float(os.getenv("SUP_BACKOFF_MAX", "600"))
+SUP_STALE_GRACE = float(os.getenv("SUP_STALE_GRACE", "120"))      # запас к ожидаемому пульсу, с
+HEALTH_HOST = os.getenv("HEALTH_HOST", "127.0.0.1")
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", "0"))                  # 0 — HTTP выключен
+
+
+class TaskState:
+    __slots__ = ("name", "timeout", "last_beat", "last_ok", "last_error", "last_error_at",
+                 "failures", "restarts", "running", "due_by", "next_run")
+
+    def __init__(self, name: str, timeout: float):
+        self.name, self.timeout = name, timeout
+        self.last_beat = time.time()
+        self.last_ok: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.last_error_at: Optional[float] = None
+        self.failures = 0          # подряд
+        self.restarts = 0
+        self.running = False
+        self.due_by = self.last_beat + timeout + SUP_STALE_GRACE  # к этому времени ждём пульс
+        self.next_run: Optional[float] = None
+
+    def stale(self, now: float) -> bool:
+        return now > self.due_by
+
+
+class TaskSupervisor:
+    def __init__(self):
+        self.tasks: dict[str, TaskState] = {}
+        self.polling = False
+
+    def _backoff(self, st: TaskState) -> float:
+        return min(SUP_BACKOFF_MAX, SUP_BACKOFF_BASE * 2 ** max(0, st.failures - 1))
+
+    def _expect(self, st: TaskState, at: float):
+        """Следующий пульс ожидается не позже at + timeout + запас."""
+        st.next_run = at
+        st.due_by = at + st.timeout + SUP_STALE_GRACE
+        metrics.set("task_next_run_timestamp", int(at), task=st.name)
+
+    def _fail(self, st: TaskState, error: str):
+        st.failures += 1
+        st.last_error, st.last_error_at = error, time.time()
+        metrics.inc("task_failures_total", task=st.name)
+
+    async def _iteration(self, st: TaskState, fn) -> bool:
+        st.running = True
+        st.last_beat = time.time()
+        st.due_by = st.last_beat + st.timeout + SUP_STALE_GRACE
+        async def run():
+            key = id(asyncio.current_task())
+            LOOP_ACTIVITY[key] = f"task {st.name}"  # для детектора зависаний
+            try:
+                await fn()
+            finally:
+                LOOP_ACTIVITY.pop(key, None)
+
+        try:
+            await asyncio.wait_for(run(), timeout=st.timeout)
+        except asyncio.TimeoutError:
+            self._fail(st, f"таймаут {st.timeout:.0f} с")
+            logger.error("[SUPERVISOR] %s: проход не уложился в %.0f с", st.name, st.timeout)
+            return False
         except Exception as e:
-            print(f"[WEEKLY-REPORT][ERROR] {e}")
-            await asyncio.sleep(60)
-        
+            self._fail(st, f"{type(e).__name__}: {e}")
+            logger.exception("[SUPERVISOR] %s: %s", st.name, e)
+            return False
+        finally:
+            st.running = False
+            st.last_beat = time.time()
+        st.failures = 0
+        st.last_ok = st.last_beat
+        metrics.set("task_last_success_timestamp", int(st.last_ok), task=st.name)
+        return True
+
+    async def _guard(self, st: TaskState, loop_fn):
+        """Перезапускает сам цикл, если он упал мимо _iteration."""
+        while True:
+            try:
+                await loop_fn()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._fail(st, f"{type(e).__name__}: {e}")
+                st.restarts += 1
+                metrics.inc("task_restarts_total", task=st.name)
+                delay = self._backoff(st)
+                logger.exception("[SUPERVISOR] %s упал, перезапуск через %.0f с: %s", st.name, delay, e)
+                self._expect(st, time.time() + delay)
+                await asyncio.sleep(delay)
+
+    def periodic(self, name: str, fn, every: float, timeout: float, first_delay: float = 0) -> asyncio.Task:
+        """fn() раз в every секунд; после ошибки — повтор раньше, с растущей паузой."""
+        st = self.tasks[name] = TaskState(name, timeout)
+
+        async def loop_fn():
+            if first_delay:
+                self._expect(st, time.time() + first_delay)
+                await asyncio.sleep(first_delay)
+            while True:
+                ok = await self._iteration(st, fn)
+                delay = every if ok else min(every, self._backoff(st))
+                self._expect(st, time.time() + delay)
+                await asyncio.sleep(delay)
+
+        return lifecycle.spawn(self._guard(st, loop_fn), name)
+
+    def scheduled(self, name: str, job, when, weekday=None, timeout: float = 1800) -> asyncio.Task:
+        """job() в заданное время. when/weekday — ключ настройки (cfg) или значение.
+
+        Упавшую задачу не повторяем до следующего срока: рассылки могли уйти частично."""
+        st = self.tasks[name] = TaskState(name, timeout)
+
+        def value(v):
+            return cfg(v) if isinstance(v, str) else v
+
+        async def loop_fn():
+            last_due = None
+            while True:
+                changed = venue.settings_changed
+                now = now_tz()
+                # не раньше, чем через секунду после прошлого запуска: таймер может сработать
+                # на доли секунды раньше, и задача запустилась бы дважды
+                base = max(now, last_due + timedelta(seconds=1)) if last_due else now
+                due = next_run_at(base, value(when), value(weekday))
+                self._expect(st, due.timestamp())
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=max(0.0, (due - now).total_seconds()))
+                    logger.info("[SCHED] %s: настройки изменились, пересчитываю время запуска", name)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+                last_due = due
+                await self._iteration(st, job)
+
+        return lifecycle.spawn(self._guard(st, loop_fn), name)
+
+    def report(self) -> dict:
+        now = time.time()
+        tasks = {}
+        for name, st in self.tasks.items():
+            tasks[name] = {
+                "ok": not st.stale(now) and st.failures == 0,
+                "stale": st.stale(now),
+                "running": st.running,
+                "last_ok": st.last_ok,
+                "next_run": st.next_run,
+                "failures": st.failures,
+                "restarts": st.restarts,
+                "last_error": st.last_error,
+            }
+        stale = [n for n, t in tasks.items() if t["stale"]]
+        return {"ready": self.polling and not lifecycle.stopping and not stale,
+                "polling": self.polling, "stopping": lifecycle.stopping,
+                "stale": stale, "tasks": tasks}
+
+
+supervisor = TaskSupervisor()
+
+
+@dp.startup()
+async def _on_polling_start():
+    supervisor.polling = True
+
+
+@dp.shutdown()
+async def _on_polling_stop():
+    supervisor.polling = False
+
+
+def _ago(ts: Optional[float]) -> str:
+    if ts is None:
+        return "—"
+    sec = time.time() - ts
+    if sec < 0:
+        return f"через {_fmt_duration(-sec)}"
+    return f"{_fmt_duration(sec)} назад"
+
+
+def _fmt_duration(sec: float) -> str:
+    if sec < 90:
+        return f"{sec:.0f} с"
+    if sec < 5400:
+        return f"{sec / 60:.0f} мин"
+    if sec < 48 * 3600:
+        return f"{sec / 3600:.1f} ч"
+    return f"{sec / 86400:.1f} дн"
+
+
+async def health_text() -> str:
+    rep = supervisor.report()
+    try:
+        await storage.fetchval("SELECT 1")
+        db = "✅"
+    except Exception as e:
+        db = f"❌ {html.escape(str(e))}"
+    lines = [f"{'✅' if rep['ready'] else '⚠️'} <b>Состояние бота</b>",
+             f"Поллинг: {'✅' if rep['polling'] else '❌'}   БД: {db}", ""]
+    for name, t in rep["tasks"].items():
+        icon = "⏳" if t["running"] else ("❌" if t["stale"] else ("⚠️" if t["failures"] else "✅"))
+        line = f"{icon} <b>{name}</b> — успех: {_ago(t['last_ok'])}, следующий: {_ago(t['next_run'])}"
+        if t["failures"] or t["restarts"]:
+            line += f"\n    ошибок подряд: {t['failures']}, перезапусков: {t['restarts']}"
+        if t["last_error"]:
+            line += f"\n    {html.escape(t['last_error'][:200])}"
+        lines.append(line)
+    if rep["stale"]:
+        lines += ["", f"❌ Зависли: {', '.join(rep['stale'])}"]
+    return "\n".join(lines)
+
+
+@dp.message(Command("health"))
+async def health_cmd(msg: Message):
+    if not is_admin(msg.from_user.id): return
+    await msg.answer(await health_text())
+
+
+# --- HTTP: /healthz (процесс жив), /readyz (поллинг + БД + нет зависших задач), /metrics ---
+async def _http_healthz(request):
+    return web.json_response({"ok": True, "version": APP_VERSION})
+
+
+async def _http_readyz(request):
+    rep = supervisor.report()
+    try:
+        await storage.fetchval("SELECT 1")
+        rep["db"] = True
+    except Exception:
+        rep["db"] = False
+        rep["ready"] = False
+    return web.json_response(rep, status=200 if rep["ready"] else 503)
+
+
+async def _http_metrics(request):
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+
+async def start_health_server() -> Optional[web.AppRunner]:
+    if not HEALTH_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/healthz", _http_healthz)
+    app.router.add_get("/readyz", _http_readyz)
+    app.router.add_get("/metrics", _http_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, HEALTH_HOST, HEALTH_PORT).start()
+    logger.info("[HEALTH] http://%s:%s/readyz", HEALTH_HOST, HEALTH_PORT)
+    return runner
+
+
+# ===== Event-loop stall detector =====
+# Отдельный поток раз в STALL_PROBE_MS ставит в event loop пустой колбэк и меряет,
+# через сколько он выполнится (лаг цикла). Если колбэк не выполнился за
+# STALL_THRESHOLD_MS — цикл чем-то заблокирован (sqlite, requests, диск): пока он
+# ещё висит, снимаем стек главного потока и смотрим, какая задача/апдейт сейчас
+# выполняется. Последние STALL_KEEP случаев — в /stalls, перцентили лага — в метриках.
+import threading
+import traceback
+
+STALL_DETECTOR = os.getenv("STALL_DETECTOR", "1") == "1"
+STALL_THRESHOLD_MS = int(os.getenv("STALL_THRESHOLD_MS", "300"))
+STALL_PROBE_MS = int(os.getenv("STALL_PROBE_MS", "100"))
+STALL_KEEP = int(os.getenv("STALL_KEEP", "20"))
+STALL_LAG_WINDOW = int(os.getenv("STALL_LAG_WINDOW", "3000"))  # замеров для перцентилей (~5 мин)
+
+# id(task) -> что она сейчас делает («update 123 user 45 → cb_get_code», «task backup»).
+# Пишет event loop (middleware, супервизор), читает поток детектора.
+LOOP_ACTIVITY: dict[int, str] = {}
+
+
+class ActivityMiddleware(BaseMiddleware):
+    """outer (dp.update): апдейт и пользователь; inner: дописывает имя хендлера."""
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        key = id(asyncio.current_task())
+        prev = LOOP_ACTIVITY.get(key)
+        if isinstance(event, Update):
+            user = data.get("event_from_user")
+            LOOP_ACTIVITY[key] = f"update {event.update_id} user {user.id if user else '-'} ({event.event_type})"
+        else:
+            handler_obj = data.get("handler")
+            name = getattr(handler_obj.callback, "__name__", "?") if handler_obj else "?"
+            LOOP_ACTIVITY[key] = f"{prev or 'update'} → {name}"
+        try:
+            return await handler(event, data)
+        finally:
+            if prev is None:
+                LOOP_ACTIVITY.pop(key, None)
+            else:
+                LOOP_ACTIVITY[key] = prev
+
+
+dp.update.outer_middleware(ActivityMiddleware())
+dp.message.middleware(ActivityMiddleware())
+dp.callback_query.middleware(ActivityMiddleware())
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class StallDetector:
+    def __init__(self, threshold: float, probe: float, keep: int, window: int):
+        self.threshold, self.probe = threshold, probe
+        self.lock = threading.Lock()
+        self.samples: deque = deque(maxlen=window)
+        self.stalls: deque = deque(maxlen=keep)
+        self.total = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """Вызывать из потока event loop."""
+        self.loop, self.loop_thread = loop, threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="stall-detector", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _capture(self) -> dict:
+        frame = sys._current_frames().get(self.loop_thread)
+        stack = traceback.format_stack(frame) if frame else []
+        try:
+            task = asyncio.current_task(self.loop)
+        except RuntimeError:
+            task = None
+        activity = LOOP_ACTIVITY.get(id(task)) if task else None
+        return {
+            "at": time.time(),
+            "task": task.get_name() if task else "вне задачи (колбэк цикла)",
+            "activity": activity or "—",
+            "stack": "".join(stack[-12:]),
+        }
+
+    def _run(self):
+        while not self._stop.is_set():
+            ran = threading.Event()
+            sent = time.perf_counter()
+            try:
+                self.loop.call_soon_threadsafe(ran.set)
+            except RuntimeError:
+                return  # цикл закрыт
+            stall = None
+            if not ran.wait(self.threshold):
+                stall = self._capture()  # цикл всё ещё стоит — стек показывает виновника
+                while not ran.wait(1.0):
+                    if self._stop.is_set() or self.loop.is_closed():
+                        return
+            lag = time.perf_counter() - sent
+            with self.lock:
+                self.samples.append(lag)
+                if stall:
+                    stall["lag"] = lag
+                    self.stalls.append(stall)
+                    self.total += 1
+            if stall:
+                logger.warning("[STALL] цикл стоял %.0f мс: %s (%s)\n%s",
+                               lag * 1000, stall["activity"], stall["task"], stall["stack"])
+            self._stop.wait(self.probe)
+
+    def snapshot(self) -> tuple[list[float], list[dict], int]:
+        with self.lock:
+            return sorted(self.samples), list(self.stalls), self.total
+
+    async def export_metrics(self):
+        lags, _, total = self.snapshot()
+        for q in (0.5, 0.9, 0.99):
+            metrics.set("loop_lag_seconds", round(_percentile(lags, q), 4), quantile=str(q))
+        metrics.set("loop_lag_max_seconds", round(lags[-1] if lags else 0.0, 4))
+        metrics.set("loop_stalls_since_start", total)
+
+
+stall_detector = StallDetector(STALL_THRESHOLD_MS / 1000, STALL_PROBE_MS / 1000, STALL_KEEP, STALL_LAG_WINDOW)
+
+
+@dp.message(Command("stalls"))
+async def stalls_cmd(msg: Message):
+    if not is_admin(msg.from_user.id): return
+    lags, stalls, total = stall_detector.snapshot()
+    ms = lambda q: f"{_percentile(lags, q) * 1000:.1f}"
+    head = (f"🐢 <b>Задержки event loop</b> (последние {len(lags)} замеров)\n"
+            f"p50 {ms(0.5)} мс · p90 {ms(0.9)} мс · p99 {ms(0.99)} мс · max {ms(1.0)} мс\n"
+            f"Зависаний > {STALL_THRESHOLD_MS} мс с запуска: <b>{total}</b>")
+    if not STALL_DETECTOR:
+        head += "\n(детектор выключен: STALL_DETECTOR=0)"
+    await msg.answer(head)
+    for st in stalls[-5:][::-1]:
+        when = datetime.fromtimestamp(st["at"], TZ).strftime("%d.%m %H:%M:%S")
+        text = (f"⏱ {when} — <b>{st['lag'] * 1000:.0f} мс</b>\n"
+                f"{html.escape(st['activity'])} [{html.escape(st['task'])}]\n"
+                f"<pre>{html.escape(st['stack'][-3000:])}</pre>")
+        await msg.answer(text)
+
+
 # ===== Run =====
-async def main():
-    if not BOT_TOKEN:
-        raise RuntimeError("BOT_TOKEN is empty. Set it in .env")
-    print("✅ Bot starting... Time now (Tashkent):", now_tz().strftime("%Y-%m-%d %H:%M:%S"))
-    print("✅ VERSION:", APP_VERSION)
-    
+async def start_venue():
+    """Подготовка текущего заведения: БД, индексы, настройки, команды, фоновые задачи.
+
+    Задачи запускаются внутри use_venue() и наследуют заведение из контекста."""
+    if not venue.BOT_TOKEN:
+        raise RuntimeError(f"BOT_TOKEN is empty ({venue.env_file or '.env'}). Set it in .env")
+    await storage.connect()
+    await storage.migrate()
+    await backfill_phone_norm()
+    await backfill_expiry_tz()
+    await ensure_guest_identity()
+    await warm_capacity_index()
+    await warm_code_index()
+    await load_settings(force=True)
+    await backfill_analytics()
+
     await set_commands()
-    
-    # фоновые задачи
-    asyncio.create_task(notifier_task())
-    asyncio.create_task(rewards_expiry_task())  # ← правильное имя и без лишней 's'
-    asyncio.create_task(weekly_report_task())
 
-  
-    await dp.start_polling(bot)
+    # фоновые задачи (таймаут — на один проход)
+    supervisor.periodic(venue_task("settings_watch"), load_settings, SETTINGS_POLL_SEC, timeout=30,
+                        first_delay=SETTINGS_POLL_SEC)
+    supervisor.periodic(venue_task("ledger_prune"), prune_ledger, 3600, timeout=300)
+    supervisor.periodic(venue_task("file_cache_prune"), prune_file_cache, 86400, timeout=300, first_delay=600)
+    supervisor.periodic(venue_task("rewards_expiry"), check_rewards_expiry, 1800, timeout=900)
+    supervisor.scheduled(venue_task("reminder"), reminder_job, "reminder_time", timeout=1800)
+    supervisor.scheduled(venue_task("daily_report"), daily_report_job, "report_time", timeout=3600)
+    supervisor.scheduled(venue_task("prizes"), prize_broadcast_job, "prize_time", "prize_day", timeout=1800)
+    supervisor.scheduled(venue_task("weekly_report"), weekly_report_job, (10, 0), 0, timeout=600)
+    if storage.dialect == "sqlite":
+        supervisor.scheduled(venue_task("backup"), backup_job, BACKUP_TIME, timeout=3600)
+
+
+async def main():
+    logger.info("✅ Bot starting... Time now (Tashkent): %s", now_tz().strftime("%Y-%m-%d %H:%M:%S"))
+    logger.info("✅ VERSION: %s", APP_VERSION)
+    if MULTI_VENUE:
+        logger.info("✅ Заведения: %s", ", ".join(v.name for v in VENUES))
+    for v in VENUES:
+        with use_venue(v):
+            await start_venue()
+    health_server = await start_health_server()
+    if STALL_DETECTOR:
+        stall_detector.start(asyncio.get_running_loop())
+        supervisor.periodic("loop_lag_export", stall_detector.export_metrics, 15, timeout=5)
+
+    # SIGTERM/SIGINT — мягкая остановка, SIGHUP — перечитать .env (на Windows сигналов нет)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, lifecycle.request_stop)
+        except (NotImplementedError, AttributeError):
+            pass
+    try:
+        loop.add_signal_handler(signal.SIGHUP, lambda: loop.create_task(apply_reload()))
+    except (NotImplementedError, AttributeError):
+        pass
+
+    try:
+        await dp.start_polling(*(v.bot for v in VENUES), handle_signals=False, close_bot_session=False)
+    finally:
+        await lifecycle.drain()
+        stall_detector.stop()
+        shutdown_qr_pool()
+        if health_server:
+            await health_server.cleanup()
+    if lifecycle.restart:
+        lifecycle.exec_restart()
 
 if __name__ == "__main__":
+    if "--venue" in sys.argv:  # для --migrate-to-pg / --restore при нескольких заведениях
+        _CURRENT_VENUE.set(VENUES_BY_NAME[sys.argv[sys.argv.index("--venue") + 1]])
+    if "--bench-capacity" in sys.argv:
+        bench_capacity()
+        sys.exit(0)
+    if "--bench-check" in sys.argv:
+        bench_check()
+        sys.exit(0)
+    if "--codes-selftest" in sys.argv:
+        sys.exit(0 if codes_selftest() else 1)
+    if "--iiko-selftest" in sys.argv:
+        sys.exit(0 if asyncio.run(iiko_selftest()) else 1)
+    if "--storage-selftest" in sys.argv:
+        sys.exit(0 if asyncio.run(storage_selftest()) else 1)
+    if "--migrate-to-pg" in sys.argv:
+        asyncio.run(migrate_sqlite_to_pg())
+        sys.exit(0)
+    if "--merge-guests" in sys.argv:
+        asyncio.run(merge_guests_cli(dry_run="--dry-run" in sys.argv))
+        sys.exit(0)
+    if "--restore" in sys.argv:
+        restore_backup(sys.argv[sys.argv.index("--restore") + 1])
+        sys.exit(0)
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
-        print("Bot stopped.")
+        logger.info("Bot stopped.")